@@ -0,0 +1,1448 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the console app.
+Runs the app code against a local HTTP stand-in for GitHub, inside a
+temporary working directory, so nothing touches the network or this checkout.
+Usage: python benchmark.py [benchmark_name ...] [--param name=value ...]
+                           [--json results.json] [--baseline baseline.json]
+Results can be written to a JSON document and compared against an earlier
+one; the exit status is 1 when a metric regressed beyond the tolerance.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import http.client
+import inspect
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_DIR)
+
+BENCHMARKS = {}
+
+# Metric name suffixes compared against a baseline, by direction
+HIGHER_IS_BETTER = ("_per_s",)
+LOWER_IS_BETTER = ("_s", "_ms", "_ns", "_bytes", "_bytes_read", "_bytes_written",
+                   "_requests", "_peak_rss", "_modules")
+
+# Counts that regress when they grow at all, whatever the tolerance
+EXACT_METRICS = ("_modules",)
+
+# Modules a launch that applies no update must not import: the update
+# machinery is loaded only when an update is checked for or applied
+DEFERRED_MODULES = ("argparse", "concurrent.futures", "downloader", "glob", "hashlib", "http.client",
+                    "object_cache", "shutil", "subprocess", "tempfile", "urllib.request", "zipfile")
+
+# Timings below this many seconds are too noisy to flag as regressions
+NOISE_FLOOR_S = 0.005
+
+
+def benchmark(name):
+    """Register a benchmark function under the given name."""
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+class StandInServer:
+    """
+    Local HTTP server that serves fixed routes after an artificial delay
+    and counts the requests it receives.
+    routes maps a URL path to response bytes. Every response carries an
+    ETag, and a matching If-None-Match is answered with 304. Range requests
+    are answered with 206 (honouring If-Range). With fail_rate set, that
+    share of responses is cut off halfway through the body; with rate set,
+    each response is sent at about that many bytes per second.
+    """
+
+    def __init__(self, routes, delay=0.0, fail_rate=0.0, seed=0, rate=None):
+        self.routes = routes
+        self.delay = delay
+        self.rate = rate
+        self.fail_rate = fail_rate
+        self.request_count = 0
+        self.not_modified_count = 0
+        self.failed_count = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._etags = {}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server._lock:
+                    server.request_count += 1
+                    fail = server._random.random() < server.fail_rate
+                time.sleep(server.delay)
+                body = server.routes.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                etag = server.etag(body)
+                if self.headers.get("If-None-Match") == etag:
+                    with server._lock:
+                        server.not_modified_count += 1
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+
+                byte_range = self.headers.get("Range", "")
+                if_range = self.headers.get("If-Range")
+                if byte_range.startswith("bytes=") and if_range in (None, etag):
+                    first, _, last = byte_range[6:].partition("-")
+                    first = int(first)
+                    last = min(int(last) if last else len(body) - 1, len(body) - 1)
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {first}-{last}/{len(body)}")
+                    body = body[first:last + 1]
+                else:
+                    self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if fail:
+                    body = body[:len(body) // 2]
+                    with server._lock:
+                        server.failed_count += 1
+                if server.rate:
+                    block_size = 64 * 1024
+                    for offset in range(0, len(body), block_size):
+                        self.wfile.write(body[offset:offset + block_size])
+                        time.sleep(block_size / server.rate)
+                else:
+                    self.wfile.write(body)
+                with server._lock:
+                    server.bytes_sent += len(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    def etag(self, body):
+        """Return the ETag of a response body, hashing each body once."""
+        key = id(body)
+        with self._lock:
+            cached = self._etags.get(key)
+        if cached is None or cached[0] is not body:
+            cached = (body, '"%s"' % hashlib.sha1(body).hexdigest())
+            with self._lock:
+                self._etags[key] = cached
+        return cached[1]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@contextlib.contextmanager
+def app_workdir(object_cache_dir=None):
+    """
+    Run inside a throwaway copy of the app's runtime state. The object cache
+    lives inside it too, unless object_cache_dir names a shared one.
+    """
+    import object_cache
+
+    old_cwd = os.getcwd()
+    old_cache_dir = object_cache.OBJECT_CACHE_DIR
+    workdir = tempfile.mkdtemp(prefix="app_bench_")
+    shutil.copy2(os.path.join(APP_DIR, "version.json"), workdir)
+    object_cache.OBJECT_CACHE_DIR = object_cache_dir or os.path.join(workdir, ".object_cache")
+    os.chdir(workdir)
+    try:
+        yield workdir
+    finally:
+        os.chdir(old_cwd)
+        object_cache.OBJECT_CACHE_DIR = old_cache_dir
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def point_updater_at(server):
+    """Redirect the updater's GitHub URLs to the stand-in server."""
+    import updater
+    updater.GITHUB_RAW_URL = f"{server.url}/raw"
+    updater.GITHUB_RELEASE_INDEX_URL = f"{server.url}/release-index.json"
+    updater.GITHUB_VERSION_URL = f"{server.url}/version.json"
+    updater.GITHUB_MANIFEST_URL = f"{server.url}/raw/manifest.json"
+    updater.GITHUB_ZIP_URL = f"{server.url}/archive.zip"
+
+
+def release_index(version_data):
+    """A release index whose stable channel points to the given release."""
+    return json.dumps({"channels": {"stable": version_data["version"]},
+                       "releases": {version_data["version"]: version_data}}).encode('utf-8')
+
+
+def metadata_routes():
+    """Routes reporting the local version, so no update is applied."""
+    with open(os.path.join(APP_DIR, "version.json"), 'rb') as f:
+        version_body = f.read()
+    return {
+        "/release-index.json": release_index(json.loads(version_body)),
+        "/version.json": version_body,
+    }
+
+
+def generate_release(file_count, file_size, changed=0):
+    """
+    Generate two versions of a synthetic release tree in memory.
+    Returns (old_files, new_files), each {relative_path: bytes};
+    the first `changed` files differ between the two.
+    """
+    old_files, new_files = {}, {}
+    for i in range(file_count):
+        path = f"pkg{i % 20}/module_{i}.py"
+        content = (f"# file {i}\n".encode('utf-8') * file_size)[:file_size]
+        old_files[path] = content
+        new_files[path] = (b"# changed\n" + content)[:file_size] if i < changed else content
+    return old_files, new_files
+
+
+def write_tree(root, files):
+    """Write {relative_path: bytes} under root."""
+    for path, content in files.items():
+        full_path = os.path.join(root, *path.split('/'))
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'wb') as f:
+            f.write(content)
+
+
+def release_routes(files, version_data):
+    """
+    Routes publishing a release: version.json, manifest, raw files and
+    the GitHub-style archive with a "repo-branch/" top-level folder.
+    """
+    import updater
+
+    version_body = json.dumps(version_data).encode('utf-8')
+    manifest = {"version": version_data["version"], "files": {
+        path: {"sha256": hashlib.sha256(content).hexdigest(), "size": len(content)}
+        for path, content in files.items()
+    }}
+
+    archive = io.BytesIO()
+    prefix = f"{updater.GITHUB_REPO_NAME}-{updater.GIT_BRANCH}/"
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(prefix + updater.VERSION_FILE, version_body)
+        zf.writestr(prefix + updater.MANIFEST_FILE, json.dumps(manifest))
+        for path, content in files.items():
+            zf.writestr(prefix + path, content)
+
+    routes = {f"/raw/{path}": content for path, content in files.items()}
+    routes["/release-index.json"] = release_index(version_data)
+    routes["/version.json"] = version_body
+    routes["/raw/manifest.json"] = json.dumps(manifest).encode('utf-8')
+    routes["/archive.zip"] = archive.getvalue()
+    return routes
+
+
+def disk_usage(*roots):
+    """Bytes used by the files under roots, counting hard-linked files once."""
+    seen = set()
+    total = 0
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                stat_result = os.lstat(os.path.join(dirpath, name))
+                if (stat_result.st_dev, stat_result.st_ino) not in seen:
+                    seen.add((stat_result.st_dev, stat_result.st_ino))
+                    total += stat_result.st_size
+    return total
+
+
+def io_counters():
+    """
+    Return (bytes_read, bytes_written) through read/write syscalls so far,
+    from /proc/self/io; (0, 0) where that is not available. The counts
+    include the in-process stand-in server's socket traffic.
+    """
+    try:
+        with open("/proc/self/io", 'r') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def legacy_full_update():
+    """
+    The pre-streaming update path: download to update.zip, extractall into
+    temp_update_extract, copy into the app directory, delete both copies.
+    Kept only as a reference point for the update_apply benchmark.
+    """
+    import updater
+    from urllib.request import urlopen
+
+    temp_zip_path = "update.zip"
+    temp_extract_dir = "temp_update_extract"
+    try:
+        with urlopen(updater.GITHUB_ZIP_URL) as response, open(temp_zip_path, 'wb') as out_file:
+            shutil.copyfileobj(response, out_file)
+        with zipfile.ZipFile(temp_zip_path, 'r') as zip_ref:
+            zip_ref.extractall(temp_extract_dir)
+        extracted_app_path = os.path.join(temp_extract_dir, f"{updater.GITHUB_REPO_NAME}-{updater.GIT_BRANCH}")
+        for item_name in os.listdir(extracted_app_path):
+            source_path = os.path.join(extracted_app_path, item_name)
+            if item_name in (updater.DATA_DIR, updater.VERSION_FILE):
+                continue
+            if os.path.isfile(source_path):
+                shutil.copy2(source_path, item_name)
+            elif os.path.isdir(source_path):
+                if os.path.exists(item_name):
+                    shutil.rmtree(item_name)
+                shutil.copytree(source_path, item_name)
+        return True
+    finally:
+        os.remove(temp_zip_path)
+        shutil.rmtree(temp_extract_dir)
+
+
+def legacy_backup_and_restore():
+    """
+    The pre-snapshot backup_user_data()/restore_user_data(): copy every JSON
+    file out and back. Kept only as a reference point for the backup benchmark.
+    """
+    import updater
+
+    backup_dir = "backup_legacy"
+    os.makedirs(backup_dir)
+    for file in os.listdir(updater.DATA_DIR):
+        if file.endswith('.json'):
+            shutil.copy2(os.path.join(updater.DATA_DIR, file), os.path.join(backup_dir, file))
+    for file in os.listdir(backup_dir):
+        shutil.copy2(os.path.join(backup_dir, file), os.path.join(updater.DATA_DIR, file))
+    shutil.rmtree(backup_dir)
+
+
+def write_user_data(count, size=256):
+    """Create count JSON records of roughly size bytes in DATA_DIR."""
+    import utils
+
+    os.makedirs(utils.DATA_DIR, exist_ok=True)
+    filler = "x" * size
+    for i in range(count):
+        with open(os.path.join(utils.DATA_DIR, f"record_{i}.json"), 'w', encoding='utf-8') as f:
+            json.dump({"content": f"{i} {filler}", "created_at": "bench", "version": "1.0"}, f, indent=2)
+
+
+def write_large_record(path, size):
+    """Write a record whose "content" string makes the file about size bytes."""
+    block = ("Голям файл с escape \\n и \\\" символи. " * 1000).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(b'{\n  "content": "')
+        written = 0
+        while written < size:
+            f.write(block)
+            written += len(block)
+        f.write(b'",\n  "created_at": "bench",\n  "version": "1.0"\n}')
+
+
+def peak_rss_of(code):
+    """Run code in a fresh interpreter (app on sys.path); return its peak RSS in bytes."""
+    script = (f"import sys, resource; sys.path.insert(0, {APP_DIR!r})\n{code}\n"
+              "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)")
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+    return int(output.split()[-1]) * 1024  # ru_maxrss is in KiB on Linux
+
+
+class _MenuReached(Exception):
+    pass
+
+
+def time_to_menu(policy):
+    """
+    Run main.main() until the menu would be shown, with the startup update
+    policy forced to policy ("sync", "background" or "skip").
+    Returns elapsed seconds.
+    """
+    import main
+    import updater
+
+    def reached_menu():
+        raise _MenuReached()
+
+    original_menu = main.show_menu
+    original_policy = os.environ.get(updater.UPDATE_POLICY_ENV)
+    main.show_menu = reached_menu
+    os.environ[updater.UPDATE_POLICY_ENV] = policy
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            main.main()
+    except _MenuReached:
+        pass
+    finally:
+        main.show_menu = original_menu
+        if original_policy is None:
+            os.environ.pop(updater.UPDATE_POLICY_ENV, None)
+        else:
+            os.environ[updater.UPDATE_POLICY_ENV] = original_policy
+    return time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def scripted_input(answers):
+    """Answer input() prompts from answers in order, discarding the output."""
+    import builtins
+
+    answers = iter(answers)
+    original_input = builtins.input
+    builtins.input = lambda prompt='': next(answers)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        builtins.input = original_input
+
+
+@benchmark("startup")
+def bench_startup(delay=0.5):
+    """Time to menu with a synchronous, background or skipped update check."""
+    import updater
+
+    results = {}
+    with app_workdir(), StandInServer(metadata_routes(), delay=delay) as server:
+        point_updater_at(server)
+        for policy in updater.UPDATE_POLICIES:
+            for path in (updater.HTTP_CACHE_FILE, updater.UPDATE_STATE_FILE):
+                if os.path.exists(path):
+                    os.remove(path)
+            requests_before = server.request_count
+            results[f"{policy}_check_s"] = time_to_menu(policy)
+            updater.apply_pending_update()
+            results[f"{policy}_requests"] = server.request_count - requests_before
+
+        # Unforced policy on a second launch right after a check: skipped
+        os.environ.pop(updater.UPDATE_POLICY_ENV, None)
+        updater.get_latest_github_version(verbose=False)
+        results["decision_after_check"] = updater.decide_update_policy("interactive")[0]
+        results["decision_batch"] = updater.decide_update_policy("batch")[0]
+    results["server_delay_s"] = delay
+    return results
+
+
+@benchmark("process_start")
+def bench_process_start(runs=5):
+    """
+    Wall time of `python main.py` from launch to exit at the first prompt:
+    cold (no compiled bytecode yet) vs. warm (bytecode cached). Piped stdin
+    makes it a batch run, so the update check is skipped.
+    """
+    results = {"runs": runs}
+    with app_workdir() as workdir:
+        timings = {"cold": [], "warm": []}
+        for run in range(runs):
+            pycache = os.path.join(workdir, f".pycache_{run}")
+            for mode in ("cold", "warm"):
+                # The first launch with a fresh prefix compiles every module
+                start = time.perf_counter()
+                subprocess.run([sys.executable, os.path.join(APP_DIR, "main.py")],
+                               input=b"9\nn\n", capture_output=True, check=True,
+                               env=dict(os.environ, PYTHONPYCACHEPREFIX=pycache))
+                timings[mode].append(time.perf_counter() - start)
+        for mode, values in timings.items():
+            results[f"{mode}_s"] = statistics.median(values)
+    return results
+
+
+def import_times(args, stdin=b""):
+    """
+    Run `python -X importtime args` and return {module: (cumulative_us, top_level)}
+    for every module it imported.
+    """
+    stderr = subprocess.run([sys.executable, "-X", "importtime", *args], input=stdin,
+                            capture_output=True, check=True).stderr.decode('utf-8', 'replace')
+    modules = {}
+    for line in stderr.splitlines():
+        fields = line.split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2][1:]
+        modules[name.strip()] = (int(fields[1]), not name.startswith(" "))
+    return modules
+
+
+@benchmark("imports")
+def bench_imports(runs=5):
+    """
+    Modules imported and import time of a launch of main.py that applies no
+    update, beyond what the bare interpreter imports. Fails when a module of
+    DEFERRED_MODULES is imported; with --baseline, any growth of the module
+    count is a regression.
+    """
+    interpreter = set(import_times(["-c", "pass"]))
+    timings = []
+    with app_workdir():
+        for _ in range(runs):
+            modules = import_times([os.path.join(APP_DIR, "main.py")], stdin=b"9\nn\n")
+            timings.append(sum(cumulative for name, (cumulative, top_level) in modules.items()
+                               if top_level and name not in interpreter) / 1000)
+    startup_modules = sorted(set(modules) - interpreter)
+    deferred = [name for name in DEFERRED_MODULES if name in startup_modules]
+    if deferred:
+        raise AssertionError(f"startup imports deferred modules: {', '.join(deferred)}")
+    return {"import_ms": statistics.median(timings), "startup_modules": len(startup_modules)}
+
+
+@benchmark("http_cache")
+def bench_http_cache():
+    """Requests made by three back-to-back checks with and without a recheck interval."""
+    import updater
+
+    results = {}
+    original_interval = updater.MIN_RECHECK_INTERVAL
+    with app_workdir(), StandInServer(metadata_routes()) as server:
+        point_updater_at(server)
+        try:
+            for interval in (600, 0):
+                updater.MIN_RECHECK_INTERVAL = interval
+                if os.path.exists(updater.HTTP_CACHE_FILE):
+                    os.remove(updater.HTTP_CACHE_FILE)
+                server.request_count = server.not_modified_count = 0
+                for _ in range(3):
+                    updater.get_latest_github_version()
+                results[f"interval_{interval}_requests"] = server.request_count
+                results[f"interval_{interval}_not_modified"] = server.not_modified_count
+        finally:
+            updater.MIN_RECHECK_INTERVAL = original_interval
+    return results
+
+
+@benchmark("check_noop")
+def bench_check_noop(calls=20, delay=0.0):
+    """
+    check_for_updates() when already up to date: fresh cache vs. revalidation
+    (304), and a fresh cache when no release index is published, where the
+    cached 404 must keep both documents from being requested.
+    """
+    import updater
+
+    results = {"calls": calls}
+    original_interval = updater.MIN_RECHECK_INTERVAL
+    without_index = {path: body for path, body in metadata_routes().items() if path != "/release-index.json"}
+    cases = (("cached", 600, metadata_routes()), ("revalidated", 0, metadata_routes()),
+             ("cached_no_index", 600, without_index))
+    try:
+        for mode, interval, routes in cases:
+            with app_workdir(), StandInServer(routes, delay=delay) as server:
+                point_updater_at(server)
+                updater.MIN_RECHECK_INTERVAL = interval
+                with contextlib.redirect_stdout(io.StringIO()):
+                    updater.check_for_updates()  # fills the cache
+                    requests_before = server.request_count
+                    start = time.perf_counter()
+                    for _ in range(calls):
+                        updater.check_for_updates()
+                results[f"{mode}_ms"] = (time.perf_counter() - start) / calls * 1000
+                results[f"{mode}_requests"] = server.request_count - requests_before
+    finally:
+        updater.MIN_RECHECK_INTERVAL = original_interval
+    assert results["cached_no_index_requests"] == 0, "requests made within MIN_RECHECK_INTERVAL"
+    return results
+
+
+@benchmark("update_delta")
+def bench_update_delta(file_count=2000, file_size=4096, changed=10):
+    """Bytes downloaded and apply time: full archive vs. changed files only."""
+    import updater
+
+    old_files, new_files = generate_release(file_count, file_size, changed)
+    version_data = {"version": "9.9.9"}
+    routes = release_routes(new_files, version_data)
+    results = {"files": file_count, "changed": changed}
+
+    with StandInServer(routes) as server:
+        for mode in ("full", "delta"):
+            with app_workdir() as workdir:
+                write_tree(workdir, old_files)
+                point_updater_at(server)
+                if mode == "full":
+                    # Without a published manifest the updater uses the archive
+                    updater.GITHUB_MANIFEST_URL = f"{server.url}/missing"
+                server.bytes_sent = 0
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ok = updater.download_and_apply_update(version_data)
+                results[f"{mode}_s"] = time.perf_counter() - start
+                results[f"{mode}_bytes"] = server.bytes_sent
+                results[f"{mode}_ok"] = ok
+    return results
+
+
+def concurrent_update_check(server_url, locked):
+    """
+    Subprocess body for the concurrent_update benchmark: one synchronous
+    update check in the current directory against the stand-in server.
+    With locked False the update lock is bypassed, as before it existed.
+    Prints "installed" if this process installed the release, else "skipped".
+    """
+    import types
+    import update_lock
+    import updater
+
+    point_updater_at(types.SimpleNamespace(url=server_url))
+    if not locked:
+        update_lock.try_acquire = lambda path: True
+        update_lock.release = lambda path: None
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        updater.check_for_updates()
+    print("installed" if "Обновяването е завършено успешно!" in output.getvalue() else "skipped")
+
+
+@benchmark("concurrent_update")
+def bench_concurrent_update(processes=8, file_count=500, file_size=4096, changed=50, delay=0.05):
+    """
+    Several processes checking for the same update at once in one install:
+    requests made, installs performed and whether the result is intact,
+    with and without the update lock. Fails unless the locked run ends with
+    one install, no failed process and an intact result.
+    """
+    import launcher
+
+    old_files, new_files = generate_release(file_count, file_size, changed)
+    # A main.py makes the installed release count as the active app directory
+    old_files["main.py"] = new_files["main.py"] = b"# app\n"
+    routes = release_routes(new_files, {"version": "9.9.9"})
+    results = {"processes": processes}
+    for mode in ("unlocked", "locked"):
+        with app_workdir() as workdir, StandInServer(routes, delay=delay) as server:
+            write_tree(workdir, old_files)
+            write_user_data(100)
+            code = (f"import sys; sys.path.insert(0, {APP_DIR!r})\n"
+                    "import benchmark\n"
+                    f"benchmark.concurrent_update_check({server.url!r}, {mode == 'locked'})")
+            env = dict(os.environ, APP_UPDATE_INTERVAL="0",
+                       APP_OBJECT_CACHE=os.path.join(workdir, ".object_cache"))
+            start = time.perf_counter()
+            children = [subprocess.Popen([sys.executable, "-c", code], cwd=workdir, env=env,
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                        for _ in range(processes)]
+            outputs = [child.communicate() for child in children]
+            results[f"{mode}_s"] = time.perf_counter() - start
+            results[f"{mode}_requests"] = server.request_count
+            results[f"{mode}_bytes"] = server.bytes_sent
+            results[f"{mode}_installs"] = sum(out.split()[-1:] == [b"installed"] for out, _ in outputs)
+            results[f"{mode}_failed_processes"] = sum(child.returncode != 0 for child in children)
+
+            # Intact: the new release is active, complete, and user data survived
+            release_dir = launcher.resolve_release_dir()
+            intact = release_dir is not None and launcher.read_version_data(release_dir).get("version") == "9.9.9"
+            for path, content in new_files.items():
+                if not intact:
+                    break
+                try:
+                    with open(os.path.join(release_dir, *path.split('/')), 'rb') as f:
+                        intact = f.read() == content
+                except OSError:
+                    intact = False
+            intact = intact and len(os.listdir("user_data")) == 100 and not os.path.exists("update.lock")
+            results[f"{mode}_intact"] = intact
+
+    # The lock must let exactly one process install, with no failures
+    assert results["locked_installs"] == 1, f"{results['locked_installs']} installs with the lock"
+    assert results["locked_failed_processes"] == 0, \
+        f"{results['locked_failed_processes']} processes failed with the lock"
+    assert results["locked_intact"], "install not intact with the lock"
+    return results
+
+
+@benchmark("object_cache")
+def bench_object_cache(instances=5, file_count=1000, file_size=4096, changed=10):
+    """Installs and updates of several instances: per-install vs. shared object cache."""
+    import install
+    import object_cache
+    import updater
+
+    old_files, new_files = generate_release(file_count, file_size, changed)
+    old_routes = release_routes(old_files, {"version": "1.0.0"})
+    new_routes = release_routes(new_files, {"version": "9.9.9"})
+    for routes in (old_routes, new_routes):
+        routes["/raw/version.json"] = routes["/version.json"]
+    results = {"instances": instances, "files": file_count, "changed": changed}
+
+    for mode in ("per_install", "shared"):
+        root = tempfile.mkdtemp(prefix="app_bench_cache_")
+        shared_cache = os.path.join(root, "shared_cache")
+        install_dirs = [os.path.join(root, f"app{i}") for i in range(instances)]
+        original_install_cache = install.OBJECT_CACHE_DIR
+        try:
+            with StandInServer(old_routes) as server:
+                install.GITHUB_RAW_URL = f"{server.url}/raw"
+                start = time.perf_counter()
+                for install_dir in install_dirs:
+                    install.OBJECT_CACHE_DIR = shared_cache if mode == "shared" \
+                        else os.path.join(install_dir + "_cache")
+                    os.makedirs(install_dir)
+                    install.install_from_manifest(install_dir)
+                results[f"{mode}_install_s"] = time.perf_counter() - start
+                results[f"{mode}_install_bytes"] = server.bytes_sent
+
+            with StandInServer(new_routes) as server:
+                start = time.perf_counter()
+                for install_dir in install_dirs:
+                    cache_dir = shared_cache if mode == "shared" else install_dir + "_cache"
+                    with app_workdir(cache_dir):
+                        point_updater_at(server)
+                        os.chdir(install_dir)
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            updater.download_and_apply_update({"version": "9.9.9"})
+                results[f"{mode}_update_s"] = time.perf_counter() - start
+                results[f"{mode}_update_bytes"] = server.bytes_sent
+
+            caches = [shared_cache] if mode == "shared" else [d + "_cache" for d in install_dirs]
+            results[f"{mode}_disk_bytes"] = disk_usage(*install_dirs, *caches)
+
+            # Once the installs are gone every blob is unused and evictable
+            for install_dir in install_dirs:
+                shutil.rmtree(install_dir)
+            object_cache.OBJECT_CACHE_DIR = caches[0]
+            results[f"{mode}_evicted"] = object_cache.evict(budget=0)[0]
+        finally:
+            install.OBJECT_CACHE_DIR = original_install_cache
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+@benchmark("install")
+def bench_install(file_count=500, file_size=4096, history=30, dev_size=2 * 1024**2):
+    """
+    Fresh install: git clone + cleanup vs. runtime files from the archive.
+    Both installs must pass verification against a manifest that, like
+    those of older releases, also lists the development files.
+    """
+    import install
+    import updater
+
+    runtime_files, _ = generate_release(file_count, file_size)
+    dev_files = {"README.md": os.urandom(dev_size // 2).hex().encode('ascii')[:dev_size],
+                 "benchmark.py": b"# benchmarks\n" * 1000}
+    results = {"files": file_count, "history_commits": history}
+
+    root = tempfile.mkdtemp(prefix="app_bench_install_")
+    try:
+        # A production repository with some history, served by path to git
+        # and as a GitHub-style archive over HTTP
+        repo = os.path.join(root, "repo")
+        git = ["git", "-c", "user.name=bench", "-c", "user.email=bench@example.invalid"]
+        subprocess.run(git + ["init", "-q", "-b", "production", repo], check=True)
+        for commit in range(history):
+            files = dict(runtime_files)
+            files.update(dev_files)
+            files["main.py"] = f"# release {commit}\n".encode('utf-8') * 200
+            files["README.md"] = os.urandom(dev_size // 2).hex().encode('ascii')
+            files[updater.MANIFEST_FILE] = json.dumps({"version": "1.0.0", "files": {
+                path: {"sha256": hashlib.sha256(content).hexdigest(), "size": len(content)}
+                for path, content in files.items()}}).encode('utf-8')
+            write_tree(repo, files)
+            subprocess.run(git + ["-C", repo, "add", "-A"], check=True)
+            subprocess.run(git + ["-C", repo, "commit", "-q", "-m", f"release {commit}"], check=True)
+
+        archive = io.BytesIO()
+        prefix = "repo-production/"
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for path, content in files.items():
+                zf.writestr(prefix + path, content)
+            zf.writestr(prefix + "version.json", b'{"version": "1.0.0"}')
+
+        original_repo, original_zip = install.GITHUB_REPO, install.GITHUB_ZIP_URL
+        with StandInServer({"/archive.zip": archive.getvalue()}) as server:
+            install.GITHUB_REPO = f"file://{repo}"
+            install.GITHUB_ZIP_URL = f"{server.url}/archive.zip"
+            try:
+                for method in ("clone", "archive"):
+                    target = os.path.join(root, f"app_{method}")
+                    start = time.perf_counter()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        _, transferred = install.install_app(target, method)
+                    results[f"{method}_s"] = time.perf_counter() - start
+                    results[f"{method}_bytes"] = transferred
+                    results[f"{method}_installed_files"] = sum(len(f) for _, _, f in os.walk(target))
+                    bad = updater.verify_release_files(target, workers=1)
+                    results[f"{method}_verify_problems"] = len(bad)
+                    assert not bad, f"fresh {method} install fails verification: {sorted(bad)}"
+            finally:
+                install.GITHUB_REPO, install.GITHUB_ZIP_URL = original_repo, original_zip
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+@benchmark("update_apply")
+def bench_update_apply(file_count=5000, file_size=2048):
+    """I/O bytes and wall time: extract-and-copy vs. streaming archive apply."""
+    import updater
+
+    _, files = generate_release(file_count, file_size)
+    results = {"files": file_count, "file_size": file_size}
+
+    with StandInServer(release_routes(files, {"version": "9.9.9"})) as server:
+        modes = (("legacy", lambda: legacy_full_update()),
+                 ("streaming", lambda: updater.apply_full_update()))
+        for mode, apply in modes:
+            # "fresh" installs over an empty directory, "reapply" over an identical tree
+            for case in ("fresh", "reapply"):
+                with app_workdir() as workdir:
+                    if case == "reapply":
+                        write_tree(workdir, files)
+                    point_updater_at(server)
+                    read_before, written_before = io_counters()
+                    start = time.perf_counter()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        apply()
+                    results[f"{mode}_{case}_s"] = time.perf_counter() - start
+                    read_after, written_after = io_counters()
+                    results[f"{mode}_{case}_bytes_read"] = read_after - read_before
+                    results[f"{mode}_{case}_bytes_written"] = written_after - written_before
+    return results
+
+
+@benchmark("download")
+def bench_download(size=32 * 1024**2, delay=0.05, fail_rate=0.2, rate=16 * 1024**2):
+    """Single stream vs. parallel ranges; resuming after injected failures."""
+    import downloader
+    from urllib.request import urlopen
+
+    body = os.urandom(size)
+    sha256 = hashlib.sha256(body).hexdigest()
+    routes = {"/archive.zip": body}
+    results = {"size": size, "server_delay_s": delay, "per_connection_rate": rate}
+    with app_workdir():
+        with StandInServer(routes, delay=delay, rate=rate) as server:
+            start = time.perf_counter()
+            with urlopen(f"{server.url}/archive.zip") as response, open("stream.zip", 'wb') as f:
+                shutil.copyfileobj(response, f, 1024 * 1024)
+            results["single_stream_s"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            downloader.download_file(f"{server.url}/archive.zip", "ranged.zip", size, sha256)
+            results["ranged_s"] = time.perf_counter() - start
+            results["ranged_requests"] = server.request_count - 1
+
+        with StandInServer(routes, delay=delay, fail_rate=fail_rate, rate=rate) as server:
+            # Without retries the first attempt stops at the first cut-off response
+            try:
+                downloader.download_file(f"{server.url}/archive.zip", "resumed.zip", size, sha256, retries=0)
+                results["first_attempt"] = "completed"
+            except (OSError, http.client.HTTPException):
+                results["first_attempt"] = "interrupted"
+            stats = downloader.download_file(f"{server.url}/archive.zip", "resumed.zip", size, sha256)
+            results["resume_reused_bytes"] = stats["reused"]
+            results["resume_downloaded_bytes"] = stats["downloaded"]
+            results["injected_failures"] = server.failed_count
+
+        with open("resumed.zip", 'rb') as f:
+            results["resumed_file_ok"] = hashlib.sha256(f.read()).hexdigest() == sha256
+
+        with StandInServer(routes) as server:
+            try:
+                downloader.download_file(f"{server.url}/archive.zip", "bad.zip", size, "0" * 64)
+                results["bad_hash_rejected"] = False
+            except ValueError:
+                results["bad_hash_rejected"] = not os.path.exists("bad.zip.part")
+    return results
+
+
+@benchmark("verify")
+def bench_verify(file_count=5000, file_size=16384, damaged=10):
+    """
+    Checking an install against its manifest: cold (one process vs. a pool),
+    warm with nothing changed (hash cache), and finding and repairing
+    damaged files from the network and from the object cache.
+    """
+    import integrity
+    import updater
+
+    files, _ = generate_release(file_count, file_size)
+    manifest = {"version": "9.9.9", "files": {
+        path: {"sha256": hashlib.sha256(content).hexdigest(), "size": len(content)}
+        for path, content in files.items()}}
+    expected = updater.release_files(manifest)
+    damaged_paths = sorted(files)[:damaged]
+    results = {"files": file_count, "cpu_count": os.cpu_count()}
+    with app_workdir() as workdir, \
+            StandInServer({f"/raw/{path}": content for path, content in files.items()}) as server:
+        app_dir = os.path.join(workdir, "app")
+        write_tree(app_dir, files)
+        time.sleep(2.1)  # let the file mtimes leave the hash cache's racy window
+        cache_path = os.path.join(app_dir, integrity.HASH_CACHE_FILE)
+
+        for label, workers in (("serial", 1), ("parallel", None)):
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+            start = time.perf_counter()
+            bad, _ = integrity.check_files(app_dir, expected, workers)
+            results[f"cold_{label}_s"] = time.perf_counter() - start
+            assert not bad
+
+        start = time.perf_counter()
+        bad, stats = integrity.check_files(app_dir, expected)
+        results["warm_s"] = time.perf_counter() - start
+        results["warm_hashed"] = stats["hashed"]
+
+        for source in ("network", "object_cache"):
+            # Replaced, not written in place: the repaired files are links to cached blobs
+            for path in damaged_paths:
+                local_path = os.path.join(app_dir, *path.split('/'))
+                with open(f"{local_path}.tmp", 'wb') as f:
+                    f.write(b"#damaged#" + files[path][9:])
+                os.replace(f"{local_path}.tmp", local_path)
+            start = time.perf_counter()
+            bad, _ = integrity.check_files(app_dir, expected)
+            results[f"detect_{source}_s"] = time.perf_counter() - start
+            assert sorted(bad) == damaged_paths
+
+            requests_before = server.request_count
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                failed = updater.repair_release_files(app_dir, manifest, sorted(bad), f"{server.url}/raw")
+            results[f"repair_{source}_s"] = time.perf_counter() - start
+            results[f"repair_{source}_requests"] = server.request_count - requests_before
+            assert not failed and not integrity.check_files(app_dir, expected)[0]
+    return results
+
+
+@benchmark("backup")
+def bench_backup(sizes=(1000, 10000, 100000)):
+    """backup_user_data() and restore_user_data() (hard-link snapshots) vs. full copies."""
+    import updater
+
+    results = {}
+    for count in sizes:
+        with app_workdir():
+            write_user_data(count)
+            steps = (("copy", legacy_backup_and_restore),
+                     ("backup", updater.backup_user_data),
+                     ("restore", lambda: updater.restore_user_data(snapshot)))
+            snapshot = None
+            for step, run in steps:
+                read_before, written_before = io_counters()
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    returned = run()
+                results[f"{step}_{count}_s"] = time.perf_counter() - start
+                read_after, written_after = io_counters()
+                results[f"{step}_{count}_bytes_written"] = written_after - written_before
+                if step == "backup":
+                    snapshot = returned
+    return results
+
+
+@benchmark("listing")
+def bench_listing(sizes=(1000, 10000, 100000)):
+    """list_json_files(): glob per call vs. catalog (cold build and warm), and one picker page."""
+    import glob
+    import utils
+
+    results = {}
+    for count in sizes:
+        with app_workdir():
+            write_user_data(count, size=64)
+            time.sleep(2.1)  # let the directory mtime leave the catalog's racy window
+
+            start = time.perf_counter()
+            [os.path.basename(f) for f in glob.glob(os.path.join(utils.DATA_DIR, "*.json"))]
+            results[f"glob_{count}_s"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            utils.list_json_files()
+            results[f"catalog_cold_{count}_s"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            names = utils.list_json_files()
+            results[f"catalog_warm_{count}_s"] = time.perf_counter() - start
+            assert len(names) == count
+
+            start = time.perf_counter()
+            utils.get_files_page(page=count // utils.PAGE_SIZE // 2)
+            results[f"picker_page_{count}_s"] = time.perf_counter() - start
+    return results
+
+
+@benchmark("read")
+def bench_read(sizes=(1000, 10000, 100000), calls=200, seed=0):
+    """Throughput of list_json_files() and read_json_file() (pick a page, open, show)."""
+    import utils
+
+    results = {}
+    chooser = random.Random(seed)
+    for count in sizes:
+        with app_workdir():
+            write_user_data(count)
+            time.sleep(2.1)  # let the directory mtime leave the catalog's racy window
+            utils.list_json_files()
+
+            start = time.perf_counter()
+            for _ in range(calls):
+                utils.list_json_files()
+            results[f"list_{count}_per_s"] = calls / (time.perf_counter() - start)
+
+            # Each read jumps to the page of a random file, picks it and declines the meta-info
+            answers = []
+            for _ in range(calls):
+                index = chooser.randrange(count)
+                answers += [f"g{index // utils.PAGE_SIZE + 1}", str(index % utils.PAGE_SIZE + 1), "n"]
+            start = time.perf_counter()
+            with scripted_input(answers):
+                for _ in range(calls):
+                    utils.read_json_file()
+            results[f"read_{count}_per_s"] = calls / (time.perf_counter() - start)
+    return results
+
+
+@benchmark("large_read")
+def bench_large_read(size=1024**3, json_load_size=100 * 1024**2, max_rss_share=0.0625):
+    """
+    Peak RSS reading a huge record: streaming reader vs. json.load (on a
+    smaller file). Fails when streaming grows the peak RSS of a bare
+    interpreter by more than max_rss_share of the file size, as loading
+    the whole file would.
+    """
+    if sys.platform == "win32":
+        return {"skipped": "needs the resource module"}
+
+    stream_code = (
+        "import json_stream\n"
+        "with json_stream.LargeRecord(PATH) as r:\n"
+        "    meta = r.fields\n"
+        "    total = sum(len(chunk) for chunk in r.iter_string('content', 4096))\n")
+    load_code = "import json\nwith open(PATH, encoding='utf-8') as f:\n    json.load(f)\n"
+
+    results = {"size": size, "json_load_size": json_load_size,
+               "baseline_peak_rss": peak_rss_of("import json_stream")}
+    with app_workdir() as workdir:
+        path = os.path.join(workdir, "large.json")
+        for label, file_size, code in (("json_load", json_load_size, load_code),
+                                       ("streaming", json_load_size, stream_code),
+                                       ("streaming_full", size, stream_code)):
+            write_large_record(path, file_size)
+            start = time.perf_counter()
+            results[f"{label}_peak_rss"] = peak_rss_of(f"PATH = {path!r}\n{code}")
+            results[f"{label}_s"] = time.perf_counter() - start
+            if label != "json_load":
+                limit = results["baseline_peak_rss"] + int(file_size * max_rss_share)
+                assert results[f"{label}_peak_rss"] <= limit, \
+                    f"{label} peak RSS {results[f'{label}_peak_rss']} exceeds {limit} for a {file_size}-byte file"
+    return results
+
+
+@benchmark("json_write")
+def bench_json_write(single_runs=200, batch_size=2000):
+    """Write latency and batch throughput: plain open('w') vs. atomic fsync+replace."""
+    import utils
+
+    record = {"content": "x" * 512, "created_at": "bench", "version": "1.0"}
+
+    def plain_write(filepath, data):
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+
+    results = {"single_runs": single_runs, "batch_size": batch_size}
+    with app_workdir():
+        os.makedirs(utils.DATA_DIR)
+        singles = (("plain", plain_write),
+                   ("atomic", utils.write_json_atomic),
+                   ("atomic_keep_previous", lambda p, d: utils.write_json_atomic(p, d, keep_previous=True)))
+        for label, write in singles:
+            path = os.path.join(utils.DATA_DIR, f"single_{label}.json")
+            start = time.perf_counter()
+            for _ in range(single_runs):
+                write(path, record)
+            results[f"{label}_single_ms"] = (time.perf_counter() - start) / single_runs * 1000
+
+        batches = (("plain", lambda items: [plain_write(os.path.join(utils.DATA_DIR, n), d) for n, d in items]),
+                   ("atomic_per_file", lambda items: [utils.write_json_atomic(os.path.join(utils.DATA_DIR, n), d)
+                                                      for n, d in items]),
+                   ("atomic_batch", utils.write_json_batch))
+        for label, write_all in batches:
+            items = [(f"{label}_{i}.json", record) for i in range(batch_size)]
+            start = time.perf_counter()
+            write_all(items)
+            results[f"{label}_records_per_s"] = batch_size / (time.perf_counter() - start)
+    return results
+
+
+@benchmark("batch_cli")
+def bench_batch_cli(record_count=20000):
+    """Records/sec of the NDJSON import (thread pool) and export paths."""
+    import utils
+
+    lines = (json.dumps({"name": f"record_{i}", "content": f"batch {i}"}) for i in range(record_count))
+    results = {"records": record_count}
+    with app_workdir():
+        start = time.perf_counter()
+        imported, _ = utils.import_records(lines)
+        results["import_records_per_s"] = imported / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        exported, _ = utils.export_records(io.StringIO())
+        results["export_records_per_s"] = exported / (time.perf_counter() - start)
+    return results
+
+
+
+@benchmark("storage")
+def bench_storage(record_count=20000, reads=2000, seed=0):
+    """
+    The two storage backends on the same records: import, export, listing
+    and random reads, disk use; compaction after overwriting every record
+    of the segment store; and migrating a file directory to segments.
+    """
+    import storage
+    import utils
+
+    lines = [json.dumps({"name": f"record_{i}", "content": f"storage benchmark record {i} " * 8})
+             for i in range(record_count)]
+    chooser = random.Random(seed)
+    picks = [f"record_{chooser.randrange(record_count)}.json" for _ in range(reads)]
+    results = {"records": record_count, "compression": storage.compression_codec()}
+    for backend in storage.STORAGE_BACKENDS:
+        os.environ[storage.STORAGE_ENV] = backend
+        with app_workdir():
+            start = time.perf_counter()
+            utils.import_records(lines)
+            results[f"{backend}_import_per_s"] = record_count / (time.perf_counter() - start)
+            results[f"{backend}_disk_bytes"] = disk_usage(utils.DATA_DIR)
+            results[f"{backend}_files"] = sum(len(names) for _, _, names in os.walk(utils.DATA_DIR))
+
+            start = time.perf_counter()
+            utils.export_records(io.StringIO())
+            results[f"{backend}_export_per_s"] = record_count / (time.perf_counter() - start)
+
+            utils.list_json_files()
+            start = time.perf_counter()
+            utils.list_json_files()
+            results[f"{backend}_list_s"] = time.perf_counter() - start
+
+            with storage.open_store(utils.DATA_DIR) as store:
+                start = time.perf_counter()
+                for name in picks:
+                    store.read(name)
+                results[f"{backend}_read_per_s"] = reads / (time.perf_counter() - start)
+
+                if backend == "segments":
+                    utils.import_records(lines)  # every record overwritten: half the bytes dead
+                    before = disk_usage(utils.DATA_DIR)
+                    start = time.perf_counter()
+                    store.compact(min_bytes=0)
+                    results["compaction_s"] = time.perf_counter() - start
+                    results["compaction_reclaimed"] = before - disk_usage(utils.DATA_DIR)
+    del os.environ[storage.STORAGE_ENV]
+
+    with app_workdir():
+        utils.import_records(lines)
+        start = time.perf_counter()
+        storage.migrate(utils.DATA_DIR, "segments")
+        results["migrate_to_segments_s"] = time.perf_counter() - start
+        with storage.open_store(utils.DATA_DIR) as store:
+            assert len(store.list_names()) == record_count
+    return results
+
+
+def search_text(chooser, words, count=20):
+    """
+    Text of one synthetic record for the search benchmark: count rare words
+    (a word of the list with a number) and common ones ("the" in 90% of the
+    records, "and" in 60%, "of" in 40%).
+    """
+    text = [chooser.choice(words) + str(chooser.randrange(1000)) for _ in range(count)]
+    text += [word for word, share in (("the", 0.9), ("and", 0.6), ("of", 0.4)) if chooser.random() < share]
+    return " ".join(text)
+
+
+def time_queries(conn, picks, results, key):
+    """Record the mean search() latency over picks (a list of queries) in ms."""
+    import search_index
+
+    start = time.perf_counter()
+    for query in picks:
+        search_index.search(conn, query)
+    results[key] = (time.perf_counter() - start) / len(picks) * 1000
+
+
+def time_query_kinds(conn, chooser, words, queries, results, count):
+    """Time rare word pairs, a rare word, common words and prefixes on an index of count records."""
+    pairs = [f"{chooser.choice(words)}{chooser.randrange(1000)} {chooser.choice(words)}" for _ in range(queries)]
+    rare = [f"{chooser.choice(words)}{chooser.randrange(100, 1000)}" for _ in range(queries)]
+    time_queries(conn, pairs, results, f"query_{count}_ms")
+    time_queries(conn, rare, results, f"rare_query_{count}_ms")
+    time_queries(conn, ["alpha1"] * queries, results, f"prefix_query_{count}_ms")
+    time_queries(conn, ["the"] * queries, results, f"common_query_{count}_ms")
+    time_queries(conn, ["the and"] * queries, results, f"common_pair_query_{count}_ms")
+    time_queries(conn, ["of alpha1"] * queries, results, f"common_prefix_query_{count}_ms")
+
+
+@benchmark("search")
+def bench_search(sizes=(10000, 100000), index_sizes=(1000000,), queries=200, seed=0):
+    """
+    Full-text index: rebuild in one process vs. a process pool, query
+    latency for rare and common words and prefixes, a no-op sync, and
+    indexing one newly created record. Also checks that a truncated prefix
+    still matches the exact word. index_sizes time the queries only, on an
+    index filled directly, without writing the records.
+    """
+    import search_index
+    import storage
+    import utils
+
+    words = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel",
+             "india", "juliett", "kilo", "lima", "mike", "november", "oscar", "papa"]
+    results = {"cpu_count": os.cpu_count()}
+    for count in sizes:
+        chooser = random.Random(seed)
+        lines = (json.dumps({"name": f"record_{i}", "content": search_text(chooser, words)})
+                 for i in range(count))
+        with app_workdir():
+            utils.import_records(lines)
+            with storage.open_store(utils.DATA_DIR) as store:
+                conn = search_index.open_index(utils.DATA_DIR)
+                try:
+                    for label, workers in (("serial", 1), ("parallel", None)):
+                        with conn:
+                            for table in ("docs", "postings", "terms", "state"):
+                                conn.execute(f"DELETE FROM {table}")
+                        start = time.perf_counter()
+                        search_index.sync(conn, store, force=True, workers=workers)
+                        results[f"rebuild_{label}_{count}_s"] = time.perf_counter() - start
+
+                    time_query_kinds(conn, chooser, words, queries, results, count)
+                    # More words start with "alpha1" than a prefix expands to: the
+                    # truncation is reported and the exact word is still searched
+                    names, _, truncated = search_index.search(conn, "alpha1", limit=count)
+                    exact = {name for (name,) in conn.execute(
+                        "SELECT name FROM docs JOIN postings ON doc = id WHERE term = 'alpha1'")}
+                    assert truncated == "alpha1" and exact <= set(names)
+
+                    time.sleep(2.1)  # let the store version leave the racy window
+                    search_index.sync(conn, store)
+                    start = time.perf_counter()
+                    search_index.sync(conn, store)
+                    results[f"sync_noop_{count}_ms"] = (time.perf_counter() - start) * 1000
+
+                    version_before = store.version()
+                    start = time.perf_counter()
+                    store.write("new_record.json", utils.build_record("zulu yankee"))
+                    search_index.record_change(store, "new_record.json", version_before)
+                    results[f"create_indexed_{count}_ms"] = (time.perf_counter() - start) * 1000
+                    assert search_index.search(conn, "yankee")[0] == ["new_record.json"]
+                finally:
+                    conn.close()
+
+    for count in index_sizes:
+        chooser = random.Random(seed)
+        with app_workdir():
+            conn = search_index.open_index(utils.DATA_DIR)
+            try:
+                start = time.perf_counter()
+                for batch_start in range(0, count, 10000):
+                    with conn:
+                        search_index._apply(conn, [
+                            (f"record_{i}.json", "0", sorted(set(search_text(chooser, words).split())))
+                            for i in range(batch_start, min(batch_start + 10000, count))])
+                results[f"fill_{count}_s"] = time.perf_counter() - start
+                time_query_kinds(conn, chooser, words, queries, results, count)
+                names, total, _ = search_index.search(conn, "the and")
+                assert len(names) == 20 and total == search_index.COUNT_LIMIT + 1
+            finally:
+                conn.close()
+    return results
+
+
+def traced_update_check(file_count, file_size, user_files):
+    """
+    Subprocess body for the trace benchmark: one synchronous update check
+    that finds and applies a new release, with APP_TRACE set by the caller.
+    """
+    import updater
+
+    _, files = generate_release(file_count, file_size)
+    with app_workdir(), StandInServer(release_routes(files, {"version": "9.9.9"})) as server:
+        point_updater_at(server)
+        # No manifest: the archive path, with download and extract phases
+        updater.GITHUB_MANIFEST_URL = f"{server.url}/missing"
+        write_user_data(user_files)
+        with contextlib.redirect_stdout(io.StringIO()):
+            updater.check_for_updates()
+
+
+@benchmark("trace")
+def bench_trace(span_calls=200000, file_count=2000, file_size=2048, user_files=1000):
+    """Cost of a span with tracing off and on; the phases of one traced update."""
+    results = {}
+    for mode, env_value in (("off", ""), ("on", os.devnull)):
+        code = (f"import sys, time; sys.path.insert(0, {APP_DIR!r})\n"
+                "import instrumentation\n"
+                "start = time.perf_counter_ns()\n"
+                f"for _ in range({span_calls}):\n"
+                "    with instrumentation.span('bench'):\n"
+                "        instrumentation.add('n')\n"
+                f"print((time.perf_counter_ns() - start) / {span_calls})")
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                env=dict(os.environ, APP_TRACE=env_value)).stdout
+        results[f"span_{mode}_ns"] = float(output.split()[-1])
+
+    trace_fd, trace_path = tempfile.mkstemp(prefix="app_bench_trace_", suffix=".jsonl")
+    os.close(trace_fd)
+    try:
+        code = (f"import sys; sys.path.insert(0, {APP_DIR!r})\n"
+                "import benchmark\n"
+                f"benchmark.traced_update_check({file_count}, {file_size}, {user_files})")
+        subprocess.run([sys.executable, "-c", code], check=True,
+                       env=dict(os.environ, APP_TRACE=trace_path, APP_UPDATE_INTERVAL="0"))
+        with open(trace_path, 'r', encoding='utf-8') as f:
+            trace = json.loads(f.readline())
+    finally:
+        os.remove(trace_path)
+    phases = {}
+    for record in trace["spans"]:
+        phases[record["name"]] = phases.get(record["name"], 0) + record["duration_ms"]
+    results["phases_ms"] = {name: round(duration, 1) for name, duration in phases.items()}
+    results["totals"] = trace["totals"]
+    return results
+
+
+def parse_param(text):
+    """Parse a --param name=value argument; the value is JSON if it parses as JSON."""
+    name, sep, value = text.partition("=")
+    if not sep or not name:
+        raise argparse.ArgumentTypeError(f"expected name=value, got '{text}'")
+    try:
+        value = json.loads(value)
+    except json.JSONDecodeError:
+        pass
+    if isinstance(value, list):
+        value = tuple(value)
+    return name, value
+
+
+def run_benchmarks(names, params):
+    """
+    Run the named benchmarks, passing each the params its function accepts.
+    Returns the results document: {"meta": {...}, "results": {name: {...}}}.
+    """
+    document = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.time(),
+            "params": {name: list(value) if isinstance(value, tuple) else value
+                       for name, value in params.items()},
+        },
+        "results": {},
+    }
+    for name in names:
+        func = BENCHMARKS[name]
+        accepted = inspect.signature(func).parameters
+        result = func(**{key: value for key, value in params.items() if key in accepted})
+        document["results"][name] = result
+        print(f"{name}: {json.dumps(result)}")
+    return document
+
+
+def flatten(result, prefix=""):
+    """Yield (dotted_name, value) for the numeric metrics of a result."""
+    for key, value in result.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+
+def metric_direction(name):
+    """Return 1 if higher is better, -1 if lower is better, 0 if not compared."""
+    if name.endswith(HIGHER_IS_BETTER):
+        return 1
+    if name.endswith(LOWER_IS_BETTER) or name.startswith("phases_ms."):
+        return -1
+    return 0
+
+
+def compare_results(document, baseline, tolerance):
+    """
+    Compare a results document with a baseline document. Returns a list of
+    (benchmark, metric, baseline_value, value, change) for the metrics that
+    got worse by more than tolerance (a fraction).
+    """
+    regressions = []
+    for name, result in document["results"].items():
+        base_metrics = dict(flatten(baseline.get("results", {}).get(name, {})))
+        for metric, value in flatten(result):
+            direction = metric_direction(metric)
+            base_value = base_metrics.get(metric)
+            if not direction or not base_value:
+                continue
+            seconds = {"_s": 1, "_ms": 1e-3}.get(metric[metric.rfind("_"):])
+            if seconds and metric_direction(metric) < 0 \
+                    and max(value, base_value) * seconds < NOISE_FLOOR_S:
+                continue
+            change = (value - base_value) / base_value
+            allowed = 0 if metric.endswith(EXACT_METRICS) else tolerance
+            if change * direction < -allowed:
+                regressions.append((name, metric, base_value, value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the console app.")
+    parser.add_argument("names", nargs="*", metavar="benchmark",
+                        help=f"benchmarks to run (default: all): {', '.join(BENCHMARKS)}")
+    parser.add_argument("--param", action="append", type=parse_param, default=[], metavar="NAME=VALUE",
+                        help="override a benchmark parameter, e.g. file_count=20000 or sizes=[1000,10000]")
+    parser.add_argument("--json", metavar="PATH", help="write the results document to PATH")
+    parser.add_argument("--baseline", metavar="PATH", help="compare the results with an earlier document")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative slowdown before a metric counts as a regression")
+    args = parser.parse_args()
+
+    names = args.names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name} (available: {', '.join(BENCHMARKS)})")
+            sys.exit(1)
+
+    document = run_benchmarks(names, dict(args.param))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(document, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get("meta", {}).get("params") != document["meta"]["params"]:
+            print("Note: the baseline was run with different --param values")
+        regressions = compare_results(document, baseline, args.tolerance)
+        for name, metric, base_value, value, change in regressions:
+            print(f"REGRESSION {name}.{metric}: {base_value:.6g} -> {value:.6g} ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
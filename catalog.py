@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Persistent catalog of the JSON files in the user data directory.
+Records each file's name, size, mtime and meta fields (everything except
+"content") in a small SQLite database, so listing files and showing meta
+information do not open the JSON bodies. The catalog is refreshed
+incrementally: only files whose size or mtime changed are parsed again, and
+the directory is not rescanned at all while its own mtime is unchanged.
+"""
+
+import json
+import os
+import time
+
+import json_stream
+
+try:
+    import sqlite3
+except ImportError:  # Python built without sqlite3: callers fall back to scanning
+    sqlite3 = None
+
+# False when the catalog cannot be used on this Python build
+AVAILABLE = sqlite3 is not None
+
+# Suffix of the catalog database, kept next to the data directory
+# (user_data -> user_data.catalog.sqlite). Inside it, every catalog write
+# would change the directory mtime the refresh relies on.
+CATALOG_SUFFIX = ".catalog.sqlite"
+
+# A directory mtime this close to the last scan may hide a later change made
+# within the same timestamp tick, so it is not trusted (as git does for its index)
+RACY_WINDOW_NS = 2 * 10**9
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    meta TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def open_catalog(data_dir):
+    """
+    Open (and create if needed) the catalog of data_dir.
+    """
+    conn = sqlite3.connect(os.path.normpath(data_dir) + CATALOG_SUFFIX, timeout=30)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def read_meta(path):
+    """
+    Return the meta fields of a JSON record (all keys except "content"),
+    or None if the file is not a valid JSON object. Large files are
+    scanned without decoding their content.
+    """
+    try:
+        if os.path.getsize(path) > json_stream.LARGE_FILE_THRESHOLD:
+            return json_stream.read_meta(path)
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    return {k: v for k, v in data.items() if k != "content"}
+
+
+def _get_state(conn, key):
+    row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_state(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+
+def _store(conn, data_dir, name, stat_result):
+    meta = read_meta(os.path.join(data_dir, name))
+    conn.execute(
+        "INSERT OR REPLACE INTO files (name, size, mtime_ns, meta) VALUES (?, ?, ?, ?)",
+        (name, stat_result.st_size, stat_result.st_mtime_ns,
+         json.dumps(meta, ensure_ascii=False) if meta is not None else "null"))
+
+
+def refresh_catalog(conn, data_dir, force=False):
+    """
+    Bring the catalog in line with data_dir. Skips the scan while the
+    directory mtime is unchanged (files were not added, removed or replaced);
+    otherwise re-reads only the files whose size or mtime changed.
+    """
+    dir_mtime_ns = os.stat(data_dir).st_mtime_ns
+    scanned_at_ns = _get_state(conn, 'scanned_at_ns') or 0
+    if not force and _get_state(conn, 'dir_mtime_ns') == dir_mtime_ns \
+            and dir_mtime_ns < scanned_at_ns - RACY_WINDOW_NS:
+        return
+
+    scan_start_ns = time.time_ns()
+    known = {name: (size, mtime_ns) for name, size, mtime_ns
+             in conn.execute("SELECT name, size, mtime_ns FROM files")}
+    with conn:
+        for entry in os.scandir(data_dir):
+            if not entry.name.endswith('.json') or not entry.is_file():
+                continue
+            stat_result = entry.stat()
+            if known.pop(entry.name, None) != (stat_result.st_size, stat_result.st_mtime_ns):
+                _store(conn, data_dir, entry.name, stat_result)
+        conn.executemany("DELETE FROM files WHERE name = ?", [(name,) for name in known])
+        _set_state(conn, 'dir_mtime_ns', dir_mtime_ns)
+        _set_state(conn, 'scanned_at_ns', scan_start_ns)
+
+
+def record_file(conn, data_dir, name):
+    """
+    Update a single entry after the app wrote or removed the file.
+    """
+    path = os.path.join(data_dir, name)
+    with conn:
+        try:
+            _store(conn, data_dir, name, os.stat(path))
+        except FileNotFoundError:
+            conn.execute("DELETE FROM files WHERE name = ?", (name,))
+
+
+def list_names(conn):
+    """
+    Return all catalogued file names, sorted.
+    """
+    return [row[0] for row in conn.execute("SELECT name FROM files ORDER BY name")]
+
+
+def name_filter(conn, query):
+    """
+    Return (where_clause, params) matching names by a search query:
+    "^text" matches a prefix, anything else a substring (case-insensitive).
+    """
+    if not query:
+        return "", ()
+    conn.create_function("name_matches", 2, name_matches, deterministic=True)
+    return " WHERE name_matches(name, ?)", (query,)
+
+
+def name_matches(name, query):
+    """
+    True if a file name matches a picker search query (see name_filter).
+    """
+    name = name.casefold()
+    if query.startswith('^'):
+        return name.startswith(query[1:].casefold())
+    return query.casefold() in name
+
+
+def count_names(conn, query=None):
+    """
+    Return the number of catalogued names matching query.
+    """
+    where, params = name_filter(conn, query)
+    return conn.execute("SELECT COUNT(*) FROM files" + where, params).fetchone()[0]
+
+
+def page_names(conn, offset, limit, query=None):
+    """
+    Return one page of the sorted names matching query.
+    """
+    where, params = name_filter(conn, query)
+    return [row[0] for row in conn.execute(
+        "SELECT name FROM files" + where + " ORDER BY name LIMIT ? OFFSET ?", params + (limit, offset))]
+
+
+def get_meta(conn, data_dir, name):
+    """
+    Return the meta fields of one file, re-reading it only if its size or
+    mtime no longer match the catalog. None for invalid JSON.
+    """
+    stat_result = os.stat(os.path.join(data_dir, name))
+    row = conn.execute("SELECT size, mtime_ns, meta FROM files WHERE name = ?", (name,)).fetchone()
+    if row is None or (row[0], row[1]) != (stat_result.st_size, stat_result.st_mtime_ns):
+        with conn:
+            _store(conn, data_dir, name, stat_result)
+        row = conn.execute("SELECT size, mtime_ns, meta FROM files WHERE name = ?", (name,)).fetchone()
+    return json.loads(row[2])
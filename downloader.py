@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+Resumable download of release archives.
+Fetches a file as fixed-size byte ranges over a small thread pool, writing
+each range in place into <dest>.part. Finished ranges are recorded in
+<dest>.part.json, so an interrupted download continues with the missing
+ranges on the next run instead of starting over. Servers without Range
+support are read as a single stream. The result is checked against the
+expected size and SHA-256 before it is moved into place.
+"""
+
+import hashlib
+import http.client
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+
+# Parallel range requests per download.
+# Override with the APP_DOWNLOAD_WORKERS environment variable.
+DOWNLOAD_WORKERS = int(os.environ.get("APP_DOWNLOAD_WORKERS", "4"))
+
+# Size of one range request; also the unit of resumable progress
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Attempts per range before the download gives up (progress is kept)
+DOWNLOAD_RETRIES = 3
+
+# Delay before the first retry of a range; doubled for each further retry
+RETRY_DELAY = 0.5
+
+HTTP_TIMEOUT = 10
+
+PART_SUFFIX = ".part"
+PROGRESS_SUFFIX = ".part.json"
+
+# Errors after which a range request is worth retrying
+_TRANSIENT_ERRORS = (URLError, OSError, http.client.HTTPException)
+
+
+def probe(url):
+    """
+    Ask for the first byte of url. Returns (size, validator) when the server
+    answers with a byte range, or (None, None) when it ignores Range.
+    The validator (ETag or Last-Modified) identifies this version of the file.
+    """
+    request = Request(url, headers={'Range': 'bytes=0-0'})
+    with urlopen(request, timeout=HTTP_TIMEOUT) as response:
+        content_range = response.headers.get('Content-Range', '')
+        if response.status != 206 or '/' not in content_range:
+            return None, None
+        total = content_range.rsplit('/', 1)[1]
+        if not total.isdigit():
+            return None, None
+        validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        return int(total), validator
+
+
+def _load_progress(progress_path, identity):
+    """
+    Return the finished chunk indices of an earlier attempt at the same
+    download (same URL, size, validator and chunking), or None.
+    """
+    try:
+        with open(progress_path, 'r', encoding='utf-8') as f:
+            progress = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if not isinstance(progress, dict) or progress.get('identity') != identity:
+        return None
+    return set(progress.get('done', []))
+
+
+def _save_progress(progress_path, identity, done):
+    temp_path = f"{progress_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({"identity": identity, "done": sorted(done)}, f)
+    os.replace(temp_path, progress_path)
+
+
+def _fetch_range(url, part_path, start, end, validator):
+    """
+    Download bytes [start, end] into the same offsets of part_path.
+    Raises ValueError if the file changed on the server.
+    """
+    headers = {'Range': f'bytes={start}-{end}'}
+    if validator:
+        headers['If-Range'] = validator
+    with urlopen(Request(url, headers=headers), timeout=HTTP_TIMEOUT) as response:
+        if response.status != 206:
+            raise ValueError("Файлът на сървъра е променен по време на изтеглянето")
+        with open(part_path, 'r+b') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                block = response.read(min(remaining, 256 * 1024))
+                if not block:
+                    raise http.client.IncompleteRead(b'', remaining)
+                f.write(block)
+                remaining -= len(block)
+
+
+def _fetch_range_with_retries(url, part_path, start, end, validator, retries):
+    delay = RETRY_DELAY
+    for attempt in range(retries + 1):
+        try:
+            _fetch_range(url, part_path, start, end, validator)
+            return
+        except ValueError:
+            raise
+        except _TRANSIENT_ERRORS:
+            if attempt == retries:
+                raise
+            time.sleep(delay)
+            delay *= 2
+
+
+def _download_ranges(url, part_path, progress_path, size, validator, expected_sha256,
+                     workers, chunk_size, retries):
+    """
+    Fetch the missing chunks of a ranged download in parallel.
+    Returns (downloaded, reused) byte counts.
+    """
+    identity = {"url": url, "size": size, "validator": validator,
+                "sha256": expected_sha256, "chunk_size": chunk_size}
+    chunk_count = (size + chunk_size - 1) // chunk_size
+
+    # Without a validator or a published hash a partial file cannot be trusted
+    done = None
+    if validator or expected_sha256:
+        done = _load_progress(progress_path, identity)
+    if done is None or not os.path.isfile(part_path) or os.path.getsize(part_path) != size:
+        done = set()
+        with open(part_path, 'wb') as f:
+            f.truncate(size)
+        _save_progress(progress_path, identity, done)
+
+    def chunk_bounds(index):
+        start = index * chunk_size
+        return start, min(start + chunk_size, size) - 1
+
+    reused = sum(chunk_bounds(i)[1] - chunk_bounds(i)[0] + 1 for i in done)
+    pending = [i for i in range(chunk_count) if i not in done]
+    first_error = None
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {executor.submit(_fetch_range_with_retries, url, part_path,
+                                   *chunk_bounds(i), validator, retries): i
+                   for i in pending}
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            error = future.exception()
+            if error is not None:
+                if first_error is None:
+                    first_error = error
+                    # Stop starting new chunks; the ones in flight finish and are kept
+                    for other in futures:
+                        other.cancel()
+                continue
+            done.add(futures[future])
+            _save_progress(progress_path, identity, done)
+
+    if isinstance(first_error, ValueError):
+        # The server has a different file now: the partial data is useless
+        for path in (part_path, progress_path):
+            if os.path.exists(path):
+                os.remove(path)
+    if first_error is not None:
+        raise first_error
+    return size - reused, reused
+
+
+def _download_stream(url, part_path):
+    """
+    Fetch the whole file in one request (no Range support).
+    Returns the number of bytes downloaded.
+    """
+    downloaded = 0
+    with urlopen(url, timeout=HTTP_TIMEOUT) as response, open(part_path, 'wb') as f:
+        for block in iter(lambda: response.read(1024 * 1024), b''):
+            f.write(block)
+            downloaded += len(block)
+    return downloaded
+
+
+def verify_file(path, expected_size=None, expected_sha256=None):
+    """
+    Raise ValueError unless the file has the expected size and SHA-256
+    (each check is skipped when its expected value is None).
+    """
+    size = os.path.getsize(path)
+    if expected_size is not None and size != expected_size:
+        raise ValueError(f"Неочакван размер на архива: {size} байта вместо {expected_size}")
+    if expected_sha256:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        if digest.hexdigest() != expected_sha256.lower():
+            raise ValueError("Контролната сума на архива не съвпада")
+
+
+def download_file(url, dest, expected_size=None, expected_sha256=None,
+                  workers=None, chunk_size=DOWNLOAD_CHUNK_SIZE, retries=DOWNLOAD_RETRIES):
+    """
+    Download url to dest, resuming an earlier interrupted attempt.
+    Returns {"size", "downloaded", "reused", "ranged"}. Network errors
+    propagate with the progress kept for the next attempt; a file that fails
+    verification is deleted and ValueError is raised.
+    """
+    if workers is None:
+        workers = DOWNLOAD_WORKERS
+    part_path = dest + PART_SUFFIX
+    progress_path = dest + PROGRESS_SUFFIX
+
+    size, validator = probe(url)
+    if size is None:
+        downloaded, reused = _download_stream(url, part_path), 0
+    else:
+        if expected_size is not None and size != expected_size:
+            raise ValueError(f"Неочакван размер на архива: {size} байта вместо {expected_size}")
+        downloaded, reused = _download_ranges(url, part_path, progress_path, size, validator,
+                                              expected_sha256, workers, chunk_size, retries)
+
+    try:
+        verify_file(part_path, expected_size, expected_sha256)
+    except ValueError:
+        for path in (part_path, progress_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    os.replace(part_path, dest)
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+    return {"size": os.path.getsize(dest), "downloaded": downloaded,
+            "reused": reused, "ranged": size is not None}
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 """
 Installation script for Python Console App
-This script clones the production version from GitHub and sets up the application.
+This script installs the production version from GitHub and sets up the application.
+When the release publishes manifest.json, files are taken from the machine-wide
+object cache (see object_cache.py) and only missing ones are downloaded;
+otherwise the runtime files are extracted from the production branch archive.
+git clone is used only when both fail (or with --method clone).
 Usage: curl -sSL https://raw.githubusercontent.com/DeyanShahov/python-console-auto-update/production/install.py | python
 """
 
@@ -13,10 +17,56 @@ import re
 import glob
 import stat
 import time
+import json
+import hashlib
+import fnmatch
+import argparse
+import tempfile
+import zipfile
+from urllib.parse import quote
+from urllib.request import urlopen
+from urllib.error import URLError
 
 GITHUB_REPO = "https://github.com/DeyanShahov/python-console-auto-update.git"
+GITHUB_RAW_URL = "https://raw.githubusercontent.com/DeyanShahov/python-console-auto-update/production"
+GITHUB_ZIP_URL = "https://github.com/DeyanShahov/python-console-auto-update/archive/refs/heads/production.zip"
 APP_DIR = "python-console-app" # Default directory name for the installed app
 
+# install.py runs on its own (piped from curl), so it carries its own copy of
+# the object cache layout from object_cache.py: objects/<sha256[:2]>/<sha256>
+OBJECT_CACHE_DIR = os.environ.get("APP_OBJECT_CACHE") or os.path.join(
+    os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME")
+    or os.path.join(os.path.expanduser("~"), ".cache"),
+    "python-console-app")
+
+MANIFEST_FILE = "manifest.json"
+VERSION_FILE = "version.json"
+
+# Downloaded archives up to this size stay in memory; larger ones spill to disk
+ARCHIVE_SPOOL_LIMIT = 32 * 1024 * 1024
+
+# Install methods tried by --method auto, in order
+INSTALL_METHODS = ('cache', 'archive', 'clone')
+
+# Files and directories that are not needed by end users
+DEVELOPMENT_FILES = [
+    '.git',
+    '.gitignore',
+    'install.py', # This install.py is the one *inside* the cloned repo, which should be removed
+    'install.ps1', # This install.ps1 is also for installation, not needed after install
+    '__pycache__',
+    'README.md',
+    'AUTO_UPDATE_WORKFLOW.md', # Development documentation, not needed for end users
+    'benchmark.py', # Development benchmarks, not needed for end users
+    'release.py', # Release tooling, not needed for end users
+    'release-index.json', # Read by installed apps from GitHub, not from disk
+    '*.pyc',
+    '*.pyo',
+    '.vscode',
+    '.idea',
+    '*.log',
+]
+
 def remove_readonly(func, path, _):
     """Clear the readonly bit and reattempt the removal on Windows."""
     try:
@@ -41,58 +91,150 @@ def run_command(command, cwd=None):
         print(f"Error: {e}")
         return False
 
-def main():
+def is_development_path(path):
     """
-    Main installation process.
+    True if a '/'-separated release path is not needed by end users.
     """
-    # Determine the directory where the app will be installed
-    install_target_dir = os.path.join(os.getcwd(), APP_DIR)
+    parts = path.split('/')
+    return any(fnmatch.fnmatch(parts[0], pattern)
+               or ('*' in pattern and fnmatch.fnmatch(parts[-1], pattern))
+               for pattern in DEVELOPMENT_FILES)
 
-    # Guard clause: Check if being run from inside the app directory
-    if os.path.exists(os.path.join(os.getcwd(), 'main.py')) and os.path.exists(os.path.join(os.getcwd(), 'updater.py')):
-        print("❌ Грешка: Този скрипт е само за инсталация.")
-        print("Изглежда, че приложението вече е инсталирано тук.")
-        print("\n🚀 За да стартирате приложението, използвайте командата:")
-        print("   python main.py")
-        sys.exit(1)
+def is_safe_path(path):
+    """
+    True if a '/'-separated release path stays inside the install directory.
+    """
+    return bool(path) and not path.startswith('/') and '..' not in path.split('/') \
+        and not os.path.splitdrive(path)[0]
 
-    print("🔄 Инсталиране на конзолното приложение...")
-    print("📥 Изтегляне на последната версия от GitHub...")
+def fetch_cached_blob(sha256, url):
+    """
+    Return (blob_path, downloaded_bytes) for a release file, downloading it
+    into the object cache only when it is not there yet.
+    """
+    blob_path = os.path.join(OBJECT_CACHE_DIR, "objects", sha256[:2], sha256)
+    if os.path.isfile(blob_path):
+        try:
+            os.utime(blob_path, (time.time(), os.stat(blob_path).st_mtime))
+        except OSError:
+            pass
+        return blob_path, 0
 
-    # Step 1: Clone the production branch
-    if os.path.exists(install_target_dir):
-        print(f"⚠️  Директорията '{install_target_dir}' вече съществува. Премахване на старата инсталация...")
-        shutil.rmtree(install_target_dir, onerror=remove_readonly)
-        time.sleep(1) # Give OS time to release file handles
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    temp_path = f"{blob_path}.{os.getpid()}.tmp"
+    digest = hashlib.sha256()
+    downloaded = 0
+    try:
+        with urlopen(url, timeout=10) as response, open(temp_path, 'wb') as f:
+            for block in iter(lambda: response.read(1024 * 1024), b''):
+                digest.update(block)
+                f.write(block)
+                downloaded += len(block)
+        if digest.hexdigest() != sha256:
+            raise ValueError(f"Hash mismatch for {url}")
+        os.replace(temp_path, blob_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return blob_path, downloaded
 
-    clone_cmd = f"git clone --branch production --single-branch {GITHUB_REPO} {APP_DIR}"
-    if not run_command(clone_cmd):
-        print("❌ Failed to clone repository from GitHub")
-        sys.exit(1)
+def install_from_manifest(target_dir):
+    """
+    Install the release files listed in the published manifest into
+    target_dir, hard-linking them from the object cache.
+    Returns the number of bytes downloaded, or None when no manifest is
+    published. Raises on download errors.
+    """
+    try:
+        with urlopen(f"{GITHUB_RAW_URL}/{MANIFEST_FILE}", timeout=10) as response:
+            manifest_body = response.read()
+        manifest = json.loads(manifest_body.decode('utf-8'))
+        files = manifest['files']
+    except (URLError, OSError, ValueError, KeyError, TypeError):
+        return None
 
-    print("✅ Приложението е изтеглено успешно")
+    downloaded = 0
+    for path, info in files.items():
+        if is_development_path(path) or not is_safe_path(path):
+            continue
+        blob_path, blob_bytes = fetch_cached_blob(info['sha256'], f"{GITHUB_RAW_URL}/{quote(path)}")
+        downloaded += blob_bytes
+        local_path = os.path.join(target_dir, *path.split('/'))
+        os.makedirs(os.path.dirname(local_path) or target_dir, exist_ok=True)
+        try:
+            os.link(blob_path, local_path)
+        except OSError:
+            shutil.copy2(blob_path, local_path)
 
-    # Step 2: Perform cleanup *before* changing directory
-    # This ensures install.py is not trying to delete files it's running from
-    print(f"🧹 Започва почистване на ненужни файлове в '{install_target_dir}'...")
-    development_files = [
-        '.git',
-        '.gitignore',
-        'install.py', # This install.py is the one *inside* the cloned repo, which should be removed
-        'install.ps1', # This install.ps1 is also for installation, not needed after install
-        '__pycache__',
-        'README.md',
-        'AUTO_UPDATE_WORKFLOW.md', # Development documentation, not needed for end users
-        '*.pyc',
-        '*.pyo',
-        '.vscode',
-        '.idea',
-        '*.log',
-    ]
+    with urlopen(f"{GITHUB_RAW_URL}/{VERSION_FILE}", timeout=10) as response:
+        version_body = response.read()
+    downloaded += len(manifest_body) + len(version_body)
+    for file_name, body in ((VERSION_FILE, version_body), (MANIFEST_FILE, manifest_body)):
+        with open(os.path.join(target_dir, file_name), 'wb') as f:
+            f.write(body)
+    return downloaded
 
+def install_from_archive(target_dir):
+    """
+    Download the production branch archive and extract only the runtime
+    files into target_dir: the files listed in the archive's manifest.json
+    (verified against their hashes), or every file outside DEVELOPMENT_FILES
+    when there is no manifest. Returns the number of bytes downloaded.
+    """
+    with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_LIMIT) as archive:
+        with urlopen(GITHUB_ZIP_URL, timeout=30) as response:
+            shutil.copyfileobj(response, archive, 1024 * 1024)
+        downloaded = archive.tell()
+
+        with zipfile.ZipFile(archive, 'r') as zip_ref:
+            # The archive has a single top-level folder like "repo-name-branch/"
+            names = zip_ref.namelist()
+            prefix = names[0].split('/', 1)[0] + '/' if names else ''
+            manifest = None
+            if prefix + MANIFEST_FILE in names:
+                manifest = json.loads(zip_ref.read(prefix + MANIFEST_FILE).decode('utf-8'))['files']
+
+            for member in zip_ref.infolist():
+                path = member.filename[len(prefix):]
+                if member.is_dir() or not member.filename.startswith(prefix) or not is_safe_path(path):
+                    continue
+                if is_development_path(path):
+                    continue
+                if manifest is not None and path not in manifest and path not in (MANIFEST_FILE, VERSION_FILE):
+                    continue
+
+                local_path = os.path.join(target_dir, *path.split('/'))
+                os.makedirs(os.path.dirname(local_path) or target_dir, exist_ok=True)
+                digest = hashlib.sha256()
+                with zip_ref.open(member) as source, open(local_path, 'wb') as destination:
+                    for block in iter(lambda: source.read(1024 * 1024), b''):
+                        digest.update(block)
+                        destination.write(block)
+                if manifest is not None and path in manifest and digest.hexdigest() != manifest[path]['sha256']:
+                    raise ValueError(f"Hash mismatch for {path}")
+    return downloaded
+
+def directory_size(path):
+    """
+    Return the total size of the files under path.
+    """
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def remove_development_files(target_dir):
+    """
+    Delete the files a git clone brings along that end users do not need.
+    Returns the list of removed paths.
+    """
     files_removed = []
-    for pattern in development_files:
-        full_pattern_path = os.path.join(install_target_dir, pattern)
+    for pattern in DEVELOPMENT_FILES:
+        full_pattern_path = os.path.join(target_dir, pattern)
         if '*' in pattern:  # Handle wildcard patterns
             matches = glob.glob(full_pattern_path)
             for match in matches:
@@ -115,13 +257,99 @@ def main():
                     files_removed.append(full_pattern_path)
                 except Exception as e:
                     print(f"⚠️ Не може да премахне '{full_pattern_path}': {e}")
+    return files_removed
 
+def install_by_clone(target_dir):
+    """
+    Clone the production branch into target_dir and remove the development
+    files afterwards. Returns the approximate number of bytes transferred
+    (the size of the cloned .git directory), or None if the clone failed.
+    """
+    clone_cmd = f'git clone --branch production --single-branch {GITHUB_REPO} "{target_dir}"'
+    if not run_command(clone_cmd):
+        print("❌ Failed to clone repository from GitHub")
+        return None
+    transferred = directory_size(os.path.join(target_dir, '.git'))
+
+    # Cleanup happens *before* changing directory, so install.py is not
+    # trying to delete files it's running from
+    print(f"🧹 Започва почистване на ненужни файлове в '{target_dir}'...")
+    files_removed = remove_development_files(target_dir)
     if files_removed:
         print(f"🧹 Почистване завършено: премахнати {len(files_removed)} елемента.")
     else:
         print("🧹 Няма ненужни файлове за почистване.")
+    return transferred
+
+def install_app(target_dir, method='auto'):
+    """
+    Install the production files into target_dir with the given method
+    ('cache', 'archive' or 'clone'); 'auto' tries them in that order.
+    Returns (method_used, bytes_transferred), or None if every method failed.
+    """
+    methods = INSTALL_METHODS if method == 'auto' else (method,)
+    for current in methods:
+        if os.path.exists(target_dir):
+            shutil.rmtree(target_dir, onerror=remove_readonly)
+        try:
+            if current == 'clone':
+                transferred = install_by_clone(target_dir)
+            else:
+                os.makedirs(target_dir)
+                if current == 'cache':
+                    transferred = install_from_manifest(target_dir)
+                else:
+                    transferred = install_from_archive(target_dir)
+        except (URLError, OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            print(f"⚠️  Методът '{current}' не успя: {e}")
+            transferred = None
+        if transferred is not None:
+            return current, transferred
+    if os.path.exists(target_dir):
+        shutil.rmtree(target_dir, onerror=remove_readonly)
+    return None
+
+def main():
+    """
+    Main installation process.
+    """
+    parser = argparse.ArgumentParser(description="Install the Python Console App.")
+    parser.add_argument('--method', choices=('auto',) + INSTALL_METHODS, default='auto',
+                        help="how to fetch the files (default: cache, then archive, then git clone)")
+    args = parser.parse_args()
+
+    # Determine the directory where the app will be installed
+    install_target_dir = os.path.join(os.getcwd(), APP_DIR)
 
-    # Step 3: Change to app directory and check Python version
+    # Guard clause: Check if being run from inside the app directory
+    if os.path.exists(os.path.join(os.getcwd(), 'main.py')) and os.path.exists(os.path.join(os.getcwd(), 'updater.py')):
+        print("❌ Грешка: Този скрипт е само за инсталация.")
+        print("Изглежда, че приложението вече е инсталирано тук.")
+        print("\n🚀 За да стартирате приложението, използвайте командата:")
+        print("   python main.py")
+        sys.exit(1)
+
+    print("🔄 Инсталиране на конзолното приложение...")
+    print("📥 Изтегляне на последната версия от GitHub...")
+
+    # Step 1: Install the production files (object cache, archive or git clone)
+    if os.path.exists(install_target_dir):
+        print(f"⚠️  Директорията '{install_target_dir}' вече съществува. Премахване на старата инсталация...")
+        shutil.rmtree(install_target_dir, onerror=remove_readonly)
+        time.sleep(1) # Give OS time to release file handles
+
+    start = time.perf_counter()
+    result = install_app(install_target_dir, args.method)
+    if result is None:
+        print("❌ Приложението не може да бъде изтеглено от GitHub")
+        sys.exit(1)
+    method_used, transferred = result
+    elapsed = time.perf_counter() - start
+
+    print("✅ Приложението е изтеглено успешно")
+    print(f"⏱️  Метод: {method_used}, време: {elapsed:.2f} s, изтеглени: {transferred} байта")
+
+    # Step 2: Change to app directory and check Python version
     try:
         os.chdir(install_target_dir)
     except FileNotFoundError:
@@ -134,6 +362,15 @@ def main():
         sys.exit(1)
     print("✅ Проверката на Python версията е успешна")
 
+    # Step 3: Check the installed files against the release manifest, repairing mismatches
+    if os.path.exists(MANIFEST_FILE):
+        result = subprocess.run([sys.executable, 'main.py', 'verify', '--repair'], capture_output=True, text=True)
+        if result.returncode == 0:
+            print("✅ Инсталираните файлове съвпадат с манифеста на версията")
+        else:
+            print("⚠️  Някои инсталирани файлове не съвпадат с манифеста:")
+            print(result.stderr)
+
     # Step 4: Make main.py executable on Unix systems
     if not os.name == 'nt':  # Not Windows
         try:
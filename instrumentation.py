@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Timing and I/O instrumentation for startup and update phases.
+Enabled by the APP_TRACE environment variable: a file path the trace is
+appended to as one JSON document per line (one line per run), or "-" for
+stderr. When it is not set, span() returns a shared no-op object and add()
+returns at once, so instrumented code pays about one function call.
+
+    @instrumentation.traced("update.install")
+    def install(): ...
+
+    with instrumentation.span("update.download", url=url):
+        ...
+        instrumentation.add("bytes_read", len(block))
+
+Counters added with add() and attributes set with annotate() go to the
+innermost open span of the calling thread; counters also to the run totals.
+"""
+
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+TRACE_ENV = "APP_TRACE"
+
+# Trace destination; None disables instrumentation
+TRACE_PATH = os.environ.get(TRACE_ENV) or None
+
+ENABLED = TRACE_PATH is not None
+
+_start_ns = time.perf_counter_ns()
+_started_at = time.time()
+_spans = []
+_totals = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class _NullSpan:
+    """Stand-in returned by span() while tracing is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, key, amount=1):
+        pass
+
+    def set(self, key, value):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    One timed phase. Records its start offset and duration in milliseconds,
+    its parent span, attributes and counters.
+    """
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.counters = {}
+        self.parent = None
+        self._begin_ns = 0
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self._begin_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end_ns = time.perf_counter_ns()
+        _stack().remove(self)
+        record = {
+            "name": self.name,
+            "parent": self.parent,
+            "thread": threading.current_thread().name,
+            "start_ms": (self._begin_ns - _start_ns) / 1e6,
+            "duration_ms": (end_ns - self._begin_ns) / 1e6,
+        }
+        if self.attrs:
+            record["attrs"] = self.attrs
+        if self.counters:
+            record["counters"] = self.counters
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        with _lock:
+            _spans.append(record)
+        return False
+
+    def add(self, key, amount=1):
+        self.counters[key] = self.counters.get(key, 0) + amount
+        with _lock:
+            _totals[key] = _totals.get(key, 0) + amount
+
+    def set(self, key, value):
+        self.attrs[key] = value
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def span(name, **attrs):
+    """
+    Return a context manager timing the named phase.
+    """
+    if not ENABLED:
+        return _NULL_SPAN
+    return Span(name, attrs)
+
+
+def traced(name):
+    """
+    Decorator timing every call of a function as a span. While tracing is
+    off the function is returned unchanged, so it costs nothing.
+    """
+    def decorate(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def annotate(key, value):
+    """
+    Set an attribute of the innermost open span of this thread.
+    """
+    if not ENABLED:
+        return
+    stack = _stack()
+    if stack:
+        stack[-1].set(key, value)
+
+
+def add(key, amount=1):
+    """
+    Add to a counter of the innermost open span of this thread (and to the
+    run totals), e.g. add("bytes_written", n) or add("files_written").
+    """
+    if not ENABLED:
+        return
+    stack = _stack()
+    if stack:
+        stack[-1].add(key, amount)
+    else:
+        with _lock:
+            _totals[key] = _totals.get(key, 0) + amount
+
+
+def _process_io():
+    """
+    Return the process's read/write byte totals from /proc/self/io, or None
+    where that is not available.
+    """
+    try:
+        with open("/proc/self/io", 'r') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return {"bytes_read": int(fields['rchar']), "bytes_written": int(fields['wchar'])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def build_trace():
+    """
+    Return the trace document of this run so far.
+    """
+    with _lock:
+        spans = sorted(_spans, key=lambda record: record["start_ms"])
+        totals = dict(_totals)
+    return {
+        "trace_version": 1,
+        "pid": os.getpid(),
+        "started_at": _started_at,
+        "wall_ms": (time.perf_counter_ns() - _start_ns) / 1e6,
+        "argv": sys.argv[1:],
+        "spans": spans,
+        "totals": totals,
+        "process_io": _process_io(),
+    }
+
+
+def write_trace():
+    """
+    Append the trace of this run to TRACE_PATH (stderr for "-").
+    Called automatically at exit when tracing is enabled.
+    """
+    if not ENABLED:
+        return
+    line = json.dumps(build_trace(), ensure_ascii=False)
+    try:
+        if TRACE_PATH == "-":
+            print(line, file=sys.stderr)
+        else:
+            with open(TRACE_PATH, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+    except OSError:
+        pass  # Tracing must never break the app
+
+
+if ENABLED:
+    atexit.register(write_trace)
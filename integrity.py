@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Integrity check of installed app files against the hashes of a release
+manifest ({path: {"sha256", "size"}}, see release.py).
+Files are hashed in a process pool when there is much to hash. The hashes
+are remembered in .verify_cache.json in the checked directory, keyed by
+size, mtime and inode, so later checks re-hash only files that changed and
+a check of an untouched install costs one stat per file.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+# Hash cache, kept in the checked directory
+HASH_CACHE_FILE = ".verify_cache.json"
+
+# A file modified this close to the check that hashed it may have changed
+# again within the same mtime tick, so its cached hash is not trusted
+RACY_WINDOW_NS = 2 * 10**9
+
+# Files are hashed in a process pool when at least this many bytes need hashing
+PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+
+# Files handed to one pool worker at a time
+HASH_CHUNK_SIZE = 64
+
+
+def hash_files(paths):
+    """
+    Return [(path, sha256_hex or None)] for files, None for unreadable ones.
+    Runs in the pool workers of check_files.
+    """
+    hashes = []
+    for path in paths:
+        digest = hashlib.sha256()
+        try:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+            hashes.append((path, digest.hexdigest()))
+        except OSError:
+            hashes.append((path, None))
+    return hashes
+
+
+def load_hash_cache(app_dir):
+    """
+    Return the hash cache of app_dir: {"written_at_ns": ..., "files": {path: [size, mtime_ns, inode, sha256]}}.
+    """
+    try:
+        with open(os.path.join(app_dir, HASH_CACHE_FILE), 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        if isinstance(cache, dict) and isinstance(cache.get('files'), dict):
+            return cache
+    except (OSError, json.JSONDecodeError):
+        pass
+    return {"written_at_ns": 0, "files": {}}
+
+
+def save_hash_cache(app_dir, cache):
+    """
+    Write the hash cache atomically. It is only an optimization, so failing
+    to write it is not an error.
+    """
+    path = os.path.join(app_dir, HASH_CACHE_FILE)
+    try:
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(cache, f, separators=(',', ':'))
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        pass
+
+
+def check_files(app_dir, expected, workers=None, seed_dir=None):
+    """
+    Compare the files of app_dir with expected {path: {"sha256", "size"}}
+    ('/'-separated paths). A file is hashed only when its size matches and
+    the cache holds no trusted hash for it. workers limits the process
+    pool (1 hashes in this process). Without a cache of its own, app_dir
+    starts from the cache of seed_dir: files hard-linked from there keep
+    their inode and mtime, so their hashes still apply.
+    Returns (bad, stats): bad maps each failing path to "missing", "size"
+    or "hash"; stats counts the files "checked", "hashed" and "cached".
+    """
+    check_start_ns = time.time_ns()
+    cache = load_hash_cache(app_dir)
+    if not cache['files'] and seed_dir:
+        cache = load_hash_cache(seed_dir)
+    trusted_before_ns = cache.get('written_at_ns', 0) - RACY_WINDOW_NS
+    cached_files = cache['files']
+    files = {}
+    bad = {}
+    to_hash = {}
+    hash_bytes = 0
+    stats = {"checked": len(expected), "hashed": 0, "cached": 0}
+
+    for path, info in expected.items():
+        local_path = os.path.join(app_dir, *path.split('/'))
+        try:
+            stat_result = os.stat(local_path)
+        except OSError:
+            bad[path] = "missing"
+            continue
+        if stat_result.st_size != info.get('size', stat_result.st_size):
+            bad[path] = "size"
+            continue
+        key = [stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino]
+        entry = cached_files.get(path)
+        if entry and entry[:3] == key and stat_result.st_mtime_ns < trusted_before_ns:
+            files[path] = entry
+            stats["cached"] += 1
+            if entry[3] != info['sha256']:
+                bad[path] = "hash"
+            continue
+        to_hash[local_path] = (path, key)
+        hash_bytes += stat_result.st_size
+
+    local_paths = list(to_hash)
+    chunks = [local_paths[i:i + HASH_CHUNK_SIZE] for i in range(0, len(local_paths), HASH_CHUNK_SIZE)]
+    if hash_bytes >= PARALLEL_MIN_BYTES and len(chunks) > 1 and workers != 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = [pair for hashes in pool.map(hash_files, chunks) for pair in hashes]
+    else:
+        results = hash_files(local_paths)
+
+    for local_path, sha256 in results:
+        path, key = to_hash[local_path]
+        stats["hashed"] += 1
+        if sha256 is None:
+            bad[path] = "missing"
+            continue
+        files[path] = key + [sha256]
+        if sha256 != expected[path]['sha256']:
+            bad[path] = "hash"
+
+    if files != cached_files or to_hash:
+        save_hash_cache(app_dir, {"written_at_ns": check_start_ns, "files": files})
+    return bad, stats
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Streaming reader for very large user data records.
+Parses the top-level keys of a JSON object incrementally from a memory map,
+keeping large string values (such as "content") as byte spans that are
+decoded chunk by chunk on demand. Pages that were scanned are released
+again, so memory use stays bounded regardless of the file size.
+"""
+
+import json
+import mmap
+
+# Files larger than this are read with LargeRecord instead of json.load
+LARGE_FILE_THRESHOLD = 8 * 1024 * 1024
+
+# String values longer than this (in bytes) are kept as spans, not decoded
+SMALL_VALUE_LIMIT = 64 * 1024
+
+# Bytes of a memory map scanned before the scanned pages are released
+SCAN_WINDOW = 16 * 1024 * 1024
+
+# Largest non-string value (number, object, array) decoded while scanning
+MAX_VALUE_SIZE = 16 * 1024 * 1024
+
+_WHITESPACE = b' \t\r\n'
+_DECODER = json.JSONDecoder()
+
+
+class LargeRecord:
+    """
+    A top-level JSON object read lazily from a file.
+    fields holds the decoded small values; spans maps the keys of large
+    string values to the (start, end) byte offsets of their raw contents.
+    Use as a context manager, or call close().
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self._file.close()
+            raise ValueError(f"'{path}' is empty")
+        self.fields = {}
+        self.spans = {}
+        try:
+            self._scan()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _release(self, start, end):
+        """Drop the pages of [start, end) from memory; they are file-backed."""
+        if hasattr(self._map, 'madvise') and hasattr(mmap, 'MADV_DONTNEED'):
+            # Whole pages only; a partial last page is released by the next call
+            start -= start % mmap.PAGESIZE
+            end -= end % mmap.PAGESIZE
+            if end > start:
+                self._map.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def _skip_whitespace(self, pos):
+        data = self._map
+        while pos < len(data) and data[pos:pos + 1] in _WHITESPACE:
+            pos += 1
+        return pos
+
+    def _expect(self, pos, token):
+        pos = self._skip_whitespace(pos)
+        if self._map[pos:pos + 1] != token:
+            raise ValueError(f"Expected {token!r} at byte {pos}")
+        return pos + 1
+
+    def _string_end(self, pos):
+        """Return the offset of the quote closing the string opened at pos."""
+        data = self._map
+        window_start = pos
+        search = pos + 1
+        while True:
+            window_end = min(window_start + SCAN_WINDOW, len(data))
+            quote = data.find(b'"', search, window_end)
+            if quote == -1:
+                if window_end == len(data):
+                    raise ValueError(f"Unterminated string at byte {pos}")
+                self._release(window_start, window_end)
+                window_start = search = window_end
+                continue
+            backslashes = 0
+            while data[quote - 1 - backslashes] == 0x5C:  # '\\'
+                backslashes += 1
+            if backslashes % 2 == 0:
+                return quote
+            search = quote + 1
+
+    def _decode_value(self, pos):
+        """Decode a small value starting at pos; return (value, end_offset)."""
+        size = 4096
+        while True:
+            chunk = self._map[pos:pos + size]
+            try:
+                text = chunk.decode('utf-8', errors='ignore')
+                value, index = _DECODER.raw_decode(text)
+                return value, pos + len(text[:index].encode('utf-8'))
+            except ValueError:
+                if pos + size >= len(self._map) or size >= MAX_VALUE_SIZE:
+                    raise
+                size *= 4
+
+    def _scan(self):
+        pos = self._expect(0, b'{')
+        pos = self._skip_whitespace(pos)
+        if self._map[pos:pos + 1] == b'}':
+            return
+        while True:
+            pos = self._skip_whitespace(pos)
+            if self._map[pos:pos + 1] != b'"':
+                raise ValueError(f"Expected a key at byte {pos}")
+            key_end = self._string_end(pos)
+            key = json.loads(self._map[pos:key_end + 1].decode('utf-8'))
+            pos = self._skip_whitespace(self._expect(key_end + 1, b':'))
+
+            if self._map[pos:pos + 1] == b'"':
+                end = self._string_end(pos)
+                if key == "content" or end - pos > SMALL_VALUE_LIMIT:
+                    self.spans[key] = (pos + 1, end)
+                    self.fields.pop(key, None)
+                else:
+                    self.fields[key] = json.loads(self._map[pos:end + 1].decode('utf-8'))
+                pos = end + 1
+            else:
+                self.fields[key], pos = self._decode_value(pos)
+
+            pos = self._skip_whitespace(pos)
+            token = self._map[pos:pos + 1]
+            if token == b'}':
+                return
+            if token != b',':
+                raise ValueError(f"Expected ',' or '}}' at byte {pos}")
+            pos += 1
+
+    def _escape_starts_at(self, pos, index):
+        """True if the backslash at index starts an escape (is not itself escaped)."""
+        run_start = index
+        while run_start > pos and self._map[run_start - 1] == 0x5C:
+            run_start -= 1
+        return (index - run_start + 1) % 2 == 1
+
+    def _safe_cut(self, pos, cut):
+        """
+        Move a chunk boundary back so it does not split a UTF-8 character,
+        an escape sequence or a \\uXXXX surrogate pair.
+        """
+        data = self._map
+        while cut > pos and data[cut] & 0xC0 == 0x80:
+            cut -= 1
+
+        # Only the last backslash before the cut can start an unfinished escape
+        index = data.rfind(b'\\', max(pos, cut - 6), cut)
+        if index != -1 and self._escape_starts_at(pos, index):
+            length = 6 if data[index + 1:index + 2] == b'u' else 2
+            if index + length > cut:
+                cut = index
+
+        # Keep a high surrogate escape together with the low half that follows
+        start = cut - 6
+        if start >= pos and data[start] == 0x5C and data[start + 1:start + 2] == b'u' \
+                and data[start + 2:start + 4].lower() in (b'd8', b'd9', b'da', b'db') \
+                and self._escape_starts_at(pos, start):
+            cut = start
+        return cut
+
+    def iter_string(self, key, chunk_size=64 * 1024):
+        """
+        Yield the decoded text of a large string value in chunks of about
+        chunk_size bytes, never splitting a UTF-8 character or an escape.
+        """
+        start, end = self.spans[key]
+        pos = start
+        while pos < end:
+            cut = min(pos + chunk_size, end)
+            if cut < end:
+                cut = self._safe_cut(pos, cut)
+                if cut == pos:  # chunk_size smaller than one character or escape
+                    cut = self._safe_cut(pos, min(pos + 13, end))
+            yield json.loads(b'"' + self._map[pos:cut] + b'"')
+            self._release(pos, cut)
+            pos = cut
+
+
+def read_meta(path):
+    """
+    Return the meta fields (all keys except "content") of a large record
+    without decoding its large string values; None if it is not valid.
+    """
+    try:
+        with LargeRecord(path) as record:
+            return {k: v for k, v in record.fields.items() if k != "content"}
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Versioned install layout.
+Each update is unpacked into releases/<version>/ and activated by rewriting
+the small current.json pointer in one atomic rename. main.py runs the release
+the pointer names; rolling back only flips the pointer, without network access.
+This module must stay import-light: main.py loads it before anything else.
+"""
+
+import json
+import os
+import sys
+
+# Directory holding one subdirectory per installed release
+RELEASES_DIR = "releases"
+
+# Pointer to the active release: {"current": version, "previous": version}.
+# A rollback adds "skipped": the version it left, which updates then pass
+# over until a later one is published (see updater.is_wanted_update).
+CURRENT_POINTER_FILE = "current.json"
+
+# "previous" (or a missing "current") naming the in-place install the first
+# update switched away from: the app files next to this launcher
+IN_PLACE_RELEASE = "in-place"
+
+# Number of releases kept on disk (the current and previous one are always kept).
+# Override with the APP_RELEASE_RETENTION environment variable.
+RELEASE_RETENTION = int(os.environ.get("APP_RELEASE_RETENTION", "3"))
+
+# Prefix of release directories that are still being prepared
+STAGING_PREFIX = ".staging-"
+
+# Parsed version.json files: {path: ((mtime_ns, size), data)}
+_version_cache = {}
+
+
+def read_pointer():
+    """
+    Return the pointer dict, or an empty dict for an in-place install.
+    """
+    try:
+        with open(CURRENT_POINTER_FILE, 'r', encoding='utf-8') as f:
+            pointer = json.load(f)
+        return pointer if isinstance(pointer, dict) else {}
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def release_path(version):
+    """
+    Return the directory of an installed release.
+    """
+    return os.path.join(RELEASES_DIR, version)
+
+
+def resolve_release_dir():
+    """
+    Return the absolute directory of the active release, or None when the
+    app runs from an in-place install (no pointer or a broken one).
+    """
+    version = read_pointer().get('current')
+    if not version:
+        return None
+    release_dir = os.path.abspath(release_path(version))
+    if os.path.isfile(os.path.join(release_dir, "main.py")):
+        return release_dir
+    return None
+
+
+def read_version_data(app_dir=None):
+    """
+    Return the parsed version.json of app_dir (the active app directory by
+    default), or None if it is missing or invalid. The parsed document is
+    kept until the file changes, so the startup banner and the update check
+    read it once; callers must not modify it.
+    """
+    path = os.path.join(app_dir or get_active_app_dir(), "version.json")
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    key = (stat_result.st_mtime_ns, stat_result.st_size)
+    cached = _version_cache.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    _version_cache[path] = (key, data)
+    return data
+
+
+def get_active_app_dir():
+    """
+    Return the directory holding the running app files: the active release,
+    or '.' for an in-place install.
+    """
+    return resolve_release_dir() or '.'
+
+
+def run_release(release_dir):
+    """
+    Execute the main.py of the given release as __main__, importing its
+    modules instead of the ones next to this launcher.
+    """
+    import runpy
+
+    sys.path[0] = release_dir
+    for name in ("utils", "updater", "launcher"):
+        sys.modules.pop(name, None)
+    runpy.run_path(os.path.join(release_dir, "main.py"), run_name="__main__")
+
+
+def write_pointer(pointer):
+    """
+    Replace the pointer file atomically.
+    """
+    temp_path = f"{CURRENT_POINTER_FILE}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(pointer, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, CURRENT_POINTER_FILE)
+
+
+def switch_release(version):
+    """
+    Make an installed release the active one; the old one becomes 'previous'
+    (IN_PLACE_RELEASE when the app ran from an in-place install).
+    """
+    pointer = read_pointer()
+    previous = pointer.get('current') or IN_PLACE_RELEASE
+    new_pointer = {"current": version}
+    if previous != version:
+        new_pointer["previous"] = previous
+    elif pointer.get('previous'):
+        new_pointer["previous"] = pointer['previous']
+    write_pointer(new_pointer)
+
+
+def rollback_release():
+    """
+    Switch back to the previous release and remember the one left as
+    skipped, so the next update check does not reinstall it. Returns the
+    activated version (IN_PLACE_RELEASE for the in-place install), or None
+    if there is nothing to roll back to.
+    """
+    pointer = read_pointer()
+    current = pointer.get('current') or IN_PLACE_RELEASE
+    previous = pointer.get('previous')
+    if not previous or previous == current:
+        return None
+    if previous != IN_PLACE_RELEASE and not os.path.isfile(os.path.join(release_path(previous), "main.py")):
+        return None
+    # Without "current" the launcher runs the in-place files
+    new_pointer = {"previous": current, "skipped": current}
+    if previous != IN_PLACE_RELEASE:
+        new_pointer["current"] = previous
+    write_pointer(new_pointer)
+    return previous
+
+
+def prune_releases(retention=None):
+    """
+    Delete the oldest releases beyond the retention count, never touching the
+    current or previous release, plus leftovers of interrupted updates.
+    Returns the list of removed directory names.
+    """
+    import shutil
+
+    if retention is None:
+        retention = RELEASE_RETENTION
+    if not os.path.isdir(RELEASES_DIR):
+        return []
+
+    pointer = read_pointer()
+    protected = {pointer.get('current'), pointer.get('previous')}
+    removed = []
+    releases = []
+    for entry in os.scandir(RELEASES_DIR):
+        if not entry.is_dir():
+            continue
+        if entry.name.startswith(STAGING_PREFIX):
+            shutil.rmtree(entry.path, ignore_errors=True)
+            removed.append(entry.name)
+        elif entry.name not in protected:
+            releases.append((entry.stat().st_mtime, entry.name, entry.path))
+
+    keep = max(retention - len(protected - {None, IN_PLACE_RELEASE}), 0)
+    releases.sort(reverse=True)
+    for _, name, path in releases[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
+        removed.append(name)
+    return removed
@@ -5,39 +5,71 @@ Main entry point for the application.
 """
 
 import os
-import json
-from utils import show_menu, read_json_file, create_new_json, DATA_DIR
-from updater import check_for_updates
+import sys
+import io
+import time
+import contextlib
+import launcher
 
+# Versioned installs: hand over to the release named by current.json before
+# importing any app module, so the release's own modules are the ones loaded.
+if __name__ == "__main__":
+    if sys.argv[1:] == ["rollback"]:
+        rolled_back_to = launcher.rollback_release()
+        if rolled_back_to == launcher.IN_PLACE_RELEASE:
+            print("Активирана е предишната версия: първоначалната инсталация")
+        elif rolled_back_to:
+            print(f"Активирана е предишната версия: {rolled_back_to}")
+        else:
+            print("Няма предишна версия за връщане.")
+        sys.exit(0)
+
+    _release_dir = launcher.resolve_release_dir()
+    if _release_dir and _release_dir != os.path.dirname(os.path.abspath(__file__)):
+        launcher.run_release(_release_dir)
+        sys.exit(0)
+
+import instrumentation
+from utils import (show_menu, read_json_file, create_new_json, search_records, import_records, export_records,
+                   DATA_DIR)
+from updater import (check_for_updates, start_background_check, get_pending_update,
+                     apply_pending_update, decide_update_policy)
 
+
+@instrumentation.traced("main.get_app_version")
 def get_app_version():
     """
     Get version and last updated date from version.json file.
     Returns tuple (version, last_updated) or defaults if file doesn't exist.
     """
-    try:
-        if os.path.exists("version.json"):
-            with open("version.json", 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                version = data.get('version', 'unknown')
-                last_updated = data.get('last_updated', 'unknown')
-                return version, last_updated
-    except (json.JSONDecodeError, KeyError):
-        pass
-    return "development", "unknown"
+    data = launcher.read_version_data()
+    if data is None:
+        return "development", "unknown"
+    return data.get('version', 'unknown'), data.get('last_updated', 'unknown')
 
 
 def main():
-    version, last_updated = get_app_version()
-    print(f"=== Python Console App v{version} ({last_updated}) ===\n")
+    # Everything up to the first menu counts as startup in the trace
+    with instrumentation.span("main.startup"):
+        version, last_updated = get_app_version()
+        print(f"=== Python Console App v{version} ({last_updated}) ===\n")
 
-    # Ensure the data directory exists on startup
-    if not os.path.exists(DATA_DIR):
-        os.makedirs(DATA_DIR)
-        print(f"Създадена директория за потребителски данни: '{DATA_DIR}'")
+        # Ensure the data directory exists on startup
+        if not os.path.exists(DATA_DIR):
+            os.makedirs(DATA_DIR)
+            print(f"Създадена директория за потребителски данни: '{DATA_DIR}'")
 
-    # Check for updates on startup
-    check_for_updates()
+        # Check for updates as the startup policy decides: in the background so
+        # the menu shows up right away, synchronously, or not at all this time
+        run_mode = "interactive" if sys.stdin.isatty() else "batch"
+        policy, reason = decide_update_policy(run_mode)
+        instrumentation.annotate("update_policy", policy)
+        instrumentation.annotate("update_policy_reason", reason)
+        if policy == "sync":
+            check_for_updates()
+        elif policy == "background":
+            start_background_check()
+    update_announced = False
 
     while True:
         choice = show_menu()
@@ -48,15 +80,127 @@ def main():
         elif choice == '2':
             # Create new JSON
             create_new_json()
+        elif choice == '3':
+            # Full-text search
+            search_records()
         else:
             print("Невалиден избор. Опитайте отново.")
 
         # Ask to continue or exit
         continue_app = input("\nЖелате ли да продължите? (y/n): ").strip().lower()
         if continue_app != 'y':
-            print("Довиждане!")
             break
 
+        # Between menu iterations: announce a staged update once
+        pending = get_pending_update()
+        if pending and not update_announced:
+            print(f"\nНалична е нова версия {pending[0]}. Тя ще бъде приложена при изход.")
+            update_announced = True
+
+    # Safe point: no user action is in progress, apply the staged update
+    with instrumentation.span("main.apply_pending_update"):
+        apply_pending_update()
+    print("Довиждане!")
+
+
+def run_command(argv):
+    """
+    Non-interactive batch mode: 'import' reads NDJSON records from stdin,
+    'export' writes all records to stdout as NDJSON, 'search' prints the
+    names of the records matching a query, 'migrate' moves the records to
+    another storage backend, 'verify' checks the installed app files
+    against the release manifest. Progress and the records/sec rate
+    go to stderr. Returns the process exit code.
+    """
+    import argparse
+
+    # 'rollback' runs before this point, ahead of the release hand-over (see the top of this file)
+    parser = argparse.ArgumentParser(prog="main.py", description="Пакетна обработка на записите в user_data.",
+                                     epilog="python main.py rollback - връщане към предишната инсталирана версия")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="създаване на записи от NDJSON на stdin ({\"name\": ..., \"content\": ...})")
+    import_parser.add_argument("--workers", type=int, default=None, help="брой нишки за запис")
+    commands.add_parser("export", help="извеждане на всички записи като NDJSON на stdout")
+    search_parser = commands.add_parser("search", help="имена на записите, съдържащи всички думи от заявката")
+    search_parser.add_argument("query", help="думи за търсене; последната може да е начало на дума")
+    search_parser.add_argument("--limit", type=int, default=100, help="най-много толкова резултата")
+    search_parser.add_argument("--rebuild", action="store_true", help="индексиране наново на всички записи")
+    verify_parser = commands.add_parser("verify", help="проверка на инсталираните файлове спрямо манифеста на версията")
+    verify_parser.add_argument("--repair", action="store_true", help="поправяне само на несъвпадащите файлове")
+    verify_parser.add_argument("--workers", type=int, default=None, help="брой процеси за хеширане")
+    migrate_parser = commands.add_parser("migrate", help="преместване на записите в друг вид хранилище")
+    migrate_parser.add_argument("--to", required=True, choices=("files", "segments"), dest="target",
+                                help="files - по един JSON файл на запис, segments - сегменти с компресия")
+    args = parser.parse_args(argv)
+
+    # Batch runs skip the update check unless APP_UPDATE_CHECK asks for one;
+    # its messages go to stderr so they never mix with exported records
+    policy, _ = decide_update_policy("batch")
+    if policy != "skip":
+        with contextlib.redirect_stdout(sys.stderr):
+            check_for_updates()
+
+    start = time.perf_counter()
+    unit = "записа"
+    with instrumentation.span(f"command.{args.command}"):
+        if args.command == "import":
+            lines = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+            count, errors = import_records(lines, workers=args.workers)
+            for line_number, message in errors:
+                print(f"Ред {line_number}: {message}", file=sys.stderr)
+            action = "Импортирани"
+        elif args.command == "search":
+            import search_index
+            import storage
+            with storage.open_store(DATA_DIR) as store:
+                conn = search_index.open_index(DATA_DIR)
+                try:
+                    indexed = search_index.sync(conn, store, force=args.rebuild)
+                    if indexed:
+                        print(f"Индексирани {indexed} записа.", file=sys.stderr)
+                    names, total, truncated = search_index.search(conn, args.query, limit=args.limit)
+                finally:
+                    conn.close()
+            if truncated:
+                print(f"Думите, започващи с '{truncated}', са твърде много; търсени са само "
+                      f"{search_index.MAX_PREFIX_TERMS} най-честите.", file=sys.stderr)
+            for name in names:
+                print(name)
+            if total > search_index.COUNT_LIMIT:
+                print(f"Записите са повече от {search_index.COUNT_LIMIT}; броят се само до толкова.", file=sys.stderr)
+            count, errors = total, []
+            action = "Намерени"
+        elif args.command == "verify":
+            from updater import verify_install
+            with contextlib.redirect_stdout(sys.stderr):
+                result = verify_install(repair=args.repair, workers=args.workers)
+            if result is None:
+                return 1
+            errors, count = result
+            action, unit = "Проверени", "файла"
+        elif args.command == "migrate":
+            import storage
+            count = storage.migrate(DATA_DIR, args.target,
+                                    progress=lambda done: print(f"Преместени {done} записа...", file=sys.stderr))
+            errors = []
+            action = "Преместени"
+        elif args.command == "export":
+            out = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', newline='\n')
+            count, errors = export_records(out)
+            out.flush()
+            for filename, message in errors:
+                print(f"{filename}: {message}", file=sys.stderr)
+            action = "Експортирани"
+        instrumentation.add("records", count)
+        instrumentation.add("errors", len(errors))
+
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed > 0 else 0.0
+    print(f"{action} {count} {unit} за {elapsed:.2f} s ({rate:.0f} {unit}/s), грешки: {len(errors)}", file=sys.stderr)
+    return 1 if errors else 0
+
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.exit(run_command(sys.argv[1:]))
     main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Machine-wide content-addressed cache of release files.
+Every file is stored once under objects/<sha256[:2]>/<sha256> and hard-linked
+into the install directories that use it, so several installs on one host
+download and store each release file only once. Blobs no install links to any
+more are evicted least recently used first when the cache exceeds its budget.
+Cached blobs are never written in place: installs replace files, they do not
+modify them.
+"""
+
+import hashlib
+import os
+import time
+from urllib.request import urlopen
+
+# Cache location. Override with the APP_OBJECT_CACHE environment variable.
+OBJECT_CACHE_DIR = os.environ.get("APP_OBJECT_CACHE") or os.path.join(
+    os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME")
+    or os.path.join(os.path.expanduser("~"), ".cache"),
+    "python-console-app")
+
+# Size budget in bytes for blobs. Override with APP_OBJECT_CACHE_MB (megabytes).
+OBJECT_CACHE_BUDGET = int(os.environ.get("APP_OBJECT_CACHE_MB", "256")) * 1024 * 1024
+
+HTTP_TIMEOUT = 10
+
+
+def object_path(sha256):
+    """
+    Return the cache path of the blob with the given SHA-256.
+    """
+    sha256 = sha256.lower()
+    return os.path.join(OBJECT_CACHE_DIR, "objects", sha256[:2], sha256)
+
+
+def touch(path):
+    """
+    Mark a blob as used now. The access time is set explicitly because
+    links do not update it and many filesystems are mounted relatime.
+    """
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except OSError:
+        pass
+
+
+def lookup(sha256):
+    """
+    Return the path of a cached blob, or None if it is not cached.
+    """
+    path = object_path(sha256)
+    if os.path.isfile(path):
+        touch(path)
+        return path
+    return None
+
+
+def _store(write_to, sha256):
+    """
+    Put a blob into the cache atomically: write_to(temp_path) fills a
+    temporary file inside the cache, which is then renamed into place.
+    """
+    path = object_path(sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        write_to(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return path
+
+
+def fetch(sha256, url):
+    """
+    Return (blob_path, downloaded_bytes) for a blob, downloading it from url
+    only when it is not cached yet. Raises ValueError when the downloaded
+    content does not match sha256, OSError/URLError on network errors.
+    """
+    cached = lookup(sha256)
+    if cached:
+        return cached, 0
+
+    downloaded = 0
+
+    def write_to(temp_path):
+        nonlocal downloaded
+        digest = hashlib.sha256()
+        with urlopen(url, timeout=HTTP_TIMEOUT) as response, open(temp_path, 'wb') as f:
+            for block in iter(lambda: response.read(1024 * 1024), b''):
+                digest.update(block)
+                f.write(block)
+                downloaded += len(block)
+        if digest.hexdigest() != sha256.lower():
+            raise ValueError(f"Несъответствие в хеша на {url}")
+
+    return _store(write_to, sha256), downloaded
+
+
+def evict(budget=None):
+    """
+    Delete least recently used blobs that no install links to (link count 1)
+    until the cache fits the budget. Returns (removed_count, freed_bytes).
+    """
+    if budget is None:
+        budget = OBJECT_CACHE_BUDGET
+    objects_dir = os.path.join(OBJECT_CACHE_DIR, "objects")
+    if not os.path.isdir(objects_dir):
+        return 0, 0
+
+    total = 0
+    unused = []
+    for fan_out in os.scandir(objects_dir):
+        if not fan_out.is_dir():
+            continue
+        for entry in os.scandir(fan_out.path):
+            try:
+                # os.stat, not entry.stat(): the latter has no link count on Windows
+                stat_result = os.stat(entry.path)
+            except OSError:
+                continue
+            total += stat_result.st_size
+            if stat_result.st_nlink == 1 and not entry.name.endswith('.tmp'):
+                unused.append((stat_result.st_atime, stat_result.st_size, entry.path))
+
+    removed = freed = 0
+    unused.sort()
+    for _, size, path in unused:
+        if total - freed <= budget:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        removed += 1
+        freed += size
+    return removed, freed
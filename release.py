@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Release tooling for the production branch.
+Writes manifest.json with the SHA-256 and size of every tracked file an
+install holds, so installed copies can update only the files that changed.
+Optionally builds the release archive as well and publishes its size and
+SHA-256 (and download URL) in version.json, so the updater can verify it.
+Finally records the release in release-index.json under a channel; installs
+resolve their target version from that one document.
+Run from the production checkout before committing a release:
+    python release.py
+    python release.py --archive release.zip --archive-url https://.../release.zip
+    python release.py --channel beta --ref v1.1.0-beta.1 --min-supported 1.0.0
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import zipfile
+
+from updater import (GITHUB_REPO_OWNER, GITHUB_REPO_NAME, GIT_BRANCH, RELEASE_INDEX_FILE, is_development_path,
+                     version_key)
+
+MANIFEST_FILE = "manifest.json"
+VERSION_FILE = "version.json"
+
+# Fields of version.json that describe the release archive of one run
+ARCHIVE_FIELDS = ("archive_url", "archive_sha256", "archive_size")
+
+
+def tracked_files():
+    """
+    Return the files tracked by git, with '/' separators.
+    """
+    result = subprocess.run(['git', 'ls-files', '-z'], capture_output=True, check=True)
+    paths = result.stdout.decode('utf-8').split('\0')
+    return sorted(p for p in paths if p and p not in (MANIFEST_FILE, VERSION_FILE, RELEASE_INDEX_FILE))
+
+
+def hash_file(path):
+    """
+    Return (sha256_hex, size) of a file.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+            size += len(block)
+    return digest.hexdigest(), size
+
+
+def build_manifest(paths, version):
+    """
+    Build the manifest document for the given files.
+    """
+    files = {}
+    for path in paths:
+        sha256, size = hash_file(path)
+        files[path] = {"sha256": sha256, "size": size}
+    return {"version": version, "files": files}
+
+
+def build_archive(archive_path, paths):
+    """
+    Write the release archive in the GitHub branch archive layout
+    ("repo-branch/" top-level folder), which the updater applies.
+    version.json is left out: the updater writes it from the published copy.
+    """
+    prefix = f"{GITHUB_REPO_NAME}-{GIT_BRANCH}/"
+    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for path in paths + [MANIFEST_FILE]:
+            zf.write(path, prefix + path)
+
+
+def publish_archive(archive_path, archive_url):
+    """
+    Record the archive's size, SHA-256 and URL in version.json, replacing
+    those of an earlier run. Without archive_path they are only removed,
+    so a release built without --archive never names a stale archive.
+    """
+    with open(VERSION_FILE, 'r', encoding='utf-8') as f:
+        version_data = json.load(f)
+    if archive_path is None and not any(field in version_data for field in ARCHIVE_FIELDS):
+        return
+    for field in ARCHIVE_FIELDS:
+        version_data.pop(field, None)
+    if archive_path is not None:
+        sha256, size = hash_file(archive_path)
+        version_data.update(archive_size=size, archive_sha256=sha256)
+        if archive_url:
+            version_data['archive_url'] = archive_url
+    with open(VERSION_FILE, 'w', encoding='utf-8') as f:
+        json.dump(version_data, f, indent=2, ensure_ascii=False)
+    if archive_path is not None:
+        print(f"Wrote {archive_path} ({size} bytes) and recorded it in {VERSION_FILE}.")
+    else:
+        print(f"Removed the archive of an earlier release from {VERSION_FILE}.")
+
+
+def update_release_index(version_data, channel, ref, min_supported=None):
+    """
+    Point a channel of release-index.json at this release, with the
+    download locations of the given git ref. Releases no channel points
+    to any more are dropped, so the index stays small.
+    """
+    try:
+        with open(RELEASE_INDEX_FILE, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        index = {}
+    channels = index.setdefault('channels', {})
+    releases = index.setdefault('releases', {})
+
+    version = version_data['version']
+    raw_url = f"https://raw.githubusercontent.com/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/{ref}"
+    release = dict(version_data)
+    release.setdefault('archive_url', f"https://github.com/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/archive/{ref}.zip")
+    release['manifest_url'] = f"{raw_url}/{MANIFEST_FILE}"
+    release['files_url'] = raw_url
+    releases[version] = release
+    channels[channel] = version
+    if min_supported:
+        version_key(min_supported)  # reject a malformed version early
+        index['min_supported'] = min_supported
+
+    for name in list(releases):
+        if name not in channels.values():
+            del releases[name]
+    with open(RELEASE_INDEX_FILE, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2, sort_keys=True, ensure_ascii=False)
+    print(f"Channel '{channel}' of {RELEASE_INDEX_FILE} now points to {version}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare a production release.")
+    parser.add_argument('--archive', help="also build the release archive at this path")
+    parser.add_argument('--archive-url', help="URL the archive will be downloaded from")
+    parser.add_argument('--channel', default="stable", help="release channel to publish to (default: stable)")
+    parser.add_argument('--ref', default=GIT_BRANCH, help="git branch or tag the release files are served from")
+    parser.add_argument('--min-supported', help="oldest version allowed to keep running without updating")
+    args = parser.parse_args()
+
+    try:
+        with open(VERSION_FILE, 'r', encoding='utf-8') as f:
+            version = json.load(f)['version']
+        version_key(version)
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Cannot read {VERSION_FILE}: {e}")
+        sys.exit(1)
+
+    try:
+        paths = tracked_files()
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Cannot list tracked files (is this a git checkout?): {e}")
+        sys.exit(1)
+
+    paths = [p for p in paths if os.path.isfile(p)]
+    # Installs leave the development files out, so the manifest does too
+    manifest = build_manifest([p for p in paths if not is_development_path(p)], version)
+    with open(MANIFEST_FILE, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print(f"Wrote {MANIFEST_FILE} for version {version} ({len(manifest['files'])} files).")
+
+    if args.archive:
+        build_archive(args.archive, paths)
+    publish_archive(args.archive, args.archive_url)
+
+    with open(VERSION_FILE, 'r', encoding='utf-8') as f:
+        version_data = json.load(f)
+    try:
+        update_release_index(version_data, args.channel, args.ref, args.min_supported)
+    except ValueError as e:
+        print(f"Invalid --min-supported: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Persistent full-text index of the user data records.
+An inverted index in SQLite maps every word of a record's "content" and meta
+field values (and of its name) to the records containing it, so a search
+looks up a few index entries instead of reading records:
+
+    conn = search_index.open_index(DATA_DIR)
+    search_index.sync(conn, store)
+    names, total, truncated = search_index.search(conn, "word another pref")
+
+Every word of a query must occur in a record; the last one also matches as
+a prefix, so results narrow while typing. The index is kept next to the data
+directory (user_data -> user_data.search.sqlite) and brought up to date
+incrementally: the app indexes the records it writes (record_change), and
+sync() re-reads only records whose stamp changed since they were indexed,
+spreading the work over a process pool when there are many.
+"""
+
+import collections
+import heapq
+import itertools
+import json
+import os
+import re
+import time
+
+import catalog
+import json_stream
+import storage
+
+# Suffix of the index database, kept next to the data directory like the catalog
+SEARCH_SUFFIX = ".search.sqlite"
+
+# Words longer than this are not indexed
+MAX_TERM_LENGTH = 64
+
+# Query words beyond this many are ignored
+MAX_QUERY_TERMS = 8
+
+# A prefix matches the word itself and at most this many longer words
+# (the most frequent ones); search() reports when it had to leave some out
+MAX_PREFIX_TERMS = 64
+
+# search() counts matches up to this many; more are reported as COUNT_LIMIT + 1
+COUNT_LIMIT = 1000
+
+# Candidates checked against the other query words at a time
+SCAN_BATCH_SIZE = 500
+
+# A group of up to this many query words is checked through the (term, doc)
+# primary key; larger ones against the candidates' word lists
+LOOKUP_MAX_TERMS = 4
+
+# sync() indexes in a process pool when at least this many records changed...
+PARALLEL_MIN_RECORDS = 2000
+
+# ...handing each worker this many records at a time
+INDEX_CHUNK_SIZE = 500
+
+# Characters of a large record's strings tokenized at a time
+LARGE_CHUNK_SIZE = 1024 * 1024
+
+_WORD = re.compile(r"\w+")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    stamp TEXT NOT NULL,
+    terms TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    doc INTEGER NOT NULL,
+    PRIMARY KEY (term, doc)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS terms (
+    term TEXT PRIMARY KEY,
+    df INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+def open_index(data_dir):
+    """
+    Open (and create if needed) the search index of data_dir.
+    """
+    conn = catalog.sqlite3.connect(os.path.normpath(data_dir) + SEARCH_SUFFIX, timeout=30)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def tokenize(text):
+    """
+    Return the words of text, case-folded, in order of appearance.
+    """
+    return [word for word in _WORD.findall(text.casefold()) if len(word) <= MAX_TERM_LENGTH]
+
+
+def _value_terms(value, terms):
+    # Meta values may be numbers, lists or objects: index their text form
+    if not isinstance(value, str):
+        value = json.dumps(value, ensure_ascii=False)
+    terms.update(tokenize(value))
+
+
+def _large_record_terms(path, terms):
+    """Add the words of a record too large to load, reading its long strings in chunks."""
+    with json_stream.LargeRecord(path) as record:
+        for value in record.fields.values():
+            _value_terms(value, terms)
+        for key in record.spans:
+            tail = ""
+            for chunk in record.iter_string(key, LARGE_CHUNK_SIZE):
+                text = tail + chunk
+                # A word may continue in the next chunk: carry it over
+                match = re.search(r"\w+$", text)
+                tail = match.group() if match else ""
+                terms.update(tokenize(text[:len(text) - len(tail)]))
+            terms.update(tokenize(tail))
+
+
+def record_terms(store, name):
+    """
+    Return the set of words of a record (name, content and meta values),
+    or None if it cannot be read.
+    """
+    terms = set(tokenize(name[:-len('.json')] if name.endswith('.json') else name))
+    try:
+        path = store.path(name)
+        if path and store.size(name) > json_stream.LARGE_FILE_THRESHOLD:
+            _large_record_terms(path, terms)
+        else:
+            for value in store.read(name).values():
+                _value_terms(value, terms)
+    except (OSError, ValueError):
+        return None
+    return terms
+
+
+def _index_chunk(data_dir, backend, names):
+    """
+    Process pool worker: return [(name, stamp, terms)] for records of data_dir.
+    The stamp is taken before the record is read, so a record rewritten
+    meanwhile is indexed again by the next sync.
+    """
+    entries = []
+    with storage.open_store(data_dir, backend) as store:
+        for name in names:
+            stamp = store.stamp(name)
+            if stamp is None:
+                continue
+            terms = record_terms(store, name)
+            entries.append((name, stamp, sorted(terms or ())))
+    return entries
+
+
+def _apply(conn, entries):
+    """
+    Point the index at the current words of records [(name, stamp, terms)],
+    touching only the words that changed; terms None removes the record.
+    The postings and word counts of the whole batch are written at once.
+    """
+    added, removed = [], []
+    df_change = collections.Counter()
+    for name, stamp, terms in entries:
+        row = conn.execute("SELECT id, terms FROM docs WHERE name = ?", (name,)).fetchone()
+        old_terms = set(row[1].split()) if row else set()
+        new_terms = set(terms or ())
+        if terms is None:
+            if row is None:
+                continue
+            doc = row[0]
+            conn.execute("DELETE FROM docs WHERE id = ?", (doc,))
+        elif row is None:
+            doc = conn.execute("INSERT INTO docs (name, stamp, terms) VALUES (?, ?, ?)",
+                               (name, stamp, " ".join(terms))).lastrowid
+        else:
+            doc = row[0]
+            conn.execute("UPDATE docs SET stamp = ?, terms = ? WHERE id = ?", (stamp, " ".join(terms), doc))
+        for term in old_terms - new_terms:
+            removed.append((term, doc))
+            df_change[term] -= 1
+        for term in new_terms - old_terms:
+            added.append((term, doc))
+            df_change[term] += 1
+
+    # Sorted by term, the inserts walk the postings B-tree in order
+    added.sort()
+    conn.executemany("DELETE FROM postings WHERE term = ? AND doc = ?", removed)
+    conn.executemany("INSERT OR IGNORE INTO postings (term, doc) VALUES (?, ?)", added)
+    changes = sorted((change, term) for term, change in df_change.items() if change)
+    conn.executemany("INSERT OR IGNORE INTO terms (term, df) VALUES (?, 0)", [(term,) for _, term in changes])
+    conn.executemany("UPDATE terms SET df = df + ? WHERE term = ?", changes)
+
+
+def _set_state(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+
+def _get_state(conn, key):
+    row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def sync(conn, store, force=False, workers=None):
+    """
+    Bring the index in line with the store. Does nothing while the store's
+    version token is the one last synced (outside the racy window, see
+    catalog.RACY_WINDOW_NS); otherwise indexes the records whose stamp
+    changed and drops the removed ones, in a process pool when at least
+    PARALLEL_MIN_RECORDS changed. force re-indexes every record.
+    Returns the number of records indexed.
+    """
+    version = store.version()
+    synced_at_ns = _get_state(conn, 'synced_at_ns') or 0
+    if not force and _get_state(conn, 'store_version') == version \
+            and version < synced_at_ns - catalog.RACY_WINDOW_NS:
+        return 0
+
+    sync_start_ns = time.time_ns()
+    stamps = store.stamps()
+    indexed = dict(conn.execute("SELECT name, stamp FROM docs"))
+    changed = [name for name, stamp in stamps.items() if force or indexed.get(name) != stamp]
+    removed = [name for name in indexed if name not in stamps]
+
+    chunks = [changed[i:i + INDEX_CHUNK_SIZE] for i in range(0, len(changed), INDEX_CHUNK_SIZE)]
+    if len(changed) >= PARALLEL_MIN_RECORDS and (workers is None or workers > 1):
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(_index_chunk, [store.data_dir] * len(chunks),
+                               [store.backend] * len(chunks), chunks)
+            _store_results(conn, results, removed)
+    else:
+        _store_results(conn, (_index_chunk(store.data_dir, store.backend, chunk) for chunk in chunks), removed)
+
+    with conn:
+        _set_state(conn, 'store_version', version)
+        _set_state(conn, 'synced_at_ns', sync_start_ns)
+    return len(changed)
+
+
+def _store_results(conn, results, removed):
+    """Write indexed chunks as they arrive, in one transaction."""
+    with conn:
+        _apply(conn, [(name, None, None) for name in removed])
+        for entries in results:
+            _apply(conn, entries)
+        conn.execute("DELETE FROM terms WHERE df <= 0")
+
+
+def record_change(store, name, version_before):
+    """
+    Index a record the app has just written (or removed). version_before is
+    store.version() from before the write: if the index was in sync then,
+    it stays in sync without a rescan.
+    """
+    conn = open_index(store.data_dir)
+    try:
+        in_sync = _get_state(conn, 'store_version') == version_before
+        with conn:
+            stamp = store.stamp(name)
+            terms = None if stamp is None else sorted(record_terms(store, name) or ())
+            _apply(conn, [(name, stamp, terms)])
+            conn.execute("DELETE FROM terms WHERE df <= 0")
+            if in_sync:
+                _set_state(conn, 'store_version', store.version())
+                _set_state(conn, 'synced_at_ns', time.time_ns())
+    finally:
+        conn.close()
+
+
+def _term_groups(conn, query):
+    """
+    Return (groups, truncated): one [(term, df)] list per query word, the
+    word itself or, for the last word, the word and the indexed words it is
+    a prefix of (most frequent first, at most MAX_PREFIX_TERMS of them).
+    truncated is the last word when it is a prefix of more words than that.
+    """
+    words = tokenize(query)[:MAX_QUERY_TERMS]
+    groups = []
+    truncated = None
+    for position, word in enumerate(words):
+        rows = conn.execute("SELECT term, df FROM terms WHERE term = ?", (word,)).fetchall()
+        if position == len(words) - 1:
+            longer = conn.execute("SELECT term, df FROM terms WHERE term > ? AND term < ? ORDER BY df DESC LIMIT ?",
+                                  (word, word + "\U0010ffff", MAX_PREFIX_TERMS + 1)).fetchall()
+            if len(longer) > MAX_PREFIX_TERMS:
+                truncated = word
+            rows += longer[:MAX_PREFIX_TERMS]
+        groups.append(rows)
+    return groups, truncated
+
+
+def _driver_cost(rows):
+    # A single word is read straight off the postings; a prefix merges the
+    # lists of all its words, so it drives only when clearly rarer
+    cost = sum(df for _, df in rows)
+    return cost if len(rows) == 1 else cost * 2
+
+
+def _matching_docs(conn, driver, others, wanted):
+    """
+    Return up to wanted doc ids, ascending, of the records containing a word
+    of every group. The driver's postings are read in doc order and stop
+    once enough matches are found; each batch of candidates is checked
+    against the other groups, by primary key or by reading their word lists.
+    """
+    # Few words are looked up by primary key; a long prefix expansion is
+    # cheaper to test against the candidates' word lists
+    lookups = [rows for rows in others if len(rows) <= LOOKUP_MAX_TERMS]
+    other_terms = [{term for term, _ in rows} for rows in others if len(rows) > LOOKUP_MAX_TERMS]
+    cursors = [conn.execute("SELECT doc FROM postings WHERE term = ? ORDER BY doc", (term,)) for term, _ in driver]
+    try:
+        merged = heapq.merge(*[(doc for (doc,) in cursor) for cursor in cursors])
+        candidates = (doc for doc, _ in itertools.groupby(merged))
+        matches = []
+        while len(matches) < wanted:
+            batch = list(itertools.islice(candidates, SCAN_BATCH_SIZE))
+            if not batch:
+                break
+            for rows in lookups:
+                if not batch:
+                    break
+                found = {doc for (doc,) in conn.execute(
+                    f"SELECT doc FROM postings WHERE term IN ({', '.join('?' * len(rows))}) "
+                    f"AND doc IN ({', '.join('?' * len(batch))})", [term for term, _ in rows] + batch)}
+                batch = [doc for doc in batch if doc in found]
+            if other_terms and batch:
+                doc_terms = dict(conn.execute(f"SELECT id, terms FROM docs WHERE id IN ({', '.join('?' * len(batch))})",
+                                              batch))
+                batch = [doc for doc in batch
+                         if all(not terms.isdisjoint(doc_terms[doc].split()) for terms in other_terms)]
+            matches += batch
+        return matches[:wanted]
+    finally:
+        # Unfinished statements would hold a read lock that blocks writers
+        for cursor in cursors:
+            cursor.close()
+
+
+def search(conn, query, offset=0, limit=20):
+    """
+    Return (names, total, truncated): limit record names from offset, in
+    index order, among the records containing every word of query (the last
+    one also as a prefix). total is exact up to COUNT_LIMIT; more matches
+    are reported as COUNT_LIMIT + 1. truncated is the last word when it is
+    the prefix of so many words that only the most frequent ones were
+    searched (see MAX_PREFIX_TERMS), else None.
+    The cheapest word drives the lookup, so a query reads about as many
+    postings as it needs for the page and the bounded count.
+    """
+    groups, truncated = _term_groups(conn, query)
+    if not groups or not all(groups):
+        return [], 0, truncated
+    driver = min(groups, key=_driver_cost)
+    others = sorted((rows for rows in groups if rows is not driver), key=_driver_cost)
+
+    docs = _matching_docs(conn, driver, others, max(offset + limit, COUNT_LIMIT + 1))
+    page = docs[offset:offset + limit]
+    names = dict(conn.execute(f"SELECT id, name FROM docs WHERE id IN ({', '.join('?' * len(page))})", page))
+    return [names[doc] for doc in page], len(docs), truncated
+
+
+def find(data_dir, query, offset=0, limit=20):
+    """
+    Sync the index of data_dir with its store and search it; see search().
+    """
+    with storage.open_store(data_dir) as store:
+        conn = open_index(data_dir)
+        try:
+            sync(conn, store)
+            return search(conn, query, offset, limit)
+        finally:
+            conn.close()
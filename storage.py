@@ -0,0 +1,913 @@
+#!/usr/bin/env python3
+"""
+Storage backends for the user data records.
+
+"files" keeps one pretty-printed JSON file per record in the data directory
+(the original layout), listed through the catalog (see catalog.py).
+
+"segments" appends records to segment files instead: records are spread over
+SHARD_COUNT shards by name, each shard appending to its current segment until
+it reaches SEGMENT_MAX_SIZE. Every record is compressed on its own (zstd when
+the zstandard package is installed, else zlib) and found through an offset
+index in SQLite, which also holds the meta fields for listing. Overwritten and
+deleted records leave dead bytes behind; segments that are mostly dead are
+rewritten by a background compaction. Records too large to hold in memory
+are kept as separate files, so they can still be read as a stream.
+
+Both backends have the same interface; open_store() picks one:
+
+    with storage.open_store(DATA_DIR) as store:
+        for name in store.list_names():
+            record = store.read(name)
+"""
+
+import json
+import os
+import struct
+import threading
+import zlib
+
+import catalog
+import json_stream
+
+# Backend of the data directory: "files" or "segments". Without the
+# APP_STORAGE environment variable, a directory holding a segment store
+# uses "segments" and any other directory "files".
+STORAGE_ENV = "APP_STORAGE"
+STORAGE_BACKENDS = ("files", "segments")
+
+# Subdirectory of the data directory holding the segment store
+STORE_DIR = "store"
+
+# A migration to segments builds the store under this suffix and renames it
+# into place when complete; a migration to files retires the store under the
+# other one before removing it
+STAGED_SUFFIX = ".migrating"
+RETIRED_SUFFIX = ".retired"
+
+# Number of shards records are spread over by name
+SHARD_COUNT = 16
+
+# A shard starts a new segment once its current one reaches this size
+SEGMENT_MAX_SIZE = 64 * 1024 * 1024
+
+# Compression of new records: "zstd", "zlib" or "none".
+# Override with the APP_STORAGE_COMPRESSION environment variable;
+# zstd falls back to zlib when the zstandard package is not installed.
+STORAGE_COMPRESSION = os.environ.get("APP_STORAGE_COMPRESSION", "zstd")
+
+# A segment is compacted once this share of its bytes is dead...
+COMPACTION_THRESHOLD = 0.5
+
+# ...and the dead bytes amount to at least this much
+COMPACTION_MIN_BYTES = 1024 * 1024
+
+# Records larger than this (as JSON) are stored as separate files
+LARGE_RECORD_SIZE = json_stream.LARGE_FILE_THRESHOLD
+
+# Record header in a segment: CRC-32 of name and payload, payload length,
+# name length, codec
+_HEADER = struct.Struct('<IIHB')
+_CODECS = {"none": 0, "zlib": 1, "zstd": 2}
+
+_SEGMENT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    segment INTEGER,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    meta TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_by_location ON files (segment, offset);
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    shard INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    dead INTEGER NOT NULL DEFAULT 0,
+    sealed INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# The zstandard module once looked up; False if it is not installed
+_zstd = None
+
+# Background compaction thread (see start_compaction)
+_compaction_thread = None
+_compaction_lock = threading.Lock()
+
+
+def fsync_dir(dir_path):
+    """
+    Flush a directory entry change (create/rename) to disk.
+    Not supported on Windows, where the rename itself is durable enough.
+    """
+    if os.name == 'nt':
+        return
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_json_atomic(filepath, data, keep_previous=False, sync_dir=True):
+    """
+    Crash-safe JSON write: the data goes to a temporary file in the same
+    directory, is fsynced, then replaces filepath with os.replace, so the
+    file is always either the old or the new complete version.
+    keep_previous keeps the replaced version as <filepath>.bak.
+    sync_dir=False skips the directory fsync (see FileStore.write_many).
+    """
+    import tempfile
+
+    dir_path = os.path.dirname(filepath) or '.'
+    fd, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(filepath)}.", suffix=".tmp", dir=dir_path)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if keep_previous and os.path.exists(filepath):
+            # Hard-link the old version aside; no bytes are copied
+            backup_temp = f"{temp_path}.bak"
+            try:
+                os.link(filepath, backup_temp)
+            except OSError:
+                import shutil
+                shutil.copy2(filepath, backup_temp)
+            os.replace(backup_temp, f"{filepath}.bak")
+
+        # mkstemp creates the file private (0600); keep the usual mode
+        try:
+            mode = os.stat(filepath).st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, filepath)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    if sync_dir:
+        fsync_dir(dir_path)
+
+
+def link_or_copy(source_path, destination_path):
+    """
+    Hard-link a file to a new path, or copy it (and flush the copy) where
+    linking is not possible. destination_path must not exist.
+    """
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        import shutil
+        shutil.copyfile(source_path, destination_path)
+        with open(destination_path, 'rb+') as f:
+            os.fsync(f.fileno())
+
+
+def meta_of(record):
+    """
+    Return the meta fields of a record: everything except "content".
+    """
+    return {k: v for k, v in record.items() if k != "content"}
+
+
+class FileStore:
+    """
+    One JSON file per record in data_dir, named after the record.
+    """
+
+    backend = "files"
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+    def path(self, name):
+        """Return the file holding a record."""
+        return os.path.join(self.data_dir, name)
+
+    def iter_names(self, query=None):
+        """
+        Yield the record names in directory order, optionally filtered by
+        a picker search query.
+        """
+        with os.scandir(self.data_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json') and entry.is_file() \
+                        and (not query or catalog.name_matches(entry.name, query)):
+                    yield entry.name
+
+    def list_names(self):
+        """Return all record names, sorted."""
+        if not catalog.AVAILABLE:
+            return sorted(self.iter_names())
+        conn = catalog.open_catalog(self.data_dir)
+        try:
+            catalog.refresh_catalog(conn, self.data_dir)
+            return catalog.list_names(conn)
+        finally:
+            conn.close()
+
+    def page(self, offset, limit, query=None):
+        """
+        Return (names, total) for limit names from offset among those matching
+        query: from the sorted catalog, or, without sqlite3, from a lazy scan
+        in directory order.
+        """
+        import itertools
+
+        if not catalog.AVAILABLE:
+            total = sum(1 for _ in self.iter_names(query))
+            return list(itertools.islice(self.iter_names(query), offset, offset + limit)), total
+        conn = catalog.open_catalog(self.data_dir)
+        try:
+            catalog.refresh_catalog(conn, self.data_dir)
+            return catalog.page_names(conn, offset, limit, query), catalog.count_names(conn, query)
+        finally:
+            conn.close()
+
+    def exists(self, name):
+        return os.path.isfile(self.path(name))
+
+    def size(self, name):
+        """Return the size of a record in bytes. Raises FileNotFoundError."""
+        return os.path.getsize(self.path(name))
+
+    def read(self, name):
+        """
+        Return a record. Raises FileNotFoundError, or ValueError if it is not
+        a JSON object.
+        """
+        with open(self.path(name), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("не е JSON обект")
+        return data
+
+    def meta(self, name):
+        """
+        Return the meta fields of a record from the catalog, without parsing
+        the file unless it changed since it was catalogued.
+        """
+        if not catalog.AVAILABLE:
+            return meta_of(self.read(name))
+        conn = catalog.open_catalog(self.data_dir)
+        try:
+            return catalog.get_meta(conn, self.data_dir, name) or {}
+        finally:
+            conn.close()
+
+    def version(self):
+        """
+        Return a token that changes whenever records are added, replaced or
+        removed: the directory mtime (atomic writes rename into it).
+        """
+        return os.stat(self.data_dir).st_mtime_ns
+
+    def stamps(self):
+        """Return {name: stamp} for every record; a record's stamp changes when it is rewritten."""
+        stamps = {}
+        with os.scandir(self.data_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json') and entry.is_file():
+                    stat_result = entry.stat()
+                    stamps[entry.name] = f"{stat_result.st_size}:{stat_result.st_mtime_ns}"
+        return stamps
+
+    def stamp(self, name):
+        """Return the stamp of one record (see stamps), or None if it does not exist."""
+        try:
+            stat_result = os.stat(self.path(name))
+        except FileNotFoundError:
+            return None
+        return f"{stat_result.st_size}:{stat_result.st_mtime_ns}"
+
+    def _record_change(self, name):
+        # Keep the catalog current, so the next listing need not rescan
+        if not catalog.AVAILABLE:
+            return
+        conn = catalog.open_catalog(self.data_dir)
+        try:
+            catalog.record_file(conn, self.data_dir, name)
+        finally:
+            conn.close()
+
+    def write(self, name, record, keep_previous=False):
+        """Write one record atomically; keep_previous keeps the old file as .bak."""
+        write_json_atomic(self.path(name), record, keep_previous=keep_previous)
+        self._record_change(name)
+
+    def write_file(self, name, source_path):
+        """
+        Store a record given as a JSON file (see migrate) by linking or
+        copying it into place, without parsing it.
+        """
+        temp_path = os.path.join(self.data_dir, f".{name}.{os.getpid()}.tmp")
+        try:
+            link_or_copy(source_path, temp_path)
+            os.replace(temp_path, self.path(name))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self._record_change(name)
+
+    def write_many(self, records):
+        """
+        Write (name, record) pairs atomically, with one directory fsync for
+        the whole batch instead of one per file. Returns the number written.
+        """
+        count = 0
+        for name, record in records:
+            write_json_atomic(self.path(name), record, sync_dir=False)
+            count += 1
+        fsync_dir(self.data_dir)
+        return count
+
+    def delete(self, names):
+        """Remove records; names that do not exist are ignored."""
+        for name in names:
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+
+
+def _zstandard():
+    """Return the zstandard module, or None if it is not installed."""
+    global _zstd
+    if _zstd is None:
+        try:
+            import zstandard
+            _zstd = zstandard
+        except ImportError:
+            _zstd = False
+    return _zstd or None
+
+
+def compression_codec():
+    """Return the codec new records are written with: "zstd", "zlib" or "none"."""
+    if STORAGE_COMPRESSION == "zstd":
+        return "zstd" if _zstandard() else "zlib"
+    return STORAGE_COMPRESSION if STORAGE_COMPRESSION in _CODECS else "none"
+
+
+def _compress(payload):
+    """Return (codec, data) for a record's JSON bytes; small gains are not worth it."""
+    codec = compression_codec()
+    if codec == "zstd":
+        compressed = _zstandard().ZstdCompressor(level=3).compress(payload)
+    elif codec == "zlib":
+        compressed = zlib.compress(payload, 6)
+    else:
+        return _CODECS["none"], payload
+    if len(compressed) >= len(payload):
+        return _CODECS["none"], payload
+    return _CODECS[codec], compressed
+
+
+def _decompress(codec, data):
+    if codec == _CODECS["none"]:
+        return data
+    if codec == _CODECS["zlib"]:
+        return zlib.decompress(data)
+    if codec == _CODECS["zstd"]:
+        if not _zstandard():
+            raise ValueError("записът е компресиран със zstd, а пакетът zstandard не е инсталиран")
+        return _zstandard().ZstdDecompressor().decompress(data)
+    raise ValueError(f"непознато компресиране {codec}")
+
+
+def encode_record(name, payload):
+    """Return the bytes of a record in a segment: header, name, compressed JSON."""
+    codec, data = _compress(payload)
+    name_bytes = name.encode('utf-8')
+    crc = zlib.crc32(data, zlib.crc32(name_bytes))
+    return _HEADER.pack(crc, len(data), len(name_bytes), codec) + name_bytes + data
+
+
+def decode_record(name, raw):
+    """Return the JSON bytes of a record read from a segment; ValueError if damaged."""
+    if len(raw) < _HEADER.size:
+        raise ValueError("повреден запис")
+    crc, length, name_length, codec = _HEADER.unpack_from(raw)
+    name_bytes = raw[_HEADER.size:_HEADER.size + name_length]
+    data = raw[_HEADER.size + name_length:]
+    if len(data) != length or name_bytes != name.encode('utf-8') \
+            or zlib.crc32(data, zlib.crc32(name_bytes)) != crc:
+        raise ValueError("повреден запис")
+    return _decompress(codec, data)
+
+
+def shard_of(name):
+    """Return the shard a record name belongs to."""
+    return zlib.crc32(name.encode('utf-8')) % SHARD_COUNT
+
+
+class SegmentStore:
+    """
+    Records appended to sharded segment files under data_dir/STORE_DIR,
+    with an SQLite offset index. Writers from several threads or processes
+    are serialized by the index's write transaction, which also makes each
+    batch of appends visible atomically: bytes past a segment's committed
+    size belong to an unfinished write and are overwritten by the next one.
+    """
+
+    backend = "segments"
+
+    def __init__(self, data_dir, store_dir=None):
+        if not catalog.AVAILABLE:
+            raise RuntimeError("Хранилището 'segments' изисква модула sqlite3")
+        self.data_dir = data_dir
+        self.store_dir = store_dir or os.path.join(data_dir, STORE_DIR)
+        os.makedirs(self.store_dir, exist_ok=True)
+        self._conn = catalog.sqlite3.connect(os.path.join(self.store_dir, "index.sqlite"),
+                                             timeout=30, isolation_level=None)
+        self._conn.executescript(_SEGMENT_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def _begin(self):
+        # IMMEDIATE takes the write lock up front: segment sizes read below stay valid
+        self._conn.execute("BEGIN IMMEDIATE")
+
+    def segment_path(self, segment_id, shard):
+        return os.path.join(self.store_dir, f"shard-{shard:02x}", f"{segment_id:08d}.seg")
+
+    def large_path(self, name):
+        return os.path.join(self.store_dir, "large", name)
+
+    def _row(self, name):
+        return self._conn.execute(
+            "SELECT segment, offset, length, size, meta FROM files WHERE name = ?", (name,)).fetchone()
+
+    def path(self, name):
+        """Return the file of a record stored on its own, or None."""
+        row = self._row(name)
+        return self.large_path(name) if row and row[0] is None else None
+
+    def iter_names(self, query=None):
+        """Yield the record names in storage order, for sequential reads."""
+        where, params = catalog.name_filter(self._conn, query)
+        for (name,) in self._conn.execute("SELECT name FROM files" + where + " ORDER BY segment, offset",
+                                          params).fetchall():
+            yield name
+
+    def list_names(self):
+        return catalog.list_names(self._conn)
+
+    def page(self, offset, limit, query=None):
+        return catalog.page_names(self._conn, offset, limit, query), catalog.count_names(self._conn, query)
+
+    def exists(self, name):
+        return self._row(name) is not None
+
+    def size(self, name):
+        row = self._row(name)
+        if row is None:
+            raise FileNotFoundError(name)
+        return row[3]
+
+    def meta(self, name):
+        row = self._row(name)
+        if row is None:
+            raise FileNotFoundError(name)
+        return json.loads(row[4])
+
+    def read_raw(self, name):
+        """Return the JSON bytes of a record. Raises FileNotFoundError or ValueError."""
+        # A compaction may move the record between the lookup and the read
+        for attempt in range(2):
+            row = self._conn.execute("SELECT files.segment, files.offset, files.length, segments.shard "
+                                     "FROM files LEFT JOIN segments ON segments.id = files.segment "
+                                     "WHERE files.name = ?", (name,)).fetchone()
+            if row is None:
+                raise FileNotFoundError(name)
+            segment_id, offset, length, shard = row
+            try:
+                if segment_id is None:
+                    with open(self.large_path(name), 'rb') as f:
+                        return f.read()
+                if shard is None:
+                    raise FileNotFoundError(name)
+                with open(self.segment_path(segment_id, shard), 'rb') as f:
+                    f.seek(offset)
+                    raw = f.read(length)
+                return decode_record(name, raw)
+            except FileNotFoundError:
+                if attempt:
+                    raise
+
+    def read(self, name):
+        data = json.loads(self.read_raw(name).decode('utf-8'))
+        if not isinstance(data, dict):
+            raise ValueError("не е JSON обект")
+        return data
+
+    def _active_segment(self, shard, segments):
+        """
+        Return [segment_id, committed_size, pending_bytes] of the segment a
+        shard appends to, sealing a full one and starting the next.
+        segments caches the entries of the current transaction.
+        """
+        entry = segments.get(shard)
+        if entry and entry[1] + len(entry[2]) < SEGMENT_MAX_SIZE:
+            return entry
+        if entry is None:
+            row = self._conn.execute("SELECT id, size FROM segments WHERE shard = ? AND sealed = 0 "
+                                     "ORDER BY id DESC LIMIT 1", (shard,)).fetchone()
+            if row and row[1] < SEGMENT_MAX_SIZE:
+                entry = segments[shard] = [row[0], row[1], bytearray()]
+                return entry
+            if row:
+                self._conn.execute("UPDATE segments SET sealed = 1 WHERE id = ?", (row[0],))
+        else:
+            self._flush_segment(shard, entry)
+            self._conn.execute("UPDATE segments SET sealed = 1 WHERE id = ?", (entry[0],))
+        segment_id = self._conn.execute("INSERT INTO segments (shard, size) VALUES (?, 0)", (shard,)).lastrowid
+        entry = segments[shard] = [segment_id, 0, bytearray()]
+        return entry
+
+    def _flush_segment(self, shard, entry):
+        """Write a segment's pending bytes at its committed size and fsync them."""
+        segment_id, size, pending = entry
+        if not pending:
+            return
+        path = self.segment_path(segment_id, shard)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            f.seek(size)
+            f.write(pending)
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+        entry[1] = size + len(pending)
+        entry[2] = bytearray()
+        self._conn.execute("UPDATE segments SET size = ? WHERE id = ?", (entry[1], segment_id))
+
+    def _forget(self, name, removed_large):
+        """
+        Count the index entry a record is replacing as dead; a record stored
+        on its own is added to removed_large, to delete once committed.
+        """
+        row = self._conn.execute("SELECT segment, length FROM files WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return
+        if row[0] is None:
+            removed_large.add(name)
+        else:
+            self._conn.execute("UPDATE segments SET dead = dead + ? WHERE id = ?", (row[1], row[0]))
+
+    def _remove_large(self, names):
+        for name in names:
+            try:
+                os.remove(self.large_path(name))
+            except FileNotFoundError:
+                pass
+
+    def write_many(self, records):
+        """
+        Append (name, record) pairs in one transaction: every segment written
+        is fsynced once, then the index is committed. Returns the number written.
+        """
+        count = 0
+        segments = {}
+        removed_large = set()
+        self._begin()
+        try:
+            for name, record in records:
+                payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+                meta = json.dumps(meta_of(record), ensure_ascii=False)
+                self._forget(name, removed_large)
+                if len(payload) > LARGE_RECORD_SIZE:
+                    os.makedirs(os.path.dirname(self.large_path(name)), exist_ok=True)
+                    write_json_atomic(self.large_path(name), record)
+                    removed_large.discard(name)
+                    self._conn.execute("INSERT OR REPLACE INTO files (name, segment, offset, length, size, meta) "
+                                       "VALUES (?, NULL, 0, 0, ?, ?)", (name, len(payload), meta))
+                else:
+                    raw = encode_record(name, payload)
+                    entry = self._active_segment(shard_of(name), segments)
+                    self._conn.execute("INSERT OR REPLACE INTO files (name, segment, offset, length, size, meta) "
+                                       "VALUES (?, ?, ?, ?, ?, ?)",
+                                       (name, entry[0], entry[1] + len(entry[2]), len(raw), len(payload), meta))
+                    entry[2] += raw
+                count += 1
+            for shard, entry in segments.items():
+                self._flush_segment(shard, entry)
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._remove_large(removed_large)
+        self._maybe_compact()
+        return count
+
+    def write_file(self, name, source_path):
+        """
+        Store a record given as a JSON file (see migrate) on its own, linked
+        or copied into place; only its meta fields are read, as a stream.
+        """
+        meta = json_stream.read_meta(source_path)
+        if meta is None:
+            raise ValueError(f"'{name}' не е JSON обект")
+        large_path = self.large_path(name)
+        temp_path = f"{large_path}.{os.getpid()}.tmp"
+        os.makedirs(os.path.dirname(large_path), exist_ok=True)
+        removed_large = set()
+        self._begin()
+        try:
+            self._forget(name, removed_large)
+            link_or_copy(source_path, temp_path)
+            os.replace(temp_path, large_path)
+            removed_large.discard(name)
+            self._conn.execute("INSERT OR REPLACE INTO files (name, segment, offset, length, size, meta) "
+                               "VALUES (?, NULL, 0, 0, ?, ?)",
+                               (name, os.path.getsize(large_path), json.dumps(meta, ensure_ascii=False)))
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._remove_large(removed_large)
+
+    def write(self, name, record, keep_previous=False):
+        """
+        Write one record. keep_previous has no effect: earlier versions stay
+        in their segment until it is compacted.
+        """
+        self.write_many([(name, record)])
+
+    def delete(self, names):
+        """Remove records; names that do not exist are ignored."""
+        removed_large = set()
+        self._begin()
+        try:
+            for name in names:
+                self._forget(name, removed_large)
+                self._conn.execute("DELETE FROM files WHERE name = ?", (name,))
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._remove_large(removed_large)
+        self._maybe_compact()
+
+    def version(self):
+        """
+        Return a token that changes whenever records are added, replaced or
+        removed (or moved by compaction): the mtime of the index, which
+        every committed write changes.
+        """
+        return os.stat(os.path.join(self.store_dir, "index.sqlite")).st_mtime_ns
+
+    def _stamp(self, name, segment, offset, size):
+        if segment is None:
+            # Stored on its own: rewritten in place, so its mtime tells
+            try:
+                offset = os.stat(self.large_path(name)).st_mtime_ns
+            except FileNotFoundError:
+                pass
+        return f"{segment}:{offset}:{size}"
+
+    def stamps(self):
+        """Return {name: stamp} for every record; a record's stamp changes when it is rewritten."""
+        return {name: self._stamp(name, segment, offset, size) for name, segment, offset, size
+                in self._conn.execute("SELECT name, segment, offset, size FROM files").fetchall()}
+
+    def stamp(self, name):
+        """Return the stamp of one record (see stamps), or None if it does not exist."""
+        row = self._row(name)
+        return self._stamp(name, row[0], row[1], row[3]) if row else None
+
+    def compactable_segments(self, threshold=COMPACTION_THRESHOLD, min_bytes=COMPACTION_MIN_BYTES):
+        """Return the ids of segments worth compacting."""
+        return [row[0] for row in self._conn.execute(
+            "SELECT id FROM segments WHERE size > 0 AND dead >= size * ? AND dead >= ?",
+            (threshold, min_bytes))]
+
+    def _maybe_compact(self):
+        if self.compactable_segments():
+            start_compaction(self.data_dir)
+
+    def compact(self, threshold=COMPACTION_THRESHOLD, min_bytes=COMPACTION_MIN_BYTES):
+        """
+        Rewrite the live records of every segment whose dead share exceeds
+        threshold into the shards' current segments, then delete it. Each
+        segment is moved in one transaction, so readers and a crash see
+        either the old or the new location. Returns (segments_removed, bytes_freed).
+        """
+        removed = freed = 0
+        for segment_id in self.compactable_segments(threshold, min_bytes):
+            self._begin()
+            try:
+                row = self._conn.execute("SELECT shard, size FROM segments WHERE id = ?", (segment_id,)).fetchone()
+                if row is None:  # compacted by another process meanwhile
+                    self._conn.execute("COMMIT")
+                    continue
+                shard, size = row
+                # Appends must not go to the segment being emptied
+                self._conn.execute("UPDATE segments SET sealed = 1 WHERE id = ?", (segment_id,))
+                segments = {}
+                live = self._conn.execute("SELECT name, offset, length, size, meta FROM files "
+                                          "WHERE segment = ? ORDER BY offset", (segment_id,)).fetchall()
+                with open(self.segment_path(segment_id, shard), 'rb') as f:
+                    for name, offset, length, record_size, meta in live:
+                        f.seek(offset)
+                        raw = f.read(length)
+                        decode_record(name, raw)  # never carry damaged bytes along
+                        entry = self._active_segment(shard_of(name), segments)
+                        self._conn.execute("UPDATE files SET segment = ?, offset = ? WHERE name = ?",
+                                           (entry[0], entry[1] + len(entry[2]), name))
+                        entry[2] += raw
+                for other_shard, entry in segments.items():
+                    self._flush_segment(other_shard, entry)
+                self._conn.execute("DELETE FROM segments WHERE id = ?", (segment_id,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            os.remove(self.segment_path(segment_id, shard))
+            removed += 1
+            freed += size - sum(length for _, _, length, _, _ in live)
+        return removed, freed
+
+
+def _compaction_worker(data_dir):
+    try:
+        with SegmentStore(data_dir) as store:
+            store.compact()
+    except (OSError, ValueError, catalog.sqlite3.Error):
+        pass  # Compaction only saves space; it is retried after the next write
+
+
+def start_compaction(data_dir):
+    """
+    Compact the segment store of data_dir in a daemon thread, unless a
+    compaction is already running in this process.
+    """
+    global _compaction_thread
+
+    with _compaction_lock:
+        if _compaction_thread is not None and _compaction_thread.is_alive():
+            return _compaction_thread
+        _compaction_thread = threading.Thread(target=_compaction_worker, args=(data_dir,),
+                                              name="storage-compaction", daemon=True)
+        _compaction_thread.start()
+        return _compaction_thread
+
+
+def snapshot_store(data_dir, target_dir, snapshot_file):
+    """
+    Take a consistent snapshot of the segment store of data_dir into
+    target_dir/STORE_DIR: the index is copied with the SQLite backup API
+    inside a read transaction, which holds off writers and compaction, and
+    only the segments and large record files it references are snapshotted
+    with snapshot_file(source, destination); SQLite journals never are.
+    Returns the number of files in the snapshot, 0 without a store.
+    """
+    store_dir = os.path.join(data_dir, STORE_DIR)
+    if not os.path.isfile(os.path.join(store_dir, "index.sqlite")):
+        return 0
+    target_store_dir = os.path.join(target_dir, STORE_DIR)
+    os.makedirs(target_store_dir, exist_ok=True)
+    count = 0
+    with SegmentStore(data_dir) as store:
+        # A read transaction: writers and compaction cannot commit until it ends
+        store._conn.execute("BEGIN")
+        store._conn.execute("SELECT COUNT(*) FROM segments").fetchone()
+        try:
+            snapshot_conn = catalog.sqlite3.connect(os.path.join(target_store_dir, "index.sqlite"))
+            try:
+                store._conn.backup(snapshot_conn)
+            finally:
+                snapshot_conn.close()
+            count += 1
+            # Segments only grow past the size the index records, so a
+            # snapshot of the file holds every byte the copied index references
+            paths = [store.segment_path(segment_id, shard) for segment_id, shard
+                     in store._conn.execute("SELECT id, shard FROM segments")]
+            paths += [store.large_path(name) for (name,)
+                      in store._conn.execute("SELECT name FROM files WHERE segment IS NULL")]
+            for path in paths:
+                if not os.path.exists(path):
+                    continue  # a segment not written to yet
+                destination = os.path.join(target_store_dir, os.path.relpath(path, store_dir))
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                snapshot_file(path, destination)
+                count += 1
+        finally:
+            store._conn.execute("ROLLBACK")
+    return count
+
+
+def detect_backend(data_dir):
+    """
+    Return the backend of data_dir: APP_STORAGE if set, else "segments" for
+    a directory holding a segment store and "files" otherwise.
+    """
+    backend = os.environ.get(STORAGE_ENV, "").strip().lower()
+    if backend in STORAGE_BACKENDS:
+        return backend
+    return "segments" if os.path.isdir(os.path.join(data_dir, STORE_DIR)) else "files"
+
+
+def open_store(data_dir, backend=None):
+    """
+    Open the store of data_dir with the given backend (detected by default).
+    """
+    backend = backend or detect_backend(data_dir)
+    if backend == "segments":
+        return SegmentStore(data_dir)
+    return FileStore(data_dir)
+
+
+def migrate(data_dir, target, batch_size=500, progress=None):
+    """
+    Move every record of data_dir into the target backend ("files" or
+    "segments"), copying them in batches. The detected backend switches
+    only once every record is copied: a new segment store is built beside
+    the live data and renamed into place, and a store being left is renamed
+    away before it is removed. Records are then removed from the source.
+    A record that already exists in a live destination is never overwritten,
+    so an interrupted migration can simply be run again. progress(done) is
+    called after each batch. Returns the number of records moved.
+    """
+    import shutil
+
+    store_dir = os.path.join(data_dir, STORE_DIR)
+    staged_dir = store_dir + STAGED_SUFFIX
+    retired_dir = store_dir + RETIRED_SUFFIX
+    # Left over by an interrupted run: a store never switched to, or one already switched from
+    shutil.rmtree(staged_dir, ignore_errors=True)
+    shutil.rmtree(retired_dir, ignore_errors=True)
+
+    if target == "files":
+        if not os.path.isdir(store_dir):
+            return 0
+        # JSON files in data_dir are not live while the store is, so they are overwritten
+        with SegmentStore(data_dir) as source, FileStore(data_dir) as destination:
+            moved = _copy_records(source, destination, list(source.iter_names()), batch_size, progress)
+        os.rename(store_dir, retired_dir)
+        fsync_dir(data_dir)
+        shutil.rmtree(retired_dir, ignore_errors=True)
+        return moved
+
+    with FileStore(data_dir) as source:
+        names = list(source.iter_names())
+        if os.path.isdir(store_dir):
+            # Switched already: copy only what the live store lacks, then drop the leftovers
+            with SegmentStore(data_dir) as destination:
+                missing = [name for name in names if not destination.exists(name)]
+                moved = _copy_records(source, destination, missing, batch_size, progress)
+        else:
+            with SegmentStore(data_dir, staged_dir) as destination:
+                moved = _copy_records(source, destination, names, batch_size, progress)
+            os.rename(staged_dir, store_dir)
+            fsync_dir(data_dir)
+        for start in range(0, len(names), batch_size):
+            source.delete(names[start:start + batch_size])
+    return moved
+
+
+def _copy_records(source, destination, names, batch_size, progress):
+    """
+    Copy the named records from source to destination in batches; returns
+    the number copied. Records too large to load are linked or copied as
+    files and never parsed.
+    """
+    copied = 0
+    for start in range(0, len(names), batch_size):
+        batch = []
+        for name in names[start:start + batch_size]:
+            path = source.path(name)
+            if path and source.size(name) > json_stream.LARGE_FILE_THRESHOLD:
+                destination.write_file(name, path)
+                copied += 1
+            else:
+                batch.append(name)
+        copied += destination.write_many((name, source.read(name)) for name in batch)
+        if progress:
+            progress(copied)
+    return copied
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Inter-process lock serializing update checks and installs.
+The lock is a small file created with O_CREAT | O_EXCL, holding the owner's
+PID and creation time. A lock whose owner process no longer runs, or that
+is older than LOCK_STALE_AFTER seconds, is stale and is broken by the next
+process that wants it, so a crashed update never blocks later ones.
+"""
+
+import json
+import os
+import time
+
+# Seconds after which a lock counts as stale even if its PID is alive
+# (the PID may have been reused). Override with APP_UPDATE_LOCK_STALE.
+LOCK_STALE_AFTER = int(os.environ.get("APP_UPDATE_LOCK_STALE", "1800"))
+
+# Seconds between two looks at a lock held by another process
+LOCK_POLL_INTERVAL = 0.1
+
+# Locks held by this process: {path: token}
+_held = {}
+
+
+def pid_alive(pid):
+    """
+    True if a process with the given PID is running.
+    """
+    if not isinstance(pid, int) or pid <= 0:
+        return False
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows; ask for its exit code
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return kernel32.GetLastError() == 5  # access denied: it exists
+        exit_code = ctypes.c_ulong()
+        try:
+            if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+                return True
+            return exit_code.value == 259  # STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+
+def read_holder(path):
+    """
+    Return the lock file's contents {pid, created_at, token}, {} for a lock
+    that is still being written or is unreadable, or None if there is no lock.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            holder = json.load(f)
+        return holder if isinstance(holder, dict) else {}
+    except FileNotFoundError:
+        return None
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def is_stale(path, holder):
+    """
+    True if the lock described by holder can be broken: its process is gone,
+    or it is older than LOCK_STALE_AFTER. A lock file without contents is
+    judged by its modification time, as its owner may still be writing it.
+    """
+    if holder.get('pid') is not None and not pid_alive(holder.get('pid')):
+        return True
+    created_at = holder.get('created_at')
+    if created_at is None:
+        try:
+            created_at = os.path.getmtime(path)
+        except OSError:
+            return False
+    return time.time() - created_at > LOCK_STALE_AFTER
+
+
+def _break_stale(path, holder):
+    """
+    Remove a stale lock. The lock is first renamed to a name private to this
+    process, so two processes breaking it at once cannot both succeed; if
+    the renamed file turns out to be a newer lock, it is put back.
+    """
+    broken_path = f"{path}.{os.getpid()}.stale"
+    try:
+        os.rename(path, broken_path)
+    except OSError:
+        return
+    if read_holder(broken_path) != holder:
+        try:
+            os.link(broken_path, path)
+        except OSError:
+            pass
+    try:
+        os.remove(broken_path)
+    except OSError:
+        pass
+
+
+def try_acquire(path):
+    """
+    Take the lock if it is free or stale. Returns True if this process now holds it.
+    """
+    token = f"{os.getpid()}-{time.time_ns()}"
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            holder = read_holder(path)
+            if holder is None:
+                continue  # released in the meantime
+            if not is_stale(path, holder):
+                return False
+            _break_stale(path, holder)
+            continue
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({"pid": os.getpid(), "created_at": time.time(), "token": token}, f)
+        _held[path] = token
+        return True
+    return False
+
+
+def acquire(path, timeout=None):
+    """
+    Take the lock, waiting up to timeout seconds (forever for None, not at
+    all for 0). Returns True if this process now holds it.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while not try_acquire(path):
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        time.sleep(LOCK_POLL_INTERVAL)
+    return True
+
+
+def wait_released(path, timeout=None):
+    """
+    Wait until nobody holds the lock (or its holder is stale) without taking
+    it. Returns False if it is still held after timeout seconds.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        holder = read_holder(path)
+        if holder is None or is_stale(path, holder):
+            return True
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        time.sleep(LOCK_POLL_INTERVAL)
+
+
+def release(path):
+    """
+    Release a lock held by this process. A lock this process does not hold
+    (for example one broken as stale and taken over) is left alone.
+    """
+    token = _held.pop(path, None)
+    if token is None:
+        return
+    holder = read_holder(path)
+    if holder and holder.get('token') == token:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -6,13 +6,17 @@ Checks for updates from GitHub and applies them safely.
 
 import json
 import os
-import shutil
-import subprocess
-from urllib.request import urlopen, URLError
-from datetime import datetime
-import zipfile
 import stat
+import threading
 import time
+import instrumentation
+import update_lock
+from launcher import (IN_PLACE_RELEASE, RELEASES_DIR, STAGING_PREFIX, get_active_app_dir, read_pointer,
+                      read_version_data, release_path, switch_release, prune_releases)
+
+# The download and install machinery (urllib, zipfile, hashlib, downloader,
+# object_cache, ...) is imported by the functions that use it, so a launch
+# that applies no update does not load it.
 
 # GitHub repository details (configured for this project)
 GITHUB_REPO_OWNER = "DeyanShahov"    # GitHub username
@@ -25,6 +29,88 @@ VERSION_FILE = "version.json"
 # Add a constant for the ZIP archive URL
 GITHUB_ZIP_URL = f"https://github.com/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/archive/refs/heads/{GIT_BRANCH}.zip"
 
+# Raw file access to the production branch
+GITHUB_RAW_URL = f"https://raw.githubusercontent.com/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/{GIT_BRANCH}"
+
+# Release index: channels, min_supported and per-release download locations
+# (see release.py). One conditional request resolves the target version.
+RELEASE_INDEX_FILE = "release-index.json"
+GITHUB_RELEASE_INDEX_URL = f"{GITHUB_RAW_URL}/{RELEASE_INDEX_FILE}"
+
+# Fallback when no release index is published
+GITHUB_VERSION_URL = f"{GITHUB_RAW_URL}/version.json"
+
+# Release channel followed by this install.
+# Override with the APP_UPDATE_CHANNEL environment variable.
+UPDATE_CHANNEL = os.environ.get("APP_UPDATE_CHANNEL", "stable")
+
+# Prefix of downloaded release archives kept in RELEASES_DIR. An interrupted
+# download leaves <name>.part and its progress file there and resumes later.
+ARCHIVE_PREFIX = ".archive-"
+
+# Per-file content hashes published with each release (see release.py).
+# When present, only the files that differ are downloaded.
+MANIFEST_FILE = "manifest.json"
+GITHUB_MANIFEST_URL = f"{GITHUB_RAW_URL}/{MANIFEST_FILE}"
+
+# Repository files installs do not hold (install.py leaves them out and
+# carries its own copy of this list): not in release manifests, not verified
+DEVELOPMENT_FILES = (
+    '.git',
+    '.gitignore',
+    'install.py',
+    'install.ps1',
+    '__pycache__',
+    'README.md',
+    'AUTO_UPDATE_WORKFLOW.md',
+    'benchmark.py',
+    'release.py',
+    'release-index.json',
+    '*.pyc',
+    '*.pyo',
+    '.vscode',
+    '.idea',
+    '*.log',
+)
+
+# Seconds before a metadata request is abandoned
+HTTP_TIMEOUT = 10
+
+# On-disk cache of metadata responses (ETag / Last-Modified validators)
+HTTP_CACHE_FILE = ".update_cache.json"
+
+# Minimum seconds between two network checks of the same URL.
+# Override with the APP_UPDATE_INTERVAL environment variable (0 = always check).
+MIN_RECHECK_INTERVAL = int(os.environ.get("APP_UPDATE_INTERVAL", "600"))
+
+# Last update check and startup decision, kept next to version.json
+UPDATE_STATE_FILE = "update_state.json"
+
+# Lock file guarding the read-modify-write of UPDATE_STATE_FILE, and the
+# seconds a save waits for it before it is skipped
+UPDATE_STATE_LOCK_FILE = "update_state.lock"
+UPDATE_STATE_LOCK_WAIT = 5
+
+# Environment variable forcing the startup policy: "sync", "background" or "skip"
+UPDATE_POLICY_ENV = "APP_UPDATE_CHECK"
+UPDATE_POLICIES = ("sync", "background", "skip")
+
+# Lock file serializing update checks and installs between processes.
+# Only one process checks and applies an update; the others wait for it
+# and reuse its result (see check_for_updates).
+UPDATE_LOCK_FILE = "update.lock"
+
+# Seconds a process waits for another one's update before giving up.
+# Override with the APP_UPDATE_LOCK_WAIT environment variable.
+UPDATE_LOCK_WAIT = int(os.environ.get("APP_UPDATE_LOCK_WAIT", "120"))
+
+# What verify_install reports for each kind of mismatch
+VERIFY_PROBLEMS = {"missing": "липсва", "size": "различен размер", "hash": "различно съдържание"}
+
+# State of the background update check (see start_background_check)
+_background_thread = None
+_pending_update = None
+
 def remove_readonly(func, path, _):
     """Clear the readonly bit and reattempt the removal on Windows."""
     try:
@@ -37,63 +123,380 @@ def get_current_version():
     """
     Get current version from version file or return default.
     """
-    if os.path.exists(VERSION_FILE):
-        try:
-            with open(VERSION_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data.get('version', '0.0.0'), data.get('commit_sha', '')
-        except (json.JSONDecodeError, FileNotFoundError):
-            pass
-    return '0.0.0', ''
+    data = read_version_data()
+    if data is None:
+        return '0.0.0', ''
+    return data.get('version', '0.0.0'), data.get('commit_sha', '')
+
+
+def load_update_state():
+    """
+    Load the persisted update state: last_check_at, pending_version and
+    the last startup decision.
+    """
+    try:
+        with open(UPDATE_STATE_FILE, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def save_update_state(**changes):
+    """
+    Merge changes into the update state and write it atomically.
+    The state is re-read and written under UPDATE_STATE_LOCK_FILE, so
+    concurrent saves from other processes or threads are not lost.
+    Failures are ignored: the state only saves work.
+    """
+    if not update_lock.acquire(UPDATE_STATE_LOCK_FILE, UPDATE_STATE_LOCK_WAIT):
+        return
+    temp_path = f"{UPDATE_STATE_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        state = load_update_state()
+        state.update(changes)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2)
+        os.replace(temp_path, UPDATE_STATE_FILE)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    finally:
+        update_lock.release(UPDATE_STATE_LOCK_FILE)
+
+
+def decide_update_policy(run_mode):
+    """
+    Decide how this launch checks for updates: "sync", "background" or "skip".
+    run_mode is "interactive" (menu on a terminal) or "batch" (commands,
+    scripted input). The APP_UPDATE_CHECK environment variable wins;
+    batch runs skip; interactive runs apply an update below whose
+    min_supported version this install runs right away, skip while the last
+    check is younger than MIN_RECHECK_INTERVAL, retry a found-but-unapplied
+    update synchronously, and otherwise check in the background.
+    The decision is persisted with the update state.
+    Returns (decision, reason).
+    """
+    now = time.time()
+    state = load_update_state()
+    override = os.environ.get(UPDATE_POLICY_ENV, "").strip().lower()
+
+    if override in UPDATE_POLICIES:
+        decision, reason = override, "env"
+    elif run_mode == "batch":
+        decision, reason = "skip", "batch"
+    elif state.get('pending_required'):
+        decision, reason = "sync", "required"
+    elif now - state.get('last_check_at', 0) < MIN_RECHECK_INTERVAL:
+        decision, reason = "skip", "recent"
+    elif state.get('pending_version'):
+        decision, reason = "sync", "pending"
+    else:
+        decision, reason = "background", "due"
+
+    save_update_state(last_decision=decision, last_decision_reason=reason,
+                      last_run_mode=run_mode, decided_at=now)
+    return decision, reason
+
+
+def load_http_cache():
+    """
+    Load the metadata cache: {url: {etag, last_modified, checked_at, data}}.
+    """
+    try:
+        with open(HTTP_CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def save_http_cache(cache):
+    """
+    Write the metadata cache atomically; failures only cost a refetch.
+    """
+    temp_path = f"{HTTP_CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, separators=(',', ':'))
+        os.replace(temp_path, HTTP_CACHE_FILE)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+@instrumentation.traced("update.fetch")
+def fetch_json_cached(url, cache, extract=None, offline=False, missing_ok=False):
+    """
+    Fetch and parse a JSON document through the metadata cache.
+    Within MIN_RECHECK_INTERVAL of the last check the cached data is returned
+    without a request. Otherwise a conditional request is sent and a
+    304 Not Modified reuses the cached data without parsing anything.
+    extract reduces the parsed document to what is worth caching.
+    offline returns the cached data whatever its age, or None if there is none.
+    missing_ok caches a 404 Not Found like a document, returning None for it.
+    """
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+    now = time.time()
+    entry = cache.get(url)
+    instrumentation.annotate("url", url)
+    if entry and (offline or now - entry.get('checked_at', 0) < MIN_RECHECK_INTERVAL):
+        instrumentation.annotate("source", "cache")
+        return entry['data']
+    if offline:
+        return None
+
+    request = Request(url)
+    if entry and entry.get('etag'):
+        request.add_header('If-None-Match', entry['etag'])
+    if entry and entry.get('last_modified'):
+        request.add_header('If-Modified-Since', entry['last_modified'])
+
+    instrumentation.add("http_requests")
+    try:
+        with urlopen(request, timeout=HTTP_TIMEOUT) as response:
+            body = response.read()
+            instrumentation.add("bytes_downloaded", len(body))
+            instrumentation.annotate("source", "network")
+            data = json.loads(body.decode('utf-8'))
+            if extract:
+                data = extract(data)
+            cache[url] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'checked_at': now,
+                'data': data,
+            }
+    except HTTPError as e:
+        if e.code == 404 and missing_ok:
+            instrumentation.annotate("source", "not_found")
+            cache[url] = {'checked_at': now, 'data': None}
+            return None
+        if e.code != 304 or not entry:
+            raise
+        instrumentation.annotate("source", "not_modified")
+        entry['checked_at'] = now
+    return cache[url]['data']
+
+
+def version_key(version):
+    """
+    Return a sort key for a semantic version ("1.2.3", "v1.2", "1.3.0-beta.2+build").
+    Missing components count as 0, a pre-release sorts before its release,
+    and build metadata is ignored. Raises ValueError for other strings.
+    """
+    text = str(version).strip()
+    if text[:1] in ('v', 'V'):
+        text = text[1:]
+    text = text.split('+', 1)[0]
+    core, _, prerelease = text.partition('-')
+    numbers = core.split('.')
+    if not 1 <= len(numbers) <= 3 or not all(n.isdigit() for n in numbers):
+        raise ValueError(f"Invalid version: {version!r}")
+    numbers = [int(n) for n in numbers] + [0] * (3 - len(numbers))
+    if not prerelease:
+        return (*numbers, (1,))
+    # Numeric identifiers sort numerically and before alphanumeric ones
+    identifiers = tuple((0, int(part), '') if part.isdigit() else (1, 0, part)
+                        for part in prerelease.split('.'))
+    return (*numbers, (0, identifiers))
+
+
+def is_newer_version(candidate, current):
+    """
+    True if candidate is a later version than current. An unparseable
+    candidate is never newer; an unparseable current version is always older.
+    """
+    try:
+        candidate_key = version_key(candidate)
+    except ValueError:
+        return False
+    try:
+        return candidate_key > version_key(current)
+    except ValueError:
+        return True
 
 
-def get_latest_github_version():
+def is_wanted_update(candidate, current):
     """
-    Fetch latest version from GitHub API.
-    Returns tuple (version, commit_sha, version_json_content) or None if error.
+    True if candidate is a later version than current and than the version
+    a rollback left (the pointer's "skipped"), so a rollback sticks until
+    a newer release is published.
     """
+    skipped = read_pointer().get('skipped')
+    if skipped and skipped != IN_PLACE_RELEASE and not is_newer_version(candidate, skipped):
+        return False
+    return is_newer_version(candidate, current)
+
+
+def resolve_release(index, channel):
+    """
+    Pick the release a channel points to from a release index document:
+    {"channels": {name: version}, "min_supported": version,
+     "releases": {version: {version.json fields, archive_url, manifest_url, files_url}}}
+    Returns the release data (with min_supported added), or None.
+    """
+    version = index.get('channels', {}).get(channel)
+    release = index.get('releases', {}).get(version) if version else None
+    if not isinstance(release, dict):
+        return None
+    release = dict(release, version=version)
+    if index.get('min_supported'):
+        release['min_supported'] = index['min_supported']
+    return release
+
+
+def compact_release_index(index):
+    """
+    Reduce a release index to what resolving a channel needs: the channels,
+    min_supported and the releases the channels point to. This is the form
+    kept in the metadata cache, so it does not grow with the release history.
+    """
+    channels = index.get('channels', {})
+    releases = index.get('releases', {})
+    return {
+        'channels': channels,
+        'min_supported': index.get('min_supported'),
+        'releases': {version: releases[version] for version in set(channels.values())
+                     if version in releases},
+    }
+
+
+@instrumentation.traced("update.resolve")
+def get_latest_github_version(verbose=True, offline=False):
+    """
+    Resolve the release of UPDATE_CHANNEL with one conditional request for
+    the release index; falls back to version.json when none is published
+    (a 404 that is cached like the documents themselves).
+    offline resolves from the metadata cache only, without any request
+    (used to reuse the result of a check another process just made).
+    Returns tuple (version, version_data) or None if error.
+    Errors are printed only when verbose is True.
+    """
+    from urllib.error import URLError
+
+    if not offline:
+        save_update_state(last_check_at=time.time())
+    cache = load_http_cache()
     try:
-        # Get latest commit SHA for the branch
-        commit_url = f"https://api.github.com/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/commits/{GIT_BRANCH}"
-        with urlopen(commit_url) as response:
-            commit_data = json.loads(response.read().decode('utf-8'))
-            latest_commit_sha = commit_data['sha']
+        # A missing index is cached too, so within MIN_RECHECK_INTERVAL
+        # neither document is requested again
+        index = fetch_json_cached(GITHUB_RELEASE_INDEX_URL, cache, extract=compact_release_index,
+                                  offline=offline, missing_ok=True)
 
-        # Get version.json content from GitHub
-        version_json_url = f"https://raw.githubusercontent.com/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/{GIT_BRANCH}/version.json"
-        with urlopen(version_json_url) as response:
-            github_version_data = json.loads(response.read().decode('utf-8'))
-            github_version = github_version_data.get('version', '0.0.0')
+        if index is not None:
+            github_version_data = resolve_release(index, UPDATE_CHANNEL)
+            if github_version_data is None:
+                raise KeyError(f"channel '{UPDATE_CHANNEL}'")
+        else:
+            github_version_data = fetch_json_cached(GITHUB_VERSION_URL, cache, offline=offline)
+            if github_version_data is None:
+                raise KeyError("no cached release metadata")
+        github_version = github_version_data.get('version', '0.0.0')
 
-        return github_version, latest_commit_sha, github_version_data
-    except (URLError, KeyError, json.JSONDecodeError) as e:
-        print(f"Error checking for updates: {e}")
+        return github_version, github_version_data
+    except (URLError, OSError, KeyError, json.JSONDecodeError) as e:
+        if verbose:
+            print(f"Error checking for updates: {e}")
         return None
+    finally:
+        if not offline:
+            save_http_cache(cache)
+
+
+def update_required(current_version, github_version_data):
+    """
+    True if the running version is below the release's min_supported.
+    """
+    min_supported = github_version_data.get('min_supported')
+    return bool(min_supported) and is_newer_version(min_supported, current_version)
 
 
 from utils import DATA_DIR # Import DATA_DIR
+from storage import STORE_DIR
+
+# ioctl request that clones a file's extents (reflink) on Linux btrfs/XFS
+FICLONE = 0x40049409
+
+
+def snapshot_file(src_path, dst_path):
+    """
+    Make dst_path a snapshot of src_path without copying bytes when possible:
+    a hard link, else a reflink (copy-on-write clone), else a plain copy.
+    """
+    try:
+        os.link(src_path, dst_path)
+        return
+    except OSError:
+        pass
+
+    try:
+        import fcntl
+        with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        import shutil
+        shutil.copystat(src_path, dst_path)
+        return
+    except (ImportError, OSError):
+        pass
+
+    import shutil
+    shutil.copy2(src_path, dst_path)
 
+
+def iter_user_data_files(root, include_store=True):
+    """
+    Yield the paths, relative to root, of the user data files in root: the
+    JSON files of the "files" storage backend and, with include_store,
+    everything in the segment store (see storage.py) but SQLite journals.
+    """
+    for entry in os.scandir(root):
+        if entry.name.endswith('.json') and entry.is_file():
+            yield entry.name
+    if not include_store:
+        return
+    store_root = os.path.join(root, STORE_DIR)
+    for dir_path, _, file_names in os.walk(store_root):
+        for file_name in file_names:
+            if not file_name.endswith(("-journal", "-wal", "-shm")):
+                yield os.path.relpath(os.path.join(dir_path, file_name), root)
+
+
+@instrumentation.traced("update.backup")
 def backup_user_data():
     """
-    Backup all JSON files (user data) from DATA_DIR before update.
+    Snapshot all user data files from DATA_DIR before update.
+    Files are hard-linked (or reflinked) into the backup directory, so the
+    backup costs metadata only; updates never write into DATA_DIR.
+    The segment store is snapshotted as a consistent whole (see
+    storage.snapshot_store).
     """
-    backup_dir = f"backup_{int(datetime.now().timestamp())}"
+    import storage
+
+    backup_dir = f"backup_{int(time.time())}_{os.getpid()}"
     os.makedirs(backup_dir, exist_ok=True)
 
+    count = 0
     if os.path.exists(DATA_DIR):
-        json_files = [f for f in os.listdir(DATA_DIR) if f.endswith('.json')]
-        for file in json_files:
-            src_path = os.path.join(DATA_DIR, file)
-            dst_path = os.path.join(backup_dir, file)
-            shutil.copy2(src_path, dst_path)
-            print(f"Backup: {src_path}")
+        for relative_path in iter_user_data_files(DATA_DIR, include_store=False):
+            snapshot_file(os.path.join(DATA_DIR, relative_path), os.path.join(backup_dir, relative_path))
+            count += 1
+        count += storage.snapshot_store(DATA_DIR, backup_dir, snapshot_file)
+    instrumentation.add("files_snapshotted", count)
+    print(f"Backup: {count} файла от '{DATA_DIR}'.")
 
     return backup_dir
 
 
+@instrumentation.traced("update.restore")
 def restore_user_data(backup_dir):
     """
-    Restore JSON files to DATA_DIR after update.
+    Restore the user data files to DATA_DIR after update.
+    Only missing files are recreated; files that exist are left as they
+    are, even if they changed since the backup.
+    The segment store is restored only as a whole, when DATA_DIR has no
+    store index: its files are never mixed with those of a live store.
     """
     if not os.path.exists(backup_dir):
         return
@@ -101,109 +504,669 @@ def restore_user_data(backup_dir):
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
 
-    for file in os.listdir(backup_dir):
-        if file.endswith('.json'):
-            src = os.path.join(backup_dir, file)
-            dst = os.path.join(DATA_DIR, file)
-            shutil.copy2(src, dst)
-            print(f"Restored: {dst}")
+    restore_store = not os.path.exists(os.path.join(DATA_DIR, STORE_DIR, "index.sqlite"))
+    # The store index last: a store is only complete once it is in place
+    paths = sorted(iter_user_data_files(backup_dir, include_store=restore_store),
+                   key=lambda path: path == os.path.join(STORE_DIR, "index.sqlite"))
+    restored = 0
+    for relative_path in paths:
+        src = os.path.join(backup_dir, relative_path)
+        dst = os.path.join(DATA_DIR, relative_path)
+        if os.path.exists(dst):
+            continue  # never overwrite data written since the backup
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        temp_path = f"{dst}.restore-tmp"
+        snapshot_file(src, temp_path)
+        os.replace(temp_path, dst)
+        restored += 1
+        instrumentation.add("files_restored")
+        print(f"Restored: {dst}")
+    print(f"Възстановени файлове: {restored}.")
 
     # Optionally remove backup after successful restore
+    import shutil
     shutil.rmtree(backup_dir, onerror=remove_readonly)
     print("Backup directory removed.")
 
 
+def file_sha256(path):
+    """
+    Return the hex SHA-256 of a file, or None if it cannot be read.
+    """
+    import hashlib
+
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def get_release_manifest(url=None):
+    """
+    Fetch the release manifest: {"version": ..., "files": {path: {"sha256", "size"}}}.
+    url defaults to the manifest on the production branch.
+    Returns None if the release does not publish one or it cannot be read.
+    """
+    from urllib.error import URLError
+    from urllib.request import urlopen
+
+    try:
+        with urlopen(url or GITHUB_MANIFEST_URL, timeout=HTTP_TIMEOUT) as response:
+            manifest = json.loads(response.read().decode('utf-8'))
+        if not isinstance(manifest.get('files'), dict):
+            return None
+        return manifest
+    except (URLError, OSError, json.JSONDecodeError, AttributeError):
+        return None
+
+
+def is_user_path(path):
+    """
+    True for paths an update must never overwrite (user data, local version file).
+    """
+    top_level = path.replace('\\', '/').split('/', 1)[0]
+    return top_level == DATA_DIR or path == VERSION_FILE
+
+
+def is_development_path(path):
+    """
+    True if a '/'-separated release path is not needed by end users.
+    """
+    import fnmatch
+
+    parts = path.split('/')
+    return any(fnmatch.fnmatch(parts[0], pattern)
+               or ('*' in pattern and fnmatch.fnmatch(parts[-1], pattern))
+               for pattern in DEVELOPMENT_FILES)
+
+
+def is_safe_relative_path(path):
+    """
+    True if a '/'-separated release path stays inside the app directory.
+    """
+    return bool(path) and not path.startswith('/') and '..' not in path.split('/') \
+        and not os.path.splitdrive(path)[0]
+
+
+def link_or_copy(source_path, destination_path):
+    """
+    Hard-link a file into place, falling back to a copy across filesystems.
+    Updates always replace files (never write into them), so a shared inode
+    is never modified through the new release.
+    """
+    parent = os.path.dirname(destination_path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        import shutil
+        shutil.copy2(source_path, destination_path)
+
+
+@instrumentation.traced("update.delta")
+def apply_delta_update(manifest, target_dir='.', source_dir='.', files_url=None):
+    """
+    Bring target_dir to the manifest, fetching only the files whose hash
+    differs from the installed copy in source_dir; unchanged files are
+    linked over from source_dir when the two differ.
+    Changed files come from the machine-wide object cache (see
+    object_cache.py), which downloads only the blobs it does not hold yet,
+    from files_url (the production branch by default).
+    Every changed file is fetched and verified first, then all of them are
+    moved into place, so a failed download leaves the install untouched.
+    Returns True on success.
+    """
+    from urllib.error import URLError
+    from urllib.parse import quote
+    import object_cache
+
+    changed = []
+    for path, info in release_files(manifest).items():
+        source_path = os.path.join(source_dir, *path.split('/'))
+        local_path = os.path.join(target_dir, *path.split('/'))
+        if os.path.isfile(source_path) and os.path.getsize(source_path) == info.get('size') \
+                and file_sha256(source_path) == info['sha256']:
+            if os.path.abspath(source_path) != os.path.abspath(local_path):
+                link_or_copy(source_path, local_path)
+            continue
+        changed.append((path, local_path, info['sha256']))
+
+    staged = []
+    downloaded_bytes = cached_files = 0
+    try:
+        for path, local_path, expected_sha in changed:
+            blob_path, downloaded = object_cache.fetch(expected_sha, f"{files_url or GITHUB_RAW_URL}/{quote(path)}")
+            downloaded_bytes += downloaded
+            instrumentation.add("bytes_downloaded", downloaded)
+            instrumentation.add("files_downloaded" if downloaded else "files_from_cache")
+            if not downloaded:
+                cached_files += 1
+
+            temp_path = f"{local_path}.update-tmp"
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            link_or_copy(blob_path, temp_path)
+            staged.append((temp_path, local_path))
+
+        for temp_path, local_path in staged:
+            os.replace(temp_path, local_path)
+            print(f"Обновен файл: {os.path.relpath(local_path, target_dir)}")
+        staged = []
+    except ValueError as e:
+        print(f"{e}.")
+        return False
+    except (URLError, OSError) as e:
+        print(f"Грешка при изтегляне на променените файлове: {e}")
+        return False
+    finally:
+        for temp_path, _ in staged:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    print(f"Изтеглени {len(changed) - cached_files} променени файла ({downloaded_bytes} байта), "
+          f"от локалния кеш: {cached_files}.")
+    return True
+
+
+def write_local_version(github_version_data, manifest=None, target_dir='.'):
+    """
+    Record the applied release in its version.json (and manifest.json).
+    Written through a temporary file, as the old file may be a hard link
+    shared with the previous release.
+    """
+    documents = [(VERSION_FILE, github_version_data)]
+    if manifest is not None:
+        documents.append((MANIFEST_FILE, manifest))
+    for file_name, data in documents:
+        path = os.path.join(target_dir, file_name)
+        with open(f"{path}.update-tmp", 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        os.replace(f"{path}.update-tmp", path)
+    print("Локалният version.json е обновен.")
+
+
+@instrumentation.traced("update.install")
 def download_and_apply_update(github_version_data):
     """
-    Downloads the latest production branch as a ZIP, extracts it,
-    and applies the update, preserving user data.
+    Install the latest production release into a fresh releases/<version>/
+    directory and activate it with one atomic pointer switch, so a crash
+    never leaves a mixed install. Uses the release manifest to fetch only
+    changed files and falls back to the full ZIP archive when no manifest
+    is published. Unchanged files are hard-linked from the active release.
+    A release already installed and intact is activated as it is.
+    """
+    import shutil
+    import object_cache
+
+    version = str(github_version_data.get('version', ''))
+    if not is_safe_relative_path(version) or '/' in version or version.startswith('.'):
+        print(f"Невалиден номер на версия: '{version}'")
+        return False
+
+    # Installed before (the release a rollback left): switch back to it if intact
+    release_dir = release_path(version)
+    if os.path.isfile(os.path.join(release_dir, "main.py")) \
+            and str((read_version_data(release_dir) or {}).get('version')) == version \
+            and load_local_manifest(release_dir) is not None and not verify_release_files(release_dir):
+        switch_release(version)
+        print(f"Активирана е вече инсталираната версия {version}.")
+        return True
+
+    source_dir = get_active_app_dir()
+    staging_dir = os.path.join(RELEASES_DIR, f"{STAGING_PREFIX}{version}-{os.getpid()}")
+    try:
+        os.makedirs(staging_dir)
+
+        manifest = get_release_manifest(github_version_data.get('manifest_url'))
+        applied = False
+        if manifest:
+            print("Изтегляне само на променените файлове...")
+            applied = apply_delta_update(manifest, staging_dir, source_dir,
+                                         github_version_data.get('files_url'))
+            if not applied:
+                print("Частичното обновяване не успя. Изтегляне на целия архив...")
+                shutil.rmtree(staging_dir, onerror=remove_readonly)
+                os.makedirs(staging_dir)
+                manifest = None
+        if not applied and not apply_full_update(staging_dir, source_dir, github_version_data):
+            return False
+        write_local_version(github_version_data, manifest, staging_dir)
+
+        # Never activate a partial or damaged copy
+        bad = verify_release_files(staging_dir, seed_dir=source_dir)
+        if bad:
+            print(f"Проверката на новата версия не успя: {len(bad)} файла не съвпадат с манифеста "
+                  f"({', '.join(sorted(bad)[:5])}).")
+            return False
+
+        # Activate: move the complete release into place, then flip the pointer
+        if os.path.exists(release_dir):
+            shutil.rmtree(release_dir, onerror=remove_readonly)
+        os.rename(staging_dir, release_dir)
+        switch_release(version)
+        print(f"Активирана е версия {version}.")
+
+        for name in prune_releases():
+            print(f"Премахната стара версия: {name}")
+        # Blobs only the pruned releases used are now candidates for eviction
+        try:
+            object_cache.evict()
+        except OSError:
+            pass
+        return True
+    except OSError as e:
+        print(f"Грешка при инсталиране на новата версия: {e}")
+        return False
+    finally:
+        if os.path.exists(staging_dir):
+            shutil.rmtree(staging_dir, onerror=remove_readonly)
+
+
+def load_local_manifest(app_dir):
+    """
+    Return the manifest.json installed with the release in app_dir, or None.
+    """
+    try:
+        with open(os.path.join(app_dir, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if isinstance(manifest, dict) and isinstance(manifest.get('files'), dict):
+            return manifest
+    except (OSError, json.JSONDecodeError):
+        pass
+    return None
+
+
+def release_files(manifest):
+    """
+    Return {path: {"sha256", "size"}} of the manifest entries an install
+    holds: not the manifest itself, user data, development files (listed
+    by releases made before they were left out) or unsafe paths.
+    """
+    return {path: info for path, info in manifest['files'].items()
+            if path != MANIFEST_FILE and not is_user_path(path) and not is_development_path(path)
+            and is_safe_relative_path(path) and isinstance(info, dict) and 'sha256' in info}
+
+
+def verify_release_files(app_dir, manifest=None, workers=None, seed_dir=None):
+    """
+    Check the files of app_dir against its manifest (the installed one by
+    default). seed_dir names a release whose hash cache app_dir may start
+    from (see integrity.check_files). Returns {path: "missing" | "size" | "hash"} for the files that
+    do not match; empty when all match or there is no manifest to check.
+    """
+    import integrity
+
+    manifest = manifest or load_local_manifest(app_dir)
+    if manifest is None:
+        return {}
+    with instrumentation.span("update.verify", app_dir=app_dir):
+        bad, stats = integrity.check_files(app_dir, release_files(manifest), workers, seed_dir)
+        instrumentation.add("files_hashed", stats["hashed"])
+    return bad
+
+
+def repair_release_files(app_dir, manifest, paths, files_url=None):
+    """
+    Replace the given files of app_dir with the manifest's versions: from
+    the object cache when it holds the blob (re-hashed first, as a damaged
+    installed file may share its inode), else downloaded and verified.
+    Returns the paths that could not be repaired.
+    """
+    from urllib.error import URLError
+    from urllib.parse import quote
+    import object_cache
+
+    expected = release_files(manifest)
+    failed = []
+    for path in paths:
+        sha256 = expected[path]['sha256']
+        local_path = os.path.join(app_dir, *path.split('/'))
+        temp_path = f"{local_path}.repair-tmp"
+        try:
+            blob_path = object_cache.lookup(sha256)
+            if blob_path and file_sha256(blob_path) != sha256:
+                os.remove(blob_path)
+                blob_path = None
+            if blob_path is None:
+                blob_path, _ = object_cache.fetch(sha256, f"{files_url or GITHUB_RAW_URL}/{quote(path)}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            link_or_copy(blob_path, temp_path)
+            os.replace(temp_path, local_path)
+            print(f"Поправен файл: {path}")
+        except (URLError, OSError, ValueError) as e:
+            print(f"Файлът {path} не може да бъде поправен: {e}")
+            failed.append(path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    return failed
+
+
+def verify_install(repair=False, workers=None):
+    """
+    Check every installed file of the active release against the release
+    manifest and, with repair, replace only the files that do not match.
+    Uses the installed manifest.json, or the published one when it is for
+    the installed version. Returns (paths still not matching, files checked),
+    or None when there is no manifest to check against.
+    """
+    app_dir = get_active_app_dir()
+    version_data = read_version_data(app_dir) or {}
+    manifest = load_local_manifest(app_dir)
+    if manifest is None:
+        published = get_release_manifest(version_data.get('manifest_url'))
+        if published and str(published.get('version')) == str(version_data.get('version')):
+            manifest = published
+    if manifest is None:
+        print("Няма манифест за инсталираната версия; файловете не могат да бъдат проверени.")
+        return None
+
+    checked = len(release_files(manifest))
+    bad = verify_release_files(app_dir, manifest, workers)
+    print(f"Проверени файлове: {checked}, несъответствия: {len(bad)}.")
+    for path, reason in sorted(bad.items()):
+        print(f"  {path}: {VERIFY_PROBLEMS[reason]}")
+    if not bad or not repair:
+        return sorted(bad), checked
+
+    # Repairs write into the release: not while another process updates it
+    if not update_lock.acquire(UPDATE_LOCK_FILE, UPDATE_LOCK_WAIT):
+        print("Друг процес обновява приложението; опитайте отново по-късно.")
+        return sorted(bad), checked
+    try:
+        repair_release_files(app_dir, manifest, sorted(bad), version_data.get('files_url'))
+        still_bad = verify_release_files(app_dir, manifest, workers)
+    finally:
+        update_lock.release(UPDATE_LOCK_FILE)
+    print(f"Поправени файлове: {len(bad) - len(still_bad)}, неуспешни: {len(still_bad)}.")
+    return sorted(still_bad), checked
+
+
+def file_crc32(path):
+    """
+    Return the CRC-32 of a file (the checksum stored in ZIP entries).
+    """
+    import zlib
+
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+
+@instrumentation.traced("update.extract")
+def apply_archive(zip_ref, target_dir='.', source_dir='.'):
+    """
+    Write the members of a GitHub branch archive straight into target_dir.
+    Each member is written once to a temporary sibling file and moved into
+    place with os.replace; members whose size and CRC match the installed
+    file in source_dir are skipped (linked over when the two differ).
+    Files left over in top-level directories the release ships are removed,
+    as the old copytree-based update did.
+    Returns (written, unchanged) file counts.
+    """
+    import shutil
+
+    # The archive has a single top-level folder like "repo-name-branch/"
+    prefix = f"{GITHUB_REPO_NAME}-{GIT_BRANCH}/"
+    written = unchanged = 0
+    release_paths = set()
+    release_dirs = set()
+
+    for info in zip_ref.infolist():
+        if not info.filename.startswith(prefix) or info.is_dir():
+            continue
+        relative_path = info.filename[len(prefix):]
+        if is_user_path(relative_path) or not is_safe_relative_path(relative_path):
+            continue
+
+        destination_path = os.path.join(target_dir, *relative_path.split('/'))
+        release_paths.add(os.path.normpath(destination_path))
+        if '/' in relative_path:
+            release_dirs.add(relative_path.split('/', 1)[0])
+
+        source_path = os.path.join(source_dir, *relative_path.split('/'))
+        if os.path.isfile(source_path) and os.path.getsize(source_path) == info.file_size \
+                and file_crc32(source_path) == info.CRC:
+            if os.path.abspath(source_path) != os.path.abspath(destination_path):
+                link_or_copy(source_path, destination_path)
+            unchanged += 1
+            instrumentation.add("files_unchanged")
+            continue
+
+        parent = os.path.dirname(destination_path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        temp_path = f"{destination_path}.update-tmp"
+        try:
+            with zip_ref.open(info) as source, open(temp_path, 'wb') as out_file:
+                shutil.copyfileobj(source, out_file, 1024 * 1024)
+            os.replace(temp_path, destination_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        written += 1
+        instrumentation.add("files_written")
+        instrumentation.add("bytes_written", info.file_size)
+
+    for dir_name in release_dirs:
+        for root, _, files in os.walk(os.path.join(target_dir, dir_name)):
+            for file_name in files:
+                path = os.path.normpath(os.path.join(root, file_name))
+                if path not in release_paths:
+                    os.remove(path)
+
+    return written, unchanged
+
+
+def apply_full_update(target_dir='.', source_dir='.', version_data=None):
+    """
+    Downloads the release archive and applies it member by member into
+    target_dir, preserving user data. The download uses parallel range
+    requests and resumes an earlier interrupted attempt; it is verified
+    against archive_size/archive_sha256 when version.json publishes them.
+    version.json may also name a prebuilt archive_url (see release.py);
+    otherwise the production branch ZIP is used.
+    Returns True on success.
     """
+    import http.client
+    import zipfile
+    from urllib.error import URLError
+    import downloader
+
+    version_data = version_data or {}
+    url = version_data.get('archive_url') or GITHUB_ZIP_URL
+    archive_path = os.path.join(RELEASES_DIR, f"{ARCHIVE_PREFIX}{version_data.get('version', 'latest')}.zip")
     print("Изтегляне на новата версия...")
-    temp_zip_path = "update.zip"
-    temp_extract_dir = "temp_update_extract"
-
-    try:
-        # Download the ZIP archive
-        with urlopen(GITHUB_ZIP_URL) as response, open(temp_zip_path, 'wb') as out_file:
-            shutil.copyfileobj(response, out_file)
-        print("Архивът е изтеглен.")
-
-        # Extract the archive
-        with zipfile.ZipFile(temp_zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_extract_dir)
-        print("Архивът е разархивиран.")
-
-        # The extracted folder will have a name like "repo-name-branch"
-        extracted_folder_name = f"{GITHUB_REPO_NAME}-{GIT_BRANCH}"
-        extracted_app_path = os.path.join(temp_extract_dir, extracted_folder_name)
-
-        # Copy updated files, excluding the DATA_DIR and the version file itself
-        for item_name in os.listdir(extracted_app_path):
-            source_path = os.path.join(extracted_app_path, item_name)
-            destination_path = os.path.join('.', item_name)
-
-            # Skip the DATA_DIR and the version file
-            if item_name == DATA_DIR or item_name == VERSION_FILE:
-                print(f"Пропускане на директория/файл: {item_name}")
-                continue
-            
-            # Overwrite existing files or copy new ones
-            if os.path.isfile(source_path):
-                shutil.copy2(source_path, destination_path)
-            elif os.path.isdir(source_path):
-                # For directories, remove existing and copy new
-                if os.path.exists(destination_path):
-                    shutil.rmtree(destination_path, onerror=remove_readonly)
-                shutil.copytree(source_path, destination_path)
-            print(f"Обновен файл/директория: {item_name}")
-
-        # Update local version.json
-        with open(VERSION_FILE, 'w', encoding='utf-8') as f:
-            json.dump(github_version_data, f, indent=2)
-        print("Локалният version.json е обновен.")
 
+    try:
+        os.makedirs(RELEASES_DIR, exist_ok=True)
+        with instrumentation.span("update.download", url=url):
+            stats = downloader.download_file(url, archive_path,
+                                             expected_size=version_data.get('archive_size'),
+                                             expected_sha256=version_data.get('archive_sha256'))
+            instrumentation.add("bytes_downloaded", stats['downloaded'])
+            instrumentation.add("bytes_resumed", stats['reused'])
+        if stats['reused']:
+            print(f"Архивът е изтеглен (продължено изтегляне, {stats['reused']} байта от предишен опит).")
+        else:
+            print("Архивът е изтеглен.")
+
+        # Apply members straight from the archive
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+            written, unchanged = apply_archive(zip_ref, target_dir, source_dir)
+        os.remove(archive_path)
+        print(f"Обновени файлове: {written}, непроменени: {unchanged}.")
         return True
-    except (URLError, KeyError, json.JSONDecodeError, zipfile.BadZipFile) as e:
+    except ValueError as e:
+        print(f"Изтегленият архив е невалиден: {e}")
+        return False
+    except (URLError, OSError, http.client.HTTPException, KeyError, zipfile.BadZipFile) as e:
         print(f"Грешка при изтегляне/прилагане на обновяването: {e}")
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+        if os.path.exists(archive_path + downloader.PART_SUFFIX):
+            print("Изтеглената част е запазена и ще бъде продължена при следващия опит.")
         return False
-    finally:
-        # Clean up temporary files
-        if os.path.exists(temp_zip_path):
-            os.remove(temp_zip_path)
-        if os.path.exists(temp_extract_dir):
-            shutil.rmtree(temp_extract_dir, onerror=remove_readonly)
 
 
+@instrumentation.traced("update.apply")
+def apply_update(latest_version, current_version, github_version_data):
+    """
+    Backup user data, apply the given update and restore the data.
+    Returns True if the update was applied.
+    """
+    print(f"Намерена е нова версия: {latest_version} (текуща: {current_version})")
+    print("Започваме обновяване...")
+
+    # Backup user data
+    backup_dir = backup_user_data()
+
+    # Perform update
+    if download_and_apply_update(github_version_data):
+        save_update_state(pending_version=None, pending_required=False)
+        # Restore user data
+        restore_user_data(backup_dir)
+        print("Обновяването е завършено успешно!")
+        return True
+
+    print("Грешка при обновяването. Възстановяване на данните...")
+    restore_user_data(backup_dir)
+    print("Обновяването е отменено.")
+    return False
+
+
+@instrumentation.traced("update.check")
 def check_for_updates():
     """
     Check for and apply updates if available.
+    Single-flight between processes: if another process is already checking
+    or updating, wait for it and reuse its result from the shared metadata
+    cache instead of making requests of our own.
     """
     print("Проверка за нови версии...")
 
-    current_version, _ = get_current_version() # current_sha is no longer relevant for comparison
-    latest_info = get_latest_github_version()
-
-    if latest_info:
-        latest_github_version, _, github_version_data = latest_info
-
-        # Compare versions (using the 'version' field from version.json)
-        if latest_github_version != current_version:
-            print(f"Намерена е нова версия: {latest_github_version} (текуща: {current_version})")
-            print("Започваме обновяване...")
+    locked = update_lock.try_acquire(UPDATE_LOCK_FILE)
+    if not locked:
+        print("Друг процес вече проверява за обновления. Изчакване на резултата...")
+        if not update_lock.wait_released(UPDATE_LOCK_FILE, UPDATE_LOCK_WAIT):
+            print("Другият процес не приключи навреме. Проверката се пропуска.")
+            return
+    try:
+        # Read after the wait: the other process may have installed a release
+        current_version, _ = get_current_version() # current_sha is no longer relevant for comparison
+        latest_info = get_latest_github_version(offline=not locked)
 
-            # Backup user data
-            backup_dir = backup_user_data()
+        if latest_info:
+            latest_github_version, github_version_data = latest_info
 
-            # Perform update
-            if download_and_apply_update(github_version_data):
-                # Restore user data
-                restore_user_data(backup_dir)
-                print("Обновяването е завършено успешно!")
+            # Only a later version is an update: never downgrade
+            if not is_newer_version(latest_github_version, current_version):
+                print("Приложението е актуално.")
+                save_update_state(pending_version=None, pending_required=False)
+            elif not is_wanted_update(latest_github_version, current_version):
+                print(f"Версия {latest_github_version} се пропуска: към {current_version} е върнато ръчно.")
+                save_update_state(pending_version=None, pending_required=False)
+            elif not locked:
+                print(f"Налична е нова версия {latest_github_version}, "
+                      "но друг процес отговаря за обновяването в момента.")
             else:
-                print("Грешка при обновяването. Възстановяване на данните...")
-                restore_user_data(backup_dir)
-                print("Обновяването е отменено.")
+                required = update_required(current_version, github_version_data)
+                if required:
+                    print(f"Версия {current_version} вече не се поддържа. Обновяването е задължително.")
+                save_update_state(pending_version=latest_github_version, pending_required=required)
+                apply_update(latest_github_version, current_version, github_version_data)
         else:
-            print("Приложението е актуално.")
-    else:
-        print("Не може да се свърже с GitHub за проверка на обновления.")
+            print("Не може да се свърже с GitHub за проверка на обновления.")
+    finally:
+        if locked:
+            update_lock.release(UPDATE_LOCK_FILE)
+
+
+@instrumentation.traced("update.background_check")
+def _background_check():
+    """
+    Thread target: look for a newer version without printing anything,
+    so the output does not interleave with the menu. While another process
+    checks, its result is awaited and reused instead.
+    """
+    global _pending_update
+
+    locked = update_lock.try_acquire(UPDATE_LOCK_FILE)
+    if not locked and not update_lock.wait_released(UPDATE_LOCK_FILE, UPDATE_LOCK_WAIT):
+        return
+    try:
+        current_version, _ = get_current_version()
+        latest_info = get_latest_github_version(verbose=False, offline=not locked)
+        if latest_info and is_wanted_update(latest_info[0], current_version):
+            if locked:
+                save_update_state(pending_version=latest_info[0],
+                                  pending_required=update_required(current_version, latest_info[1]))
+            _pending_update = (latest_info[0], current_version, latest_info[1])
+        elif latest_info and locked:
+            save_update_state(pending_version=None, pending_required=False)
+    finally:
+        if locked:
+            update_lock.release(UPDATE_LOCK_FILE)
+
+
+def start_background_check():
+    """
+    Start checking for updates in a daemon thread and return immediately.
+    A found update is only staged; apply it with apply_pending_update().
+    """
+    global _background_thread, _pending_update
+
+    _pending_update = None
+    _background_thread = threading.Thread(target=_background_check, name="update-check", daemon=True)
+    _background_thread.start()
+    return _background_thread
+
+
+def get_pending_update():
+    """
+    Return the staged update (latest_version, current_version, version_data)
+    without waiting, or None if the check is still running or found nothing.
+    """
+    if _background_thread is None or _background_thread.is_alive():
+        return None
+    return _pending_update
+
+
+def apply_pending_update(timeout=HTTP_TIMEOUT):
+    """
+    Apply the update staged by the background check, if any.
+    Waits up to timeout seconds for a check that is still running, and for
+    an update another process is applying; a version that process already
+    installed is not applied again.
+    Returns True if an update was applied.
+    """
+    if _background_thread is None:
+        return False
+
+    global _pending_update
+
+    _background_thread.join(timeout)
+    pending = get_pending_update()
+    if not pending:
+        return False
+    _pending_update = None
+
+    if not update_lock.acquire(UPDATE_LOCK_FILE, UPDATE_LOCK_WAIT):
+        print("Друг процес обновява приложението. Обновяването се пропуска.")
+        return False
+    try:
+        current_version, _ = get_current_version()
+        if not is_newer_version(pending[0], current_version):
+            print(f"Версия {current_version} вече е инсталирана от друг процес.")
+            return False
+        return apply_update(pending[0], current_version, pending[2])
+    finally:
+        update_lock.release(UPDATE_LOCK_FILE)
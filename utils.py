@@ -3,13 +3,34 @@
 Utility functions for JSON file management.
 """
 
+import collections
+import itertools
 import json
 import os
-import glob
+
+import catalog
+import json_stream
+import storage
+# Re-exported: the atomic write helpers live with the storage backends
+from storage import fsync_dir, write_json_atomic
 
 # Directory for user data JSON files
 DATA_DIR = "user_data"
 
+# Number of files shown per page in the file picker
+PAGE_SIZE = 20
+
+# Bytes of a large file's content shown per screen
+CONTENT_PAGE_SIZE = 4096
+
+# Keep the previous version of an overwritten file as <name>.json.bak.
+# Off by default: nothing removes, migrates or backs up the .bak files.
+# Enable with APP_KEEP_PREVIOUS=1; applies to the "files" storage backend only.
+KEEP_PREVIOUS_VERSION = os.environ.get("APP_KEEP_PREVIOUS", "0") == "1"
+
+# Records handed to one worker at a time by import_records
+IMPORT_CHUNK_SIZE = 500
+
 def show_menu():
     """
     Display main menu and get user choice.
@@ -17,24 +38,101 @@ def show_menu():
     print("Изберете действие:")
     print("1. Четене от съществуващ JSON файл")
     print("2. Създаване на нов JSON файл")
+    print("3. Търсене в записите")
 
-    choice = input("Ваш избор (1 или 2): ").strip()
+    choice = input("Ваш избор (1, 2 или 3): ").strip()
     return choice
 
 
 def list_json_files():
     """
-    List all JSON files in the data directory.
-    Returns list of .json files (relative to DATA_DIR).
+    List all records in the data directory, sorted.
+    Returns list of .json names (relative to DATA_DIR).
     """
     # Ensure data directory exists before listing
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
         return [] # No files if directory was just created
 
-    json_files = glob.glob(os.path.join(DATA_DIR, "*.json"))
-    # Return only the filename for display, but use full path for operations
-    return [os.path.basename(f) for f in json_files]
+    with storage.open_store(DATA_DIR) as store:
+        return store.list_names()
+
+
+def iter_json_files(query=None):
+    """
+    Yield the names of the records in DATA_DIR in storage order,
+    optionally filtered by a picker search query.
+    """
+    with storage.open_store(DATA_DIR) as store:
+        yield from store.iter_names(query)
+
+
+def get_files_page(page, query=None):
+    """
+    Return (names, total) for one page (0-based) of the records matching query.
+    Only the requested page is materialized (see storage.FileStore.page).
+    """
+    if not os.path.exists(DATA_DIR):
+        os.makedirs(DATA_DIR)
+        return [], 0
+
+    with storage.open_store(DATA_DIR) as store:
+        return store.page(page * PAGE_SIZE, PAGE_SIZE, query)
+
+
+def pick_json_file():
+    """
+    Paginated file picker. Shows one page at a time and accepts a file
+    number, n/p for the next/previous page, g<N> to jump to page N,
+    /text to search (/^text for a prefix, / alone clears the search)
+    and an empty line to cancel.
+    Returns the chosen filename, or None.
+    """
+    page, query = 0, None
+    while True:
+        files, total = get_files_page(page, query)
+        page_count = max((total + PAGE_SIZE - 1) // PAGE_SIZE, 1)
+        if page >= page_count:
+            page = page_count - 1
+            files, total = get_files_page(page, query)
+
+        if total == 0:
+            if query:
+                print(f"\nНяма файлове, отговарящи на '{query}'.")
+            else:
+                print(f"Няма JSON файлове в директорията '{DATA_DIR}'.")
+                return None
+        else:
+            search_note = f", търсене: '{query}'" if query else ""
+            print(f"\nНалични JSON файлове в '{DATA_DIR}' (страница {page + 1}/{page_count}, общо {total}{search_note}):")
+            for i, file in enumerate(files, 1):
+                print(f"{i}. {file}")
+
+        choice = input("\nИзберете файл (номер), n/p - страница, g<N> - към страница, /текст - търсене: ").strip()
+        if not choice:
+            return None
+        if choice == 'n':
+            page = min(page + 1, page_count - 1)
+        elif choice == 'p':
+            page = max(page - 1, 0)
+        elif choice.startswith('g') and choice[1:].strip().isdigit():
+            page = min(max(int(choice[1:]) - 1, 0), page_count - 1)
+        elif choice.startswith('/'):
+            query, page = choice[1:] or None, 0
+        else:
+            is_valid, filename = validate_file_choice(choice, files)
+            if is_valid:
+                return filename
+            print("Невалиден избор.")
+
+
+def get_file_meta(filename):
+    """
+    Return the meta fields of a record (everything except "content") from the
+    store's index, without parsing the record unless it changed since.
+    """
+    with storage.open_store(DATA_DIR) as store:
+        return store.meta(filename)
 
 
 def validate_file_choice(choice, files_list):
@@ -56,48 +154,228 @@ def read_json_file():
     """
     Read and display content of a JSON file.
     """
-    files = list_json_files()
-
-    if not files:
-        print(f"Няма JSON файлове в директорията '{DATA_DIR}'.")
+    filename = pick_json_file()
+    if not filename:
         return
+    show_record(filename)
 
-    print(f"\nНалични JSON файлове в '{DATA_DIR}':")
-    for i, file in enumerate(files, 1):
-        print(f"{i}. {file}")
-
-    choice = input("\nИзберете файл (номер): ").strip()
-
-    is_valid, filename = validate_file_choice(choice, files)
-    if not is_valid:
-        print("Невалиден избор.")
-        return
 
+def show_record(filename):
+    """
+    Display the content of a record and, on request, its meta-info.
+    """
     filepath = os.path.join(DATA_DIR, filename) # Construct full path
 
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            
-            # Extract content and meta-info
+        with storage.open_store(DATA_DIR) as store:
+            # Large records are files of their own on either backend
+            large_path = store.path(filename)
+            if store.size(filename) > json_stream.LARGE_FILE_THRESHOLD and large_path:
+                read_large_json_file(large_path)
+                return
+
+            data = store.read(filename)
+
+            # Extract content; the meta-info comes from the store's index
             content = data.get("content", "Няма съдържание.")
-            meta_info = {k: v for k, v in data.items() if k != "content"}
 
             print(f"\nСъдържание на файла '{filepath}':")
             print(content)
 
+            meta_info = store.meta(filename)
             if meta_info:
                 show_meta = input("\nЖелаете ли да видите мета информацията за файла? (y/n): ").strip().lower()
                 if show_meta == 'y':
                     print("\nМета информация:")
                     print(json.dumps(meta_info, indent=2, ensure_ascii=False))
-            
-    except json.JSONDecodeError:
+
+    except (json.JSONDecodeError, ValueError):
         print(f"Грешка: Файлът '{filepath}' не е валиден JSON.")
     except FileNotFoundError:
         print(f"Грешка: Файлът '{filepath}' не е намерен.")
 
 
+def search_records():
+    """
+    Full-text search over the records' content and meta-info (see
+    search_index.py): shows the matches one page at a time and opens the
+    chosen one. n/p switch pages, an empty line cancels.
+    """
+    if not catalog.AVAILABLE:
+        print("Търсенето изисква модула sqlite3.")
+        return
+    import search_index
+
+    query = input("Търсене (думи; последната може да е начало на дума): ").strip()
+    if not query:
+        return
+
+    page = 0
+    while True:
+        files, total, truncated = search_index.find(DATA_DIR, query, page * PAGE_SIZE, PAGE_SIZE)
+        if truncated:
+            print(f"Думите, започващи с '{truncated}', са твърде много; търсени са само "
+                  f"{search_index.MAX_PREFIX_TERMS} най-честите. Въведете повече букви.")
+        if total == 0:
+            print(f"Няма записи, съдържащи '{query}'.")
+            return
+        page_count = (total + PAGE_SIZE - 1) // PAGE_SIZE
+        # Matches are counted only up to COUNT_LIMIT; later pages count further
+        shown_total = f"над {search_index.COUNT_LIMIT}" if total > search_index.COUNT_LIMIT else total
+        print(f"\nНамерени записи за '{query}' (страница {page + 1}/{page_count}, общо {shown_total}):")
+        for i, file in enumerate(files, 1):
+            print(f"{i}. {file}")
+
+        choice = input("\nИзберете запис (номер), n/p - страница: ").strip()
+        if not choice:
+            return
+        if choice == 'n':
+            page = min(page + 1, page_count - 1)
+        elif choice == 'p':
+            page = max(page - 1, 0)
+        else:
+            is_valid, filename = validate_file_choice(choice, files)
+            if is_valid:
+                show_record(filename)
+                return
+            print("Невалиден избор.")
+
+
+def read_large_json_file(filepath):
+    """
+    Display a file too large to load at once: the content is decoded and
+    shown one screen at a time and the meta-info is read without it,
+    so memory use does not depend on the file size.
+    """
+    with json_stream.LargeRecord(filepath) as record:
+        print(f"\nСъдържание на файла '{filepath}' ({os.path.getsize(filepath)} байта):")
+        if "content" in record.spans:
+            chunks = record.iter_string("content", CONTENT_PAGE_SIZE)
+            chunk = next(chunks, None)
+            while chunk is not None:
+                print(chunk, end='')
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    more = input("\n-- Enter за още, q за край --").strip().lower()
+                    if more == 'q':
+                        break
+            print()
+        else:
+            print(record.fields.get("content", "Няма съдържание."))
+
+        meta_info = {k: v for k, v in record.fields.items() if k != "content"}
+        if meta_info:
+            show_meta = input("\nЖелаете ли да видите мета информацията за файла? (y/n): ").strip().lower()
+            if show_meta == 'y':
+                print("\nМета информация:")
+                print(json.dumps(meta_info, indent=2, ensure_ascii=False))
+
+
+def write_json_batch(records, dir_path=DATA_DIR):
+    """
+    Write many (filename, data) records into the store of dir_path in one
+    batch: one directory fsync (files) or one transaction (segments).
+    Returns the number of records written.
+    """
+    with storage.open_store(dir_path) as store:
+        return store.write_many(records)
+
+
+def build_record(content):
+    """
+    Build a user data record in the shape create_new_json() saves.
+    """
+    return {
+        "content": content,
+        "created_at": str(os.environ.get('USERNAME', 'unknown')),
+        "version": "1.0"
+    }
+
+
+def record_filename(name):
+    """
+    Return the file name for a record name (adding .json), or None if the
+    name is empty or would point outside DATA_DIR.
+    """
+    name = str(name).strip()
+    if not name or name in ('.', '..') or '/' in name or '\\' in name or os.path.splitdrive(name)[0]:
+        return None
+    return name if name.endswith('.json') else name + '.json'
+
+
+def import_records(lines, workers=None):
+    """
+    Create records from NDJSON lines ({"name": ..., "content": ...}).
+    Chunks of records are written in parallel by a thread pool, each as one
+    store batch (see write_json_batch). Reads the input lazily, holding at most a few
+    chunks per worker in memory.
+    Returns (imported, errors) where errors lists (line_number, message).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not os.path.exists(DATA_DIR):
+        os.makedirs(DATA_DIR)
+
+    errors = []
+    backend = storage.detect_backend(DATA_DIR)
+
+    def parse(numbered_lines):
+        for line_number, line in numbered_lines:
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                filename = record_filename(item["name"])
+                if filename is None:
+                    raise ValueError(f"невалидно име '{item['name']}'")
+                content = item.get("content", "")
+                yield filename, build_record(content if isinstance(content, str) else json.dumps(content))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                errors.append((line_number, str(e)))
+
+    def write_chunk(chunk):
+        # One store per chunk: SQLite connections are not shared across threads
+        with storage.open_store(DATA_DIR, backend) as store:
+            return store.write_many(chunk)
+
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    records = parse(enumerate(lines, 1))
+    imported = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for chunk in iter(lambda: list(itertools.islice(records, IMPORT_CHUNK_SIZE)), []):
+            pending.append(pool.submit(write_chunk, chunk))
+            if len(pending) >= workers * 2:
+                imported += pending.popleft().result()
+        while pending:
+            imported += pending.popleft().result()
+    return imported, errors
+
+
+def export_records(out):
+    """
+    Stream every record in DATA_DIR, in storage order, to out as NDJSON lines
+    ({"name": ..., <record fields>}) without prompts.
+    Returns (exported, errors) where errors lists (filename, message).
+    """
+    if not os.path.exists(DATA_DIR):
+        return 0, []
+
+    exported = 0
+    errors = []
+    with storage.open_store(DATA_DIR) as store:
+        for filename in store.iter_names():
+            try:
+                data = store.read(filename)
+            except (OSError, ValueError) as e:
+                errors.append((filename, str(e)))
+                continue
+            out.write(json.dumps({"name": filename[:-len('.json')], **data}, ensure_ascii=False))
+            out.write('\n')
+            exported += 1
+    return exported, errors
+
+
 def create_new_json():
     """
     Create a new JSON file.
@@ -117,26 +395,38 @@ def create_new_json():
 
     filepath = os.path.join(DATA_DIR, filename) # Construct full path
 
+    store = storage.open_store(DATA_DIR)
+    version_before = store.version()
+
     # Check if file already exists
-    if os.path.exists(filepath):
+    if store.exists(filename):
         overwrite = input(f"Файлът '{filepath}' вече съществува. Презаписване? (y/n): ").strip().lower()
         if overwrite != 'y':
             print("Операцията е отменена.")
+            store.close()
             return
 
     content = input("Въведете съдържание на файла (текст/информация): ").strip()
     if not content:
         content = ""  # Allow empty content
 
-    data = {
-        "content": content,
-        "created_at": str(os.environ.get('USERNAME', 'unknown')),
-        "version": "1.0"
-    }
+    data = build_record(content)
 
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        try:
+            store.write(filename, data, keep_previous=KEEP_PREVIOUS_VERSION)
+        except Exception as e:
+            print(f"Грешка при запазването на файла: {e}")
+            return
         print(f"Файлът '{filepath}' е създаден успешно.")
-    except Exception as e:
-        print(f"Грешка при запазването на файла: {e}")
+        if catalog.AVAILABLE:
+            # Keep the search index current, so the next search need not rescan.
+            # The file is saved either way: a stale index is resynced on search.
+            import search_index
+            try:
+                search_index.record_change(store, filename, version_before)
+            except Exception as e:
+                print(f"Предупреждение: индексът за търсене не е обновен ({e}). "
+                      "Ще бъде поправен при следващото търсене.")
+    finally:
+        store.close()